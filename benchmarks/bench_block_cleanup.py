@@ -0,0 +1,107 @@
+"""
+Compares the previous and vectorized `fill_holes` and `drop_contained_geometries`
+on synthetic enclosures of a city with many blocks:
+
+    python benchmarks/bench_block_cleanup.py --blocks 100000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from shapely.geometry import Polygon
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "urban_scaling_toolkit"))
+
+import utils
+
+
+def legacy_fill_holes(gdf):
+    gdf["geometry"] = gdf["geometry"].boundary
+    gdf = gdf.explode(index_parts=False)
+    gdf["geometry"] = gdf["geometry"].map(
+        lambda x: Polygon(x) if x.geom_type != 'Point' else np.nan)
+    gdf = gdf.dropna(subset='geometry').reset_index(drop=True).to_crs(4326)
+
+    return gdf
+
+
+def legacy_drop_contained_geometries(gdf):
+    gdf = gdf.reset_index(drop=True)
+
+    overlaps = gdf["geometry"].sindex.query(gdf["geometry"], predicate="contains")
+    contains_dict = {x: [] for x in overlaps[0]}
+    for x, y in zip(overlaps[0], overlaps[1]):
+        if x != y:
+            contains_dict[x].append(y)
+
+    contained_geoms_idxs = list({x for v in contains_dict.values() for x in v})
+    gdf = gdf.drop(contained_geoms_idxs)
+    gdf = gdf.reset_index(drop=True)
+
+    return gdf
+
+
+def make_enclosures(n_blocks, hole_share=0.2, seed=0):
+    """
+    Returns square enclosures on a grid, some of them with a hole
+    and a smaller enclosure inside the hole, as polygonize produces around cul-de-sacs.
+    """
+
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(n_blocks)))
+    cell = 0.001
+
+    x, y = np.divmod(np.arange(n_blocks), side)
+    x, y = x * cell, y * cell
+    outer = shapely.box(x, y, x + 0.9 * cell, y + 0.9 * cell)
+
+    with_hole = rng.random(n_blocks) < hole_share
+    inner = shapely.box(x + 0.3 * cell, y + 0.3 * cell, x + 0.6 * cell, y + 0.6 * cell)
+    outer[with_hole] = shapely.difference(outer[with_hole], inner[with_hole])
+
+    geometry = np.concatenate([outer, inner[with_hole]])
+
+    return gpd.GeoDataFrame({"index": np.arange(len(geometry))}, geometry=geometry, crs=4326)
+
+
+def timeit(func, gdf, repeat):
+    times = []
+    for _ in range(repeat):
+        data = gdf.copy()
+        start = time.perf_counter()
+        res = func(data)
+        times.append(time.perf_counter() - start)
+
+    return min(times), res
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--blocks", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    enclosures = make_enclosures(args.blocks)
+    print(f"{len(enclosures)} enclosures")
+
+    for name, legacy, vectorized in [
+            ("fill_holes", legacy_fill_holes, utils.fill_holes),
+            ("drop_contained_geometries", legacy_drop_contained_geometries, utils.drop_contained_geometries)]:
+
+        legacy_time, legacy_res = timeit(legacy, enclosures, args.repeat)
+        vectorized_time, res = timeit(vectorized, enclosures, args.repeat)
+
+        same = len(res) == len(legacy_res) and shapely.equals(res.geometry.values, legacy_res.geometry.values).all()
+        print(f"{name}: legacy {legacy_time:.3f}s, vectorized {vectorized_time:.3f}s, "
+              f"speedup {legacy_time / vectorized_time:.1f}x, same result: {same}")
+
+        enclosures = res
+
+
+if __name__ == "__main__":
+    main()
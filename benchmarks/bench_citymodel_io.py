@@ -0,0 +1,142 @@
+"""
+Compares the dill pickle of a CityModel with `CityModel.save`/`CityModel.load`
+(GeoParquet per layer) by size on disk and save/load time on a large synthetic city:
+
+    python benchmarks/bench_citymodel_io.py --blocks 200000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "urban_scaling_toolkit"))
+
+import utils
+from city_model import CityModel, read_layer
+
+
+def make_model(n_blocks, services_per_block=2, blocks_per_cluster=20, seed=0):
+    """
+    Returns a CityModel with grid blocks and random services, clusters and stats
+    in the columns produced by the full pipeline.
+    """
+
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(n_blocks)))
+    cell = 0.001
+
+    lines = np.arange(side + 1) * cell
+    roads = gpd.GeoSeries(np.concatenate([
+        shapely.linestrings(np.stack([np.c_[lines, np.zeros(side + 1)], np.c_[lines, np.full(side + 1, side * cell)]], axis=1)),
+        shapely.linestrings(np.stack([np.c_[np.zeros(side + 1), lines], np.c_[np.full(side + 1, side * cell), lines]], axis=1))]), crs=4326)
+    territory = gpd.GeoDataFrame(geometry=[shapely.box(0, 0, side * cell, side * cell)], crs=4326)
+
+    model = CityModel(territory, roads, verbose=False)
+
+    x, y = np.divmod(np.arange(n_blocks), side)
+    cluster_id = np.where(rng.random(n_blocks) < 0.3, x // 5 * side + y // 4, np.nan)
+    model.blocks = gpd.GeoDataFrame({
+        "block_id": np.arange(n_blocks),
+        "geometry": shapely.box(x * cell, y * cell, (x + 0.9) * cell, (y + 0.9) * cell),
+        "area": rng.uniform(1e3, 1e5, n_blocks),
+        "cluster_id": cluster_id,
+        "diversity": np.where(np.isnan(cluster_id), np.nan, rng.random(n_blocks)),
+        "services_total": np.where(np.isnan(cluster_id), np.nan, rng.integers(1, 50, n_blocks)),
+        "centrality": rng.random(n_blocks),
+        "centrality_bin": rng.integers(0, 11, n_blocks),
+        "population": rng.integers(0, 500, n_blocks),
+    }, crs=4326)
+
+    n_services = n_blocks * services_per_block
+    block_id = rng.integers(0, n_blocks, n_services)
+    categories = np.array(["education", "food", "leisure", "shop"])
+    tags = np.array(["school", "cafe", "restaurant", "cinema", "bakery", "books"])
+    model.services = gpd.GeoDataFrame({
+        "service_id": np.arange(n_services),
+        "name": [f"service {i}" for i in range(n_services)],
+        "tags": [list(rng.choice(tags, rng.integers(1, 3))) for _ in range(n_services)],
+        "category": rng.choice(categories, n_services),
+        "geometry": shapely.points(rng.uniform(0, side * cell, (n_services, 2))),
+        "block_id": block_id,
+        "cluster_id": cluster_id[block_id],
+    }, crs=4326)
+
+    clusters = np.unique(cluster_id[~np.isnan(cluster_id)])
+    hulls = model.blocks.dropna(subset="cluster_id").dissolve("cluster_id").convex_hull
+    model.cluster_polygons = gpd.GeoDataFrame({"cluster_id": hulls.index}, geometry=hulls.values, crs=4326)
+
+    n_clusters = len(clusters)
+    model.cluster_info = gpd.GeoDataFrame({
+        "cluster_id": clusters,
+        "centrality_bin": rng.integers(0, 11, n_clusters),
+        "centrality": rng.random(n_clusters),
+        "diversity": rng.random(n_clusters),
+        "services_total": rng.integers(1, 500, n_clusters).astype(float),
+        "area": rng.uniform(1e4, 1e6, n_clusters),
+        "population": rng.integers(0, 10000, n_clusters),
+        "geometry": hulls.values,
+        "top_tags": [list(rng.choice(tags, 3, replace=False)) for _ in range(n_clusters)],
+        "top_categories": [list(rng.choice(categories, 3, replace=False)) for _ in range(n_clusters)],
+        **{category: rng.integers(0, 100, n_clusters).astype(float) for category in categories},
+        "centrality_norm": rng.random(n_clusters),
+    }, crs=4326)
+
+    return model
+
+
+def get_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(entry.stat().st_size for entry in os.scandir(path))
+
+
+def timeit(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        res = func()
+        times.append(time.perf_counter() - start)
+
+    return min(times), res
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--blocks", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    model = make_model(args.blocks)
+    print(f"{len(model.blocks)} blocks, {len(model.services)} services, {len(model.cluster_info)} clusters")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pkl_path = os.path.join(tmp, "model.pkl")
+        parquet_path = os.path.join(tmp, "model")
+
+        cases = [
+            ("dill", pkl_path,
+             lambda: utils.save_pkl(model, pkl_path),
+             [("load", lambda: utils.load_pkl(pkl_path))]),
+            ("geoparquet", parquet_path,
+             lambda: model.save(parquet_path),
+             [("load", lambda: CityModel.load(parquet_path)),
+              ("lazy load of blocks", lambda: CityModel.load(parquet_path, lazy=True).blocks),
+              ("blocks population and cluster_id", lambda: read_layer(parquet_path, "blocks", ["cluster_id", "population"]))]),
+        ]
+
+        for name, path, save, loads in cases:
+            save_time, _ = timeit(save, args.repeat)
+            print(f"{name}: size {get_size(path) / 1024 ** 2:.1f} MB, save {save_time:.2f} s")
+            for load_name, load in loads:
+                load_time, _ = timeit(load, args.repeat)
+                print(f"{name}: {load_name} {load_time:.3f} s")
+
+
+if __name__ == "__main__":
+    main()
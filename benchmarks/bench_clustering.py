@@ -0,0 +1,81 @@
+"""
+Times the sparse clustering engine on synthetic services of growing number, at the density
+of `bench_pipeline_scaling.py` cities and the default clustering distance of `CityModel.cluster_blocks`,
+where services of a city form one connected component:
+
+    python benchmarks/bench_clustering.py --services 50000 100000 200000
+
+Sizes up to `--max-dense` are also clustered with a full scipy linkage, and the labels
+of both are compared by the adjusted Rand index.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from scipy.cluster.hierarchy import fcluster, linkage
+from sklearn.metrics import adjusted_rand_score
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "urban_scaling_toolkit"))
+
+from clusterizer import get_sparse_clusters
+
+
+def make_services(n, density=300, seed=0):
+    """
+    Returns `n` services in a square with `density` services per km² (EPSG:32632):
+    half of them uniform, half clustered around centers that are denser towards the middle.
+    """
+
+    rng = np.random.default_rng(seed)
+    side = np.sqrt(n / density) * 1000
+    parents = side / 2 + rng.normal(0, side / 6, (max(n // 80, 1), 2))
+    coords = np.vstack([
+        rng.uniform(0, side, (n // 2, 2)),
+        parents[rng.integers(0, len(parents), n - n // 2)] + rng.normal(0, 150, (n - n // 2, 2))])
+
+    return gpd.GeoDataFrame(geometry=shapely.points(coords), crs=32632)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--services", type=int, nargs="+", default=[5000, 50000, 100000, 200000])
+    parser.add_argument("--links", nargs="+", default=["average", "complete", "single"])
+    parser.add_argument("--clustering-distance", type=float, default=1200)
+    parser.add_argument("--max-dense", type=int, default=10000, help="largest size clustered with scipy too")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    results = []
+    for n in args.services:
+        services = make_services(n, seed=args.seed)
+        coords = shapely.get_coordinates(services.geometry.values)
+
+        for link in args.links:
+            start = time.perf_counter()
+            labels = get_sparse_clusters(services, distance_limit=args.clustering_distance, link=link)
+            result = {"services": n, "link": link, "sparse, s": time.perf_counter() - start,
+                      "clusters": labels.max() + 1, "scipy, s": np.nan, "ari": np.nan}
+
+            if n <= args.max_dense:
+                start = time.perf_counter()
+                expected = fcluster(linkage(coords, method=link), t=args.clustering_distance, criterion="distance")
+                result["scipy, s"] = time.perf_counter() - start
+                result["ari"] = adjusted_rand_score(expected, labels)
+
+            print(", ".join(f"{key}: {value:.3f}" if isinstance(value, float) else f"{key}: {value}"
+                            for key, value in result.items()), flush=True)
+            results.append(result)
+
+    results = pd.DataFrame(results)
+    with pd.option_context("display.width", 200, "display.float_format", "{:.3f}".format):
+        print(results.pivot(index="services", columns="link", values="sparse, s"))
+
+
+if __name__ == "__main__":
+    main()
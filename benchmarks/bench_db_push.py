@@ -0,0 +1,86 @@
+"""
+Compares COPY and row-wise INSERT paths of `push_citymodel_to_db` on synthetic data.
+
+Requires a running PostGIS server with credentials in `.env` (see db_manager).
+The benchmark creates its own scratch database and drops it afterwards:
+
+    python benchmarks/bench_db_push.py --dbname push_benchmark --blocks 50000
+"""
+
+import argparse
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "urban_scaling_toolkit"))
+
+
+def make_model(n_blocks, services_per_block=3, roads_per_block=4, tags_per_service=2, seed=0):
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(n_blocks)))
+    cell = 0.001
+
+    x, y = np.divmod(np.arange(n_blocks), side)
+    blocks = gpd.GeoDataFrame({
+        "block_id": np.arange(n_blocks),
+        "cluster_id": rng.integers(0, max(n_blocks // 50, 1), n_blocks).astype(float),
+        "population": rng.integers(0, 500, n_blocks),
+        "area": np.full(n_blocks, 1e4),
+        "geometry": shapely.box(x * cell, y * cell, (x + 0.9) * cell, (y + 0.9) * cell),
+    }, crs=4326)
+
+    n_services = n_blocks * services_per_block
+    services = gpd.GeoDataFrame({
+        "service_id": np.arange(n_services),
+        "block_id": np.repeat(np.arange(n_blocks), services_per_block),
+        "name": [f"service {i}" for i in range(n_services)],
+        "tags": [list(rng.choice(["school", "cafe", "bank", "park"], tags_per_service)) for _ in range(n_services)],
+        "geometry": shapely.points(rng.uniform(0, side * cell, (n_services, 2))),
+    }, crs=4326)
+
+    starts = rng.uniform(0, side * cell, (n_blocks * roads_per_block, 2))
+    roads = gpd.GeoSeries(shapely.linestrings(np.stack([starts, starts + cell], axis=1)), crs=4326)
+
+    return SimpleNamespace(blocks=blocks, services=services, roads=roads)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dbname", default="push_benchmark")
+    parser.add_argument("--blocks", type=int, default=20000)
+    args = parser.parse_args()
+
+    # point db_manager helpers to the scratch database
+    os.environ["dbname"] = args.dbname
+    import db_manager
+    from batch_city_aggregator import push_citymodel_to_db
+
+    db_manager.create_urban_scaling_db(dbname=args.dbname)
+    try:
+        for create_table in [db_manager.create_city_table, db_manager.create_block_table, db_manager.create_road_table,
+                             db_manager.create_service_table, db_manager.create_tag_table,
+                             db_manager.create_servicetag_table, db_manager.create_id_sequences]:
+            create_table()
+        db_manager.post_query([
+            "INSERT INTO city (name) VALUES ('benchmark')",
+            "INSERT INTO tag (name, category) VALUES ('school','education'), ('cafe','food'), ('bank','other'), ('park','nature')",
+        ])
+        tags_df = db_manager.get_query("SELECT tag_id, name FROM tag")
+        engine = db_manager.get_engine()
+
+        for method in ["insert", "copy"]:
+            model = make_model(args.blocks)
+            start = time.perf_counter()
+            push_citymodel_to_db(model, 1, engine, tags_df, method=method)
+            print(f"{method:>6}: {time.perf_counter() - start:.2f} s")
+    finally:
+        db_manager.drop_db(dbname=args.dbname)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+"""
+Times the CityModel pipeline on synthetic cities of growing size, offline:
+grid and organic roads, a river and lakes, a railway, Poisson and clustered services
+and a population GeoTIFF in ESRI:54009 like GHS-POP.
+
+For every stage it prints the time at each size and the scaling exponent,
+the slope of log(time) over log(number of blocks). Exponents well above 1
+show stages that grow super-linearly with the city. The pipeline runs with
+the defaults of `process_city` and with the faster engines, side by side:
+
+    python benchmarks/bench_pipeline_scaling.py --sizes 2 4 8 16
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import warnings
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+import shapely
+from rasterio.transform import from_origin
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "urban_scaling_toolkit"))
+
+import instrumentation
+from city_model import CityModel
+from data_fetcher import service_tags
+
+# synthetic cities are drawn in UTM meters around this point and passed to the model in EPSG:4326
+LOCAL_CRS = 32632
+ORIGIN = (500000, 5000000)
+
+STAGES = ["generate_blocks", "set_services", "cluster_blocks", "evaluate_centrality",
+          "populate_blocks", "aggregate_cluster_info"]
+
+# keyword arguments of CityModel methods by stage: "default" runs the pipeline as `process_city` does,
+# "fast" switches to the engines added for large cities
+CONFIGS = {
+    "default": {},
+    "fast": {"cluster_blocks": {"engine": "sparse"}, "populate_blocks": {"engine": "raster"}},
+}
+
+
+def _random_walk(rng, start, n_steps, step, turn):
+    heading = rng.uniform(0, 2 * np.pi)
+    headings = heading + np.cumsum(rng.normal(0, turn, n_steps))
+    steps = np.c_[np.cos(headings), np.sin(headings)] * step
+    return np.vstack([start, start + np.cumsum(steps, axis=0)])
+
+
+def make_city(size_km, seed=0, grid_spacing=150, services_per_km2=300):
+    """
+    Returns a synthetic city: a regular street grid in the center, organic streets across it,
+    a ring road with radial arterials, a river, lakes, a railway and services.
+
+    Attributes
+    ----------
+    size_km: float
+        Side of the square the city is drawn in.
+
+    grid_spacing: float
+        Distance between streets of the central grid in meters.
+
+    services_per_km2: float
+        Density of services. Half of them are uniform, half are clustered around centers
+        that are denser towards the city center.
+
+    Returns
+    -------
+    city: dict
+        `territory`, `roads`, `railways`, `water` and `services` in EPSG:4326,
+        the same as `data_fetcher` returns for a real city.
+    """
+
+    rng = np.random.default_rng(seed)
+    side = size_km * 1000
+    x0, y0 = ORIGIN
+    center = np.array([x0 + side / 2, y0 + side / 2])
+
+    # irregular territory
+    angles = np.linspace(0, 2 * np.pi, 72, endpoint=False)
+    radii = side / 2 * (0.85 + 0.15 * rng.random(len(angles)))
+    territory = shapely.Polygon(center + np.c_[np.cos(angles), np.sin(angles)] * radii[:, None])
+
+    roads = []
+
+    # jittered grid with a few missing streets in the central third
+    core = side / 3
+    lines = np.arange(-core / 2, core / 2, grid_spacing)
+    for offset in lines[rng.random(len(lines)) > 0.1]:
+        t = np.linspace(-core / 2, core / 2, 10)
+        jitter = rng.normal(0, grid_spacing / 20, len(t))
+        roads.append(shapely.LineString(center + np.c_[offset + jitter, t]))
+        roads.append(shapely.LineString(center + np.c_[t, offset + jitter]))
+
+    # organic streets with a constant density, so that the number of blocks grows with the area
+    n_streets = int(25 * size_km ** 2)
+    starts = rng.uniform([x0, y0], [x0 + side, y0 + side], (n_streets, 2))
+    for start in starts:
+        roads.append(shapely.LineString(_random_walk(rng, start, 25, grid_spacing / 2, 0.25)))
+
+    # ring road and radial arterials
+    roads.append(shapely.Point(center).buffer(side / 3, quad_segs=32).exterior)
+    for angle in np.linspace(0, 2 * np.pi, 8, endpoint=False):
+        roads.append(shapely.LineString([center, center + np.array([np.cos(angle), np.sin(angle)]) * side / 2]))
+
+    # river across the city and lakes
+    t = np.linspace(x0, x0 + side, 50)
+    river = shapely.LineString(np.c_[t, center[1] + side / 10 * np.sin(t / side * 3 * np.pi) + side / 6]).buffer(40)
+    lakes = [shapely.Point(center + rng.normal(0, side / 4, 2)).buffer(rng.uniform(100, 300))
+             for _ in range(max(int(size_km / 2), 1))]
+    water = [river] + lakes
+
+    railways = [shapely.LineString([(x0, y0 + side * 0.2), (x0 + side, y0 + side * 0.7)])]
+
+    # services: uniform and clustered (Thomas process)
+    n_services = int(services_per_km2 * shapely.area(territory) / 1e6)
+    n_uniform = n_services // 2
+    n_parents = max((n_services - n_uniform) // 40, 1)
+    parents = center + rng.normal(0, side / 6, (n_parents, 2))
+    points = np.vstack([
+        rng.uniform([x0, y0], [x0 + side, y0 + side], (n_uniform, 2)),
+        parents[rng.integers(0, n_parents, n_services - n_uniform)] + rng.normal(0, 150, (n_services - n_uniform, 2))])
+    points = shapely.points(points)
+    points = points[shapely.contains_xy(territory, shapely.get_coordinates(points)[:, 0], shapely.get_coordinates(points)[:, 1])]
+
+    tag_pool = {category: sorted({tag for values in service_tags[category].dropna() for tag in values})
+                for category in service_tags.columns}
+    categories = rng.choice(list(tag_pool), len(points))
+    tags = [[rng.choice(tag_pool[category])] for category in categories]
+
+    def to_4326(geometry):
+        return gpd.GeoSeries(geometry, crs=LOCAL_CRS).to_crs(4326)
+
+    services = gpd.GeoDataFrame({
+        "name": [f"service {i}" for i in range(len(points))],
+        "tags": tags,
+        "category": categories,
+        "geometry": to_4326(points).values}, crs=4326)
+
+    return {
+        "territory": gpd.GeoDataFrame(geometry=to_4326([territory]), crs=4326),
+        "roads": gpd.GeoDataFrame(geometry=to_4326(roads), crs=4326),
+        "railways": gpd.GeoDataFrame(geometry=to_4326(railways), crs=4326),
+        "water": gpd.GeoDataFrame(geometry=to_4326(water), crs=4326),
+        "services": services}
+
+
+def write_population_raster(path, territory, resolution=100, seed=0):
+    """
+    Writes a GHS-POP-like population GeoTIFF (ESRI:54009, 100 m cells) covering a territory:
+    density decaying from the center with noise and empty cells.
+    """
+
+    rng = np.random.default_rng(seed)
+    xmin, ymin, xmax, ymax = territory.to_crs("ESRI:54009").total_bounds
+    xmin, ymin = np.floor([xmin - resolution, ymin - resolution])
+    width = int(np.ceil((xmax - xmin) / resolution)) + 2
+    height = int(np.ceil((ymax - ymin) / resolution)) + 2
+
+    x = (np.arange(width) - width / 2) / width
+    y = (np.arange(height) - height / 2) / height
+    distance = np.sqrt(x[None, :] ** 2 + y[:, None] ** 2)
+    population = 200 * np.exp(-distance * 6) * rng.lognormal(0, 0.5, (height, width))
+    population[rng.random((height, width)) < 0.1] = 0
+
+    with rasterio.open(
+            path, "w", driver="GTiff", height=height, width=width, count=1, dtype="float32",
+            crs="ESRI:54009", transform=from_origin(xmin, ymin + height * resolution, resolution, resolution),
+            nodata=-200) as dst:
+        dst.write(population.astype("float32"), 1)
+
+
+def run_pipeline(city, raster_path, params):
+    """
+    Runs all stages with keyword arguments of the CityModel methods by stage name,
+    the same as `batch_city_aggregator.process_city`, and returns their instrumentation records.
+    """
+
+    instrumentation.get_records()
+
+    model = CityModel(city["territory"], city["roads"], city["railways"], city["water"], verbose=False)
+    model.generate_blocks(**params.get("generate_blocks", {}))
+    model.set_services(city["services"])
+    model.cluster_blocks(**params.get("cluster_blocks", {}))
+    model.evaluate_centrality(**params.get("evaluate_centrality", {}))
+    model.populate_blocks(population_raster_path=raster_path, **params.get("populate_blocks", {}))
+    model.aggregate_cluster_info(**params.get("aggregate_cluster_info", {}))
+
+    records = pd.DataFrame(instrumentation.get_records())
+    records = records[records["parent"].isna()]
+    records["stage"] = records["stage"].str.rsplit(".", n=1).str[-1]
+
+    return model, records.set_index("stage")
+
+
+def get_scaling(results):
+    """
+    Returns the scaling exponent of every stage: the slope of a least squares fit
+    of log(time) over log(number of blocks).
+    """
+
+    blocks = np.log(results.groupby("size")["blocks"].first())
+    exponents = {}
+    for stage, times in results.groupby("stage"):
+        times = times.set_index("size")["wall_time"]
+        if len(times) > 1:
+            exponents[stage] = np.polyfit(blocks[times.index], np.log(times.clip(lower=1e-6)), 1)[0]
+
+    return pd.Series(exponents, name="exponent")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=float, nargs="+", default=[2, 4, 8, 16], help="city sides in km")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--configs", nargs="+", default=list(CONFIGS), choices=list(CONFIGS),
+                        help="configurations reported side by side")
+    parser.add_argument("--min-block-width", type=float, default=None)
+    parser.add_argument("--clustering-distance", type=float, default=None,
+                        help="overrides the default of cluster_blocks in all configurations")
+    parser.add_argument("--output", default=None, help="CSV file for all timings")
+    args = parser.parse_args()
+
+    warnings.filterwarnings("ignore")
+    instrumentation.configure(enabled=True, track_memory=True)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            city = make_city(size, seed=args.seed)
+            raster_path = os.path.join(tmp, f"population_{size}.tif")
+            write_population_raster(raster_path, city["territory"], seed=args.seed)
+
+            for config in args.configs:
+                params = {stage: dict(kwargs) for stage, kwargs in CONFIGS[config].items()}
+                if args.min_block_width is not None:
+                    params.setdefault("generate_blocks", {})["min_block_width"] = args.min_block_width
+                if args.clustering_distance is not None:
+                    params.setdefault("cluster_blocks", {})["clustering_distance"] = args.clustering_distance
+
+                model, records = run_pipeline(city, raster_path, params)
+                print(f"{size:g} km, {config}: {len(model.blocks)} blocks, {len(model.services)} services, "
+                      f"{len(model.cluster_info)} clusters, {records['wall_time'].sum():.2f} s")
+
+                for stage in STAGES:
+                    results.append({
+                        "config": config,
+                        "size": size,
+                        "blocks": len(model.blocks),
+                        "services": len(model.services),
+                        "stage": stage,
+                        "wall_time": records.loc[stage, "wall_time"],
+                        "cpu_time": records.loc[stage, "cpu_time"],
+                        "peak_rss": records.loc[stage, "peak_rss"]})
+
+    results = pd.DataFrame(results)
+    if args.output:
+        results.to_csv(args.output, index=False)
+
+    tables = []
+    for config, config_results in results.groupby("config", sort=False):
+        table = config_results.pivot(index="stage", columns="size", values="wall_time").loc[STAGES]
+        table.columns = [f"{size:g} km, s" for size in table.columns]
+        table = table.join(get_scaling(config_results))
+        tables.append(table)
+
+    with pd.option_context("display.width", 250, "display.max_columns", None, "display.float_format", "{:.3f}".format):
+        print(pd.concat(tables, axis=1, keys=results["config"].unique()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# modules of the toolkit import each other by their flat names
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "urban_scaling_toolkit"))
+sys.path.insert(0, os.path.dirname(__file__))
@@ -0,0 +1,160 @@
+import contextlib
+import threading
+import time
+
+import geopandas as gpd
+import numpy as np
+import osmnx as ox
+import pandas as pd
+import shapely
+from osmnx.features import InsufficientResponseError
+
+
+class OverpassTimeout(Exception):
+    pass
+
+
+class MockOverpass:
+    """
+    Local stand-in for `ox.features_from_polygon` serving features from a GeoDataFrame,
+    for tests of fetching logic without network access.
+
+    Attributes
+    ----------
+    features: gpd.GeoDataFrame
+        Features (EPSG:4326) with OSM tags in columns. The index is used as the feature ID,
+        like the (element_type, osmid) index of osmnx.
+
+    max_features: int or None
+        Requests matching more features fail with `OverpassTimeout`, like dense cells on a real server.
+
+    fail_rate: float
+        Share of requests failing with `OverpassTimeout` at random.
+
+    latency: float
+        Delay of every request in seconds.
+
+    seed: int
+        Seed of random failures.
+    """
+
+    def __init__(self, features, max_features=None, fail_rate=0, latency=0, seed=0):
+
+        self.features = features
+        self.max_features = max_features
+        self.fail_rate = fail_rate
+        self.latency = latency
+
+        self.tree = shapely.STRtree(features.geometry.values)
+        self.random = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+
+        self.requests = 0
+        self.failures = 0
+        self.active = 0
+        self.max_active = 0
+
+    def _match_tags(self, features, tags):
+
+        mask = np.zeros(len(features), dtype=bool)
+        for key, values in tags.items():
+            if key not in features:
+                continue
+            if values is True:
+                mask |= features[key].notna().to_numpy()
+            else:
+                values = [values] if isinstance(values, str) else values
+                mask |= features[key].isin(values).to_numpy()
+
+        return features[mask]
+
+    def __call__(self, polygon, tags):
+
+        with self.lock:
+            self.requests += 1
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            failed = self.random.random() < self.fail_rate
+
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+
+            idx = self.tree.query(polygon, predicate='intersects')
+            res = self._match_tags(self.features.iloc[np.sort(idx)], tags)
+
+            if failed or (self.max_features is not None and len(res) > self.max_features):
+                with self.lock:
+                    self.failures += 1
+                raise OverpassTimeout("Mock Overpass request timed out")
+
+            if len(res) == 0:
+                raise InsufficientResponseError("No matching features")
+
+            return res.copy()
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+@contextlib.contextmanager
+def patch(mock):
+    """
+    Replaces `ox.features_from_polygon` with a mock, e.g. to run `data_fetcher` functions offline.
+    """
+
+    features_from_polygon = ox.features_from_polygon
+    ox.features_from_polygon = mock
+    try:
+        yield mock
+    finally:
+        ox.features_from_polygon = features_from_polygon
+
+
+def make_features(n=10000, bounds=(0, 0, 0.1, 0.1), tags=None, seed=0):
+    """
+    Generates random points and short lines with random tags.
+
+    Attributes
+    ----------
+    n: int
+        Number of features.
+
+    bounds: tuple
+        Extent of features (EPSG:4326).
+
+    tags: dict or None
+        Key -> list of values to draw from. Defaults to a few amenities and highways.
+
+    Returns
+    -------
+    features: gpd.GeoDataFrame
+        Features indexed by (element_type, osmid).
+    """
+
+    if tags is None:
+        tags = {"amenity": ["cafe", "school", "library"], "highway": ["primary", "residential"]}
+
+    rng = np.random.default_rng(seed)
+    xmin, ymin, xmax, ymax = bounds
+    coords = rng.uniform([xmin, ymin], [xmax, ymax], size=(n, 2))
+
+    is_line = rng.random(n) < 0.5
+    offsets = rng.normal(scale=(xmax - xmin) / 50, size=(n, 2))
+    geometry = np.where(
+        is_line,
+        shapely.linestrings(np.stack([coords, coords + offsets], axis=1)),
+        shapely.points(coords))
+
+    keys = list(tags)
+    key_idx = rng.integers(0, len(keys), n)
+    columns = {key: pd.Series([None] * n, dtype=object) for key in keys}
+    for i, key in enumerate(keys):
+        mask = key_idx == i
+        columns[key][mask] = np.array(tags[key], dtype=object)[rng.integers(0, len(tags[key]), mask.sum())]
+
+    index = pd.MultiIndex.from_arrays(
+        [np.where(is_line, 'way', 'node'), np.arange(n)], names=['element_type', 'osmid'])
+
+    return gpd.GeoDataFrame(
+        {key: column.to_numpy() for key, column in columns.items()}, geometry=geometry, index=index, crs=4326)
@@ -0,0 +1,79 @@
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from city_model import CityModel
+from data_fetcher import service_tags
+
+# cities are drawn in UTM meters around this point and returned in EPSG:4326
+LOCAL_CRS = 32632
+ORIGIN = (500000, 5000000)
+
+
+def make_city(size=2000, grid_spacing=150, n_services=400, seed=0):
+    """
+    Generates a small city for tests: a jittered street grid, organic streets,
+    a river, a lake, a railway and services with tags.
+
+    Attributes
+    ----------
+    size: float
+        Side of the square the city is drawn in, in meters.
+
+    Returns
+    -------
+    city: dict
+        `territory`, `roads`, `railways`, `water` and `services` in EPSG:4326,
+        in the formats of `data_fetcher`.
+    """
+
+    rng = np.random.default_rng(seed)
+    x0, y0 = ORIGIN
+    center = np.array([x0 + size / 2, y0 + size / 2])
+
+    angles = np.linspace(0, 2 * np.pi, 48, endpoint=False)
+    radii = size / 2 * (0.85 + 0.15 * rng.random(len(angles)))
+    territory = shapely.Polygon(center + np.c_[np.cos(angles), np.sin(angles)] * radii[:, None])
+
+    roads = []
+    t = np.linspace(0, size, 12)
+    for offset in np.arange(grid_spacing / 2, size, grid_spacing):
+        roads.append(shapely.LineString(np.c_[x0 + offset + rng.normal(0, grid_spacing / 20, len(t)), y0 + t]))
+        roads.append(shapely.LineString(np.c_[x0 + t, y0 + offset + rng.normal(0, grid_spacing / 20, len(t))]))
+    for start in rng.uniform([x0, y0], [x0 + size, y0 + size], (10, 2)):
+        steps = np.c_[np.cos(rng.normal(0, 1, 20).cumsum()), np.sin(rng.normal(0, 1, 20).cumsum())] * grid_spacing / 3
+        roads.append(shapely.LineString(np.vstack([start, start + steps.cumsum(axis=0)])))
+
+    river = shapely.LineString(np.c_[x0 + t, center[1] + size / 10 * np.sin(t / size * 3 * np.pi)]).buffer(20)
+    lake = shapely.Point(center + size / 5).buffer(size / 15)
+    railways = [shapely.LineString([(x0, y0 + size * 0.2), (x0 + size, y0 + size * 0.7)])]
+
+    points = shapely.points(np.vstack([
+        rng.uniform([x0, y0], [x0 + size, y0 + size], (n_services // 2, 2)),
+        center + rng.normal(0, size / 8, (n_services - n_services // 2, 2))]))
+    points = points[shapely.contains(territory, points)]
+    categories = rng.choice(list(service_tags.columns), len(points))
+    tags = [[rng.choice(sorted({tag for values in service_tags[category].dropna() for tag in values}))]
+            for category in categories]
+
+    def to_4326(geometry):
+        return gpd.GeoSeries(geometry, crs=LOCAL_CRS).to_crs(4326)
+
+    return {
+        "territory": gpd.GeoDataFrame(geometry=to_4326([territory]), crs=4326),
+        "roads": gpd.GeoDataFrame(geometry=to_4326(roads), crs=4326),
+        "railways": gpd.GeoDataFrame(geometry=to_4326(railways), crs=4326),
+        "water": gpd.GeoDataFrame(geometry=to_4326([river, lake]), crs=4326),
+        "services": gpd.GeoDataFrame({
+            "name": [f"service {i}" for i in range(len(points))],
+            "tags": tags,
+            "category": categories,
+            "geometry": to_4326(points).values}, crs=4326)}
+
+
+def make_model(city):
+    """
+    Returns a CityModel of a city generated by `make_city`.
+    """
+
+    return CityModel(city["territory"], city["roads"], city["railways"], city["water"], verbose=False)
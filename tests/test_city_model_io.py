@@ -0,0 +1,143 @@
+import json
+import os
+import pickle
+
+import geopandas as gpd
+import pandas as pd
+import pytest
+from geopandas.testing import assert_geodataframe_equal, assert_geoseries_equal
+
+import city_model
+from city_model import CityModel, read_layer
+from synthetic_city import make_city, make_model
+
+LAYERS = ["blocks", "services", "cluster_polygons", "cluster_info"]
+
+
+@pytest.fixture(scope="module")
+def model():
+    city = make_city()
+    model = make_model(city)
+    model.generate_blocks()
+    model.set_services(city["services"])
+    model.cluster_blocks(engine="sparse")
+    model.evaluate_centrality()
+    model.blocks["population"] = (model.blocks["area"] / 100).round().astype(int)
+    model.aggregate_cluster_info()
+    return model
+
+
+def assert_models_equal(res, expected):
+    assert res.territory.equals(expected.territory)
+    for layer in city_model.SERIES_LAYERS:
+        assert_geoseries_equal(getattr(res, layer), getattr(expected, layer))
+    for layer in LAYERS:
+        assert_geodataframe_equal(getattr(res, layer), getattr(expected, layer))
+    assert res.local_crs == expected.local_crs
+
+
+def test_round_trip(model, tmp_path):
+    model.save(tmp_path)
+    res = CityModel.load(tmp_path)
+
+    assert_models_equal(res, model)
+    # lists are read back as lists, not arrays
+    assert res.services["tags"].tolist() == model.services["tags"].tolist()
+    assert res.cluster_info["top_tags"].tolist() == model.cluster_info["top_tags"].tolist()
+    assert all(isinstance(tags, list) for tags in res.cluster_info["top_tags"])
+
+
+def test_missing_lists_and_layers(tmp_path):
+    city = make_city(n_services=20)
+    city["services"].loc[[1, 3], "tags"] = None
+    model = make_model(city)
+    model.generate_blocks()
+    model.set_services(city["services"])
+
+    model.save(tmp_path)
+
+    assert read_layer(tmp_path, "cluster_polygons") is None
+    res = CityModel.load(tmp_path)
+    assert res.cluster_polygons is None and res.cluster_info is None
+    # missing lists are read back as NaN
+    assert res.services["tags"].isna().any()
+    assert [tags if isinstance(tags, list) else None for tags in res.services["tags"]] == [
+        tags if isinstance(tags, list) else None for tags in model.services["tags"]]
+
+
+def test_lazy_load(model, tmp_path):
+    model.save(tmp_path)
+    res = CityModel.load(tmp_path, lazy=True)
+
+    # layers are read on first access only
+    assert "_blocks" not in res.__dict__ and "services" not in res.__dict__
+    assert_geodataframe_equal(res.blocks, model.blocks)
+    assert "_blocks" in res.__dict__ and "services" not in res.__dict__
+
+    assert_models_equal(res, model)
+
+    with pytest.raises(AttributeError):
+        res.unknown_layer
+
+
+def test_read_layer_columns(model, tmp_path):
+    model.save(tmp_path)
+
+    res = read_layer(tmp_path, "blocks", ["block_id", "cluster_id"])
+    assert type(res) is pd.DataFrame
+    pd.testing.assert_frame_equal(res, pd.DataFrame(model.blocks[["block_id", "cluster_id"]]))
+
+    res = read_layer(tmp_path, "cluster_info", ["cluster_id", "top_tags"])
+    assert res["top_tags"].tolist() == model.cluster_info["top_tags"].tolist()
+
+    assert isinstance(read_layer(tmp_path, "blocks", ["block_id", "geometry"]), gpd.GeoDataFrame)
+
+
+def test_interrupted_save_is_not_loaded(model, tmp_path, monkeypatch):
+    model.save(tmp_path)
+
+    # a new save stops after some layers were overwritten
+    to_parquet = gpd.GeoDataFrame.to_parquet
+
+    def fail_on_services(self, path, *args, **kwargs):
+        if os.path.basename(path) == "services.parquet":
+            raise OSError("disk full")
+        return to_parquet(self, path, *args, **kwargs)
+
+    monkeypatch.setattr(gpd.GeoDataFrame, "to_parquet", fail_on_services)
+    with pytest.raises(OSError):
+        model.save(tmp_path)
+
+    with pytest.raises(FileNotFoundError):
+        CityModel.load(tmp_path)
+    with pytest.raises(FileNotFoundError):
+        read_layer(tmp_path, "blocks")
+
+
+def test_newer_format_is_not_loaded(model, tmp_path):
+    model.save(tmp_path)
+
+    manifest_path = os.path.join(tmp_path, city_model.MANIFEST_FILE)
+    with open(manifest_path) as fp:
+        manifest = json.load(fp)
+    manifest["format_version"] = city_model.FORMAT_VERSION + 1
+    with open(manifest_path, "w") as fp:
+        json.dump(manifest, fp)
+
+    with pytest.raises(ValueError):
+        CityModel.load(tmp_path)
+
+
+def test_pickle_lazy_model(model, tmp_path):
+    model.save(tmp_path)
+    res = CityModel.load(tmp_path, lazy=True)
+    res.blocks
+
+    # layers not read yet are read by the unpickled copy
+    res = pickle.loads(pickle.dumps(res))
+    assert "services" not in res.__dict__
+    assert_models_equal(res, model)
+
+    # links to blocks are rebuilt after unpickling
+    res._link_services_to_blocks()
+    assert res.services["block_id"].equals(model.services["block_id"])
@@ -0,0 +1,52 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+import shapely
+from scipy.cluster.hierarchy import fcluster, linkage
+from sklearn.metrics import adjusted_rand_score
+
+import clusterizer
+
+
+def make_services(n, side=5000, seed=0):
+    """
+    Uniform and clustered points in a projected CRS, with a share of coincident points.
+    """
+
+    rng = np.random.default_rng(seed)
+    parents = rng.uniform(0, side, (max(n // 40, 1), 2))
+    coords = np.vstack([
+        rng.uniform(0, side, (n // 2, 2)),
+        parents[rng.integers(0, len(parents), n - n // 2)] + rng.normal(0, 150, (n - n // 2, 2))])
+    coords[:n // 20] = coords[n // 20:2 * (n // 20)]
+
+    return gpd.GeoDataFrame(geometry=shapely.points(coords), crs=32632)
+
+
+@pytest.mark.parametrize("link", ["single", "average", "complete"])
+@pytest.mark.parametrize("distance_limit", [300, 1200])
+def test_sparse_clusters_match_full_linkage(link, distance_limit):
+    services = make_services(2000, seed=distance_limit)
+    coords = shapely.get_coordinates(services.geometry.values)
+
+    labels = clusterizer.get_sparse_clusters(services, distance_limit=distance_limit, link=link)
+    expected = fcluster(linkage(coords, method=link), t=distance_limit, criterion="distance")
+
+    assert adjusted_rand_score(expected, labels) == 1
+    np.testing.assert_array_equal(np.unique(labels), np.arange(len(np.unique(expected))))
+
+
+@pytest.mark.parametrize("link", ["single", "average", "complete"])
+def test_sparse_clusters_of_degenerate_inputs(link):
+    # points on a line cannot be triangulated
+    line = gpd.GeoDataFrame(geometry=shapely.points(np.c_[[0, 100, 200, 1000, 1100], np.zeros(5)]), crs=32632)
+    assert adjusted_rand_score([0, 0, 0, 1, 1], clusterizer.get_sparse_clusters(line, 500, link)) == 1
+
+    single = line.iloc[:1]
+    np.testing.assert_array_equal(clusterizer.get_sparse_clusters(single, 500, link), [0])
+    np.testing.assert_array_equal(clusterizer.get_sparse_clusters(line.iloc[:0], 500, link), [])
+
+
+def test_sparse_clusters_reject_ward():
+    with pytest.raises(ValueError):
+        clusterizer.get_sparse_clusters(make_services(10), link="ward")
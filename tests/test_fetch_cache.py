@@ -0,0 +1,119 @@
+import os
+import time
+
+import geopandas as gpd
+import pytest
+import shapely
+from geopandas.testing import assert_geodataframe_equal
+
+import data_fetcher
+import fetch_cache
+import mock_overpass
+from mock_overpass import MockOverpass, make_features
+
+BOUNDS = (0, 0, 0.1, 0.1)
+TERRITORY = shapely.box(*BOUNDS)
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    # settings of the module are restored after every test
+    for name in ["CACHE_DIR", "TTL", "MAX_SIZE"]:
+        monkeypatch.setattr(fetch_cache, name, getattr(fetch_cache, name))
+    fetch_cache.configure(str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def overpass():
+    with mock_overpass.patch(MockOverpass(make_features(n=500, bounds=BOUNDS, seed=2))) as mock:
+        yield mock
+
+
+def make_roads(n=3):
+    return gpd.GeoDataFrame(geometry=[shapely.LineString([(0, i / 100), (0.1, i / 100)]) for i in range(n)], crs=4326)
+
+
+def make_services():
+    return gpd.GeoDataFrame({
+        "name": ["school 1", None],
+        "tags": [["school"], ["cafe", "bar"]],
+        "category": ["education", "food"],
+        "geometry": [shapely.Point(0.01, 0.01), shapely.Point(0.02, 0.02)]}, crs=4326)
+
+
+def test_stored_results_are_served_without_overpass(cache_dir, overpass):
+    roads, services = make_roads(), make_services()
+    fetch_cache.store(data_fetcher.fetch_roads, roads, TERRITORY)
+    fetch_cache.store(data_fetcher.fetch_services, services, TERRITORY)
+
+    assert_geodataframe_equal(data_fetcher.fetch_roads(TERRITORY), roads)
+    # territories are matched by geometry and `verbose` does not change the key
+    res = data_fetcher.fetch_services(gpd.GeoDataFrame(geometry=[TERRITORY], crs=4326), verbose=False)
+    assert_geodataframe_equal(res, services)
+    assert res["tags"].tolist() == [["school"], ["cafe", "bar"]]
+
+    assert overpass.requests == 0
+
+
+def test_other_parameters_are_not_served(cache_dir, overpass):
+    fetch_cache.store(data_fetcher.fetch_roads, make_roads(), TERRITORY)
+
+    data_fetcher.fetch_roads(TERRITORY, tags={"highway": ["primary"]})
+    data_fetcher.fetch_roads(shapely.box(0, 0, 0.05, 0.05))
+
+    assert overpass.requests == 2
+
+
+def test_fetched_results_are_cached(cache_dir, overpass):
+    res = data_fetcher.fetch_roads(TERRITORY)
+    assert overpass.requests == 1
+    assert len(res) > 0
+
+    assert_geodataframe_equal(data_fetcher.fetch_roads(TERRITORY), res)
+    assert overpass.requests == 1
+
+
+def test_expired_results_are_refetched(cache_dir, overpass):
+    fetch_cache.configure(str(cache_dir), ttl=60)
+    fetch_cache.store(data_fetcher.fetch_roads, make_roads(), TERRITORY)
+    key = fetch_cache.get_cache_key(data_fetcher.fetch_roads, TERRITORY)
+    path = os.path.join(cache_dir, f"{key}.parquet")
+
+    past = time.time() - 120
+    os.utime(path, (past, past))
+
+    assert fetch_cache.load(key) is None
+    assert not os.path.exists(path)
+
+    data_fetcher.fetch_roads(TERRITORY)
+    assert overpass.requests == 1
+
+
+def test_evict_removes_expired_then_least_recently_used(cache_dir):
+    fetch_cache.configure(str(cache_dir), ttl=3600)
+    territories = [shapely.box(0, 0, size, size) for size in [0.01, 0.02, 0.03, 0.04]]
+    paths = []
+    for territory in territories:
+        fetch_cache.store(data_fetcher.fetch_roads, make_roads(), territory)
+        key = fetch_cache.get_cache_key(data_fetcher.fetch_roads, territory)
+        paths.append(os.path.join(cache_dir, f"{key}.parquet"))
+
+    # the first file is expired, the second one was used last and the third one first
+    now = time.time()
+    for path, (accessed, modified) in zip(paths, [(now, now - 7200), (now - 10, now - 100),
+                                                  (now - 30, now - 100), (now - 20, now - 100)]):
+        os.utime(path, (accessed, modified))
+
+    size = os.path.getsize(paths[1])
+    fetch_cache.configure(str(cache_dir), max_size=2 * size)
+    fetch_cache.evict()
+
+    assert [os.path.exists(path) for path in paths] == [False, True, False, True]
+
+    # reading a file makes it the most recently used
+    fetch_cache.load(fetch_cache.get_cache_key(data_fetcher.fetch_roads, territories[3]))
+    fetch_cache.configure(str(cache_dir), max_size=size)
+    fetch_cache.evict()
+
+    assert [os.path.exists(path) for path in paths] == [False, False, False, True]
@@ -0,0 +1,136 @@
+import numpy as np
+import pytest
+import shapely
+
+import data_fetcher
+from mock_overpass import MockOverpass, OverpassTimeout, make_features
+
+BOUNDS = (0, 0, 0.1, 0.1)
+TAGS = {"amenity": True}
+
+
+@pytest.fixture
+def features():
+    return make_features(n=3000, bounds=BOUNDS, seed=1)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+    monkeypatch.setattr(data_fetcher.time, "sleep", delays.append)
+    return delays
+
+
+def expected_index(features, territory=shapely.box(*BOUNDS)):
+    matching = features[features["amenity"].notna()]
+    return set(matching.index[shapely.intersects(matching.geometry.values, territory)])
+
+
+class Recorder:
+    """
+    Wraps a fetch function and records requested cells and whether they succeeded.
+    """
+
+    def __init__(self, fetch):
+        self.fetch = fetch
+        self.calls = []
+
+    def __call__(self, polygon, tags):
+        try:
+            res = self.fetch(polygon, tags)
+        except OverpassTimeout:
+            self.calls.append((polygon, False))
+            raise
+        self.calls.append((polygon, True))
+        return res
+
+
+class Flaky:
+    """
+    Fails the first `n_failures` requests of every cell.
+    """
+
+    def __init__(self, fetch, n_failures):
+        self.fetch = fetch
+        self.n_failures = n_failures
+        self.attempts = {}
+
+    def __call__(self, polygon, tags):
+        key = shapely.to_wkb(shapely.normalize(polygon))
+        self.attempts[key] = self.attempts.get(key, 0) + 1
+        if self.attempts[key] <= self.n_failures:
+            raise OverpassTimeout("Flaky request")
+        return self.fetch(polygon, tags)
+
+
+def test_features_crossing_cells_are_returned_once(features, sleeps):
+    mock = MockOverpass(features)
+
+    res = data_fetcher.fetch_long_query(
+        shapely.box(*BOUNDS), TAGS, subdivision=4, verbose=False, fetch=mock)
+
+    assert res.index.is_unique
+    assert set(res.index) == expected_index(features)
+    assert mock.requests == 16
+    assert sleeps == []
+
+
+def test_failed_requests_are_retried_with_backoff(features, sleeps):
+    fetch = Flaky(MockOverpass(features), n_failures=2)
+
+    # no splits are allowed, so every cell must succeed on its last retry
+    res = data_fetcher.fetch_long_query(
+        shapely.box(*BOUNDS), TAGS, subdivision=2, verbose=False, max_retries=2, backoff=0.5,
+        max_depth=0, fetch=fetch)
+
+    assert set(res.index) == expected_index(features)
+    assert sorted(fetch.attempts.values()) == [3, 3, 3, 3]
+    assert sorted(sleeps) == [0.5] * 4 + [1.0] * 4
+
+
+def test_cells_over_budget_are_split_into_four(features, sleeps):
+    fetch = Recorder(MockOverpass(features, max_features=100))
+
+    res = data_fetcher.fetch_long_query(
+        shapely.box(*BOUNDS), TAGS, subdivision=2, verbose=False, max_retries=0, max_depth=4, fetch=fetch)
+
+    assert res.index.is_unique
+    assert set(res.index) == expected_index(features)
+
+    failed = [polygon for polygon, ok in fetch.calls if not ok]
+    assert len(failed) > 0
+    assert len(fetch.calls) == 4 + 4 * len(failed)
+
+    # every failed cell is covered exactly by four requested subcells
+    requested = [polygon for polygon, _ in fetch.calls]
+    for cell in failed:
+        subcells = [polygon for polygon in requested
+                    if polygon.area < cell.area and shapely.contains_properly(cell.buffer(1e-12), polygon)]
+        subcells = [polygon for polygon in subcells if np.isclose(polygon.area, cell.area / 4)]
+        assert len(subcells) == 4
+        assert np.isclose(shapely.union_all(subcells).area, cell.area)
+
+
+def test_cell_failing_at_max_depth_raises(features, sleeps):
+    fetch = Recorder(MockOverpass(features, fail_rate=1))
+
+    with pytest.raises(RuntimeError):
+        data_fetcher.fetch_long_query(
+            shapely.box(*BOUNDS), TAGS, subdivision=1, verbose=False, max_retries=0, max_depth=1,
+            max_workers=1, fetch=fetch)
+
+    # the initial cell fails, then the first of its four subcells raises and the rest are cancelled
+    assert not fetch.calls[0][1]
+    assert np.isclose(fetch.calls[0][0].area, shapely.box(*BOUNDS).area)
+    assert 2 <= len(fetch.calls) <= 5
+    assert all(np.isclose(polygon.area, shapely.box(*BOUNDS).area / 4) for polygon, _ in fetch.calls[1:])
+
+
+def test_cell_over_feature_budget_at_max_depth_is_kept(features, sleeps):
+    mock = MockOverpass(features)
+
+    res = data_fetcher.fetch_long_query(
+        shapely.box(*BOUNDS), TAGS, subdivision=1, verbose=False, max_features=10, max_depth=1, fetch=mock)
+
+    assert set(res.index) == expected_index(features)
+    assert mock.requests == 5
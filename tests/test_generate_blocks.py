@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+import shapely
+
+from synthetic_city import make_city, make_model
+
+# blocks of both engines differ by rounding of vertices noded in different tiles
+TOLERANCE = 1e-8
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_tiled_blocks_match_union_blocks(seed):
+    city = make_city(seed=seed)
+
+    union = make_model(city)
+    union.generate_blocks(engine="union")
+    tiled = make_model(city)
+    # tiles of about 300 m put many blocks on seams
+    tiled.generate_blocks(engine="tiled", tile_size=300)
+
+    assert len(tiled.blocks) == len(union.blocks)
+
+    # every union block contains the representative point of exactly one tiled block and the other way around
+    union_idx, tiled_idx = shapely.STRtree(tiled.blocks.geometry.values).query(
+        shapely.point_on_surface(union.blocks.geometry.values), predicate="within")
+    assert len(np.unique(union_idx)) == len(union_idx) == len(union.blocks)
+    assert len(np.unique(tiled_idx)) == len(tiled.blocks)
+
+    a = union.blocks.geometry.values[union_idx]
+    b = tiled.blocks.geometry.values[tiled_idx]
+    assert (shapely.area(shapely.symmetric_difference(a, b)) / shapely.area(a)).max() < TOLERANCE
+    np.testing.assert_allclose(
+        tiled.blocks["area"].values[tiled_idx], union.blocks["area"].values[union_idx], rtol=TOLERANCE)
+
+
+def test_tiled_blocks_cross_seams():
+    city = make_city()
+    tiled = make_model(city)
+    # tiles are smaller than the 150 m street grid
+    tiled.generate_blocks(engine="tiled", tile_size=100)
+
+    # blocks are not cut by tile seams, so many of them are wider than a tile
+    bounds = tiled._project("blocks", tiled.blocks).bounds
+    assert ((bounds["maxx"] - bounds["minx"]) > 100).mean() > 0.5
@@ -0,0 +1,49 @@
+import geopandas as gpd
+
+from synthetic_city import make_city, make_model
+
+
+def get_links(services, blocks, crs):
+    """
+    Service names and block ids linked by a full nearest join within 200 meters.
+    """
+
+    joined = gpd.sjoin_nearest(
+        services[["name", "geometry"]].to_crs(crs), blocks[["block_id", "geometry"]].to_crs(crs), max_distance=200)
+    return sorted(zip(joined["name"], joined["block_id"]))
+
+
+def test_reused_links_match_full_relink():
+    city = make_city()
+    model = make_model(city)
+    model.generate_blocks()
+    model.set_services(city["services"])
+
+    assert sorted(zip(model.services["name"], model.services["block_id"])) == get_links(
+        city["services"], model.blocks, model.local_crs)
+
+    # clustering sets columns of blocks only, services keep their links and get clusters of their blocks
+    tree = model._get_blocks_tree()
+    model.cluster_blocks(engine="sparse")
+    assert model._get_blocks_tree() is tree
+
+    assert sorted(zip(model.services["name"], model.services["block_id"])) == get_links(
+        city["services"], model.blocks, model.local_crs)
+    cluster_ids = model.blocks.set_index("block_id")["cluster_id"]
+    assert model.services["cluster_id"].equals(model.services["block_id"].map(cluster_ids))
+    assert model.services["cluster_id"].notna().any()
+
+
+def test_reassigned_blocks_are_relinked():
+    city = make_city()
+    model = make_model(city)
+    model.generate_blocks()
+    model.set_services(city["services"])
+    services = model.services.copy()
+
+    # other blocks get other ids, so links cannot be reused
+    model.generate_blocks(min_block_width=20)
+    model._link_services_to_blocks(reuse_links=True)
+
+    assert sorted(zip(model.services["name"], model.services["block_id"])) == get_links(
+        services, model.blocks, model.local_crs)
@@ -0,0 +1,142 @@
+import geopandas as gpd
+import pandas as pd
+import pytest
+import shapely
+
+import data_fetcher
+import mock_overpass
+from mock_overpass import MockOverpass
+
+osmium = pytest.importorskip("osmium")
+
+import pbf_fetcher
+
+# two neighbouring territories, the first one has a road in common with the second one
+TERRITORIES = gpd.GeoDataFrame(
+    {"city_id": ["west", "east"]},
+    geometry=[shapely.box(10.0, 50.0, 10.01, 50.01), shapely.box(10.01, 50.0, 10.02, 50.01)], crs=4326)
+
+# (id, coordinates or members, tags) of every OSM object
+NODES = [
+    (1, (10.002, 50.002), {"amenity": "cafe", "name": "Cafe"}),
+    (2, (10.05, 50.05), {"amenity": "cafe", "name": "Far away"}),
+    (3, (10.015, 50.009), {"shop": "bakery", "amenity": "cafe", "name": "Bakery"}),
+]
+WAYS = [
+    (101, [(10.001, 50.005), (10.01, 50.0052), (10.019, 50.005)], {"highway": "residential", "name": "Main street"}),
+    (102, [(10.001, 50.007), (10.005, 50.007)], {"highway": "footway"}),
+    (103, [(10.001, 50.001), (10.009, 50.009)], {"railway": "rail"}),
+    (104, [(10.002, 50.001), (10.008, 50.003)], {"railway": "rail", "service": "siding"}),
+    (105, [(10.003, 50.003), (10.005, 50.003), (10.005, 50.004), (10.003, 50.004), (10.003, 50.003)],
+     {"amenity": "school", "name": "School"}),
+    (106, [(10.011, 50.001), (10.019, 50.009)], {"waterway": "river"}),
+    # rings of the lake have no tags, they are read only as members of the relation
+    (107, [(10.012, 50.002), (10.018, 50.002), (10.018, 50.007), (10.012, 50.007), (10.012, 50.002)], {}),
+    (108, [(10.014, 50.004), (10.016, 50.004), (10.016, 50.005), (10.014, 50.005), (10.014, 50.004)], {}),
+]
+RELATIONS = [
+    (201, [("w", 107, "outer"), ("w", 108, "inner")], {"type": "multipolygon", "natural": "water", "name": "Lake"}),
+]
+
+
+def write_osm(path):
+    """
+    Writes the objects to an OSM file, with a node for every way vertex.
+    """
+
+    node_ids = {}
+    nodes = [osmium.osm.mutable.Node(id=i, location=location, tags=tags) for i, location, tags in NODES]
+    ways = []
+    for i, coords, tags in WAYS:
+        for location in coords:
+            if location not in node_ids:
+                node_ids[location] = 1000 + len(node_ids)
+                nodes.append(osmium.osm.mutable.Node(id=node_ids[location], location=location))
+        ways.append(osmium.osm.mutable.Way(id=i, nodes=[node_ids[location] for location in coords], tags=tags))
+
+    writer = osmium.SimpleWriter(str(path))
+    for node in nodes:
+        writer.add_node(node)
+    for way in ways:
+        writer.add_way(way)
+    for i, members, tags in RELATIONS:
+        writer.add_relation(osmium.osm.mutable.Relation(id=i, members=members, tags=tags))
+    writer.close()
+
+
+def get_overpass_features():
+    """
+    The same objects as returned by `ox.features_from_polygon`, with polygons of closed ways and relations.
+    """
+
+    ways = {i: coords for i, coords, _ in WAYS}
+    lake = shapely.Polygon(ways[107], holes=[ways[108]])
+
+    rows = [("node", i, shapely.Point(location), tags) for i, location, tags in NODES]
+    rows += [("way", i, shapely.Polygon(coords) if coords[0] == coords[-1] else shapely.LineString(coords), tags)
+             for i, coords, tags in WAYS if tags]
+    rows += [("relation", 201, lake, RELATIONS[0][2])]
+
+    index = pd.MultiIndex.from_tuples([row[:2] for row in rows], names=["element_type", "osmid"])
+    return gpd.GeoDataFrame(
+        pd.DataFrame([row[3] for row in rows], index=index), geometry=[row[2] for row in rows], crs=4326)
+
+
+@pytest.fixture(scope="module")
+def pbf_layers(tmp_path_factory):
+    path = tmp_path_factory.mktemp("osm") / "city.osm.pbf"
+    write_osm(path)
+    return pbf_fetcher.fetch_from_pbf(str(path), TERRITORIES, verbose=False)
+
+
+def sort_geometries(gdf):
+    # rings of osmium and osmnx polygons are oriented differently
+    gdf = gdf.set_geometry(shapely.normalize(gdf.geometry.values))
+    return gdf.assign(wkt=shapely.to_wkt(gdf.geometry.values)).sort_values("wkt").drop(columns="wkt").reset_index(drop=True)
+
+
+def test_features_of_territories(pbf_layers):
+    west, east = pbf_layers["west"], pbf_layers["east"]
+
+    # the road crossing both territories is repeated, the footway is not a road
+    assert len(west["roads"]) == len(east["roads"]) == 1
+    # sidings are dropped
+    assert len(west["railways"]) == 1 and east["railways"] is None
+
+    # the lake is assembled from untagged member ways and keeps its hole
+    assert west["water"] is None
+    assert sorted(east["water"].geom_type) == ["LineString", "Polygon"]
+    lake = east["water"].geometry[east["water"].geom_type == "Polygon"].iloc[0]
+    assert len(lake.interiors) == 1
+
+    # the closed school way is read once, as the centroid of its area
+    assert sorted(zip(west["services"]["name"], west["services"]["category"])) == [
+        ("Cafe", "food"), ("School", "education")]
+    school = west["services"].geometry[west["services"]["name"] == "School"].iloc[0]
+    assert school.distance(shapely.Point(10.004, 50.0035)) < 1e-6
+
+    # a feature of several categories is repeated for each of them
+    assert sorted(east["services"]["category"]) == ["food", "shop"]
+
+
+@pytest.mark.parametrize("i", [0, 1])
+def test_same_formats_as_overpass(pbf_layers, i):
+    territory = TERRITORIES.geometry.iloc[i]
+    res = pbf_layers[TERRITORIES["city_id"].iloc[i]]
+
+    with mock_overpass.patch(MockOverpass(get_overpass_features())):
+        expected = {
+            "roads": data_fetcher.fetch_roads(territory),
+            "railways": data_fetcher.fetch_railways(territory),
+            "water": data_fetcher.fetch_water(territory),
+            "services": data_fetcher.fetch_services(territory, verbose=False)}
+
+    for layer in ["roads", "railways", "water", "services"]:
+        if expected[layer] is None or len(expected[layer]) == 0:
+            assert res[layer] is None or len(res[layer]) == 0
+            continue
+
+        assert list(res[layer].columns) == list(expected[layer].columns)
+        assert res[layer].crs == expected[layer].crs
+        pd.testing.assert_frame_equal(
+            sort_geometries(res[layer]).to_wkt(), sort_geometries(expected[layer]).to_wkt(), check_dtype=False)
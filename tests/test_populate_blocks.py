@@ -0,0 +1,106 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+import shapely
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+
+import raster_handler
+from synthetic_city import make_city, make_model
+
+RASTER_CRS = "ESRI:54009"
+RESOLUTION = 100
+
+
+@pytest.fixture
+def population_raster():
+    """
+    Returns a function writing a GHS-POP-like GeoTIFF in memory with its top left corner at (x, y)
+    in ESRI:54009: random values with empty and nodata cells. Returns its path.
+    """
+
+    files = []
+
+    def write(x, y, height=12, width=16, seed=0):
+        rng = np.random.default_rng(seed)
+        population = rng.uniform(0, 100, (height, width))
+        population[rng.random((height, width)) < 0.1] = 0
+        population[rng.random((height, width)) < 0.1] = -200
+
+        memfile = MemoryFile()
+        with memfile.open(driver="GTiff", height=height, width=width, count=1, dtype="float32", crs=RASTER_CRS,
+                          transform=from_origin(x, y, RESOLUTION, RESOLUTION), nodata=-200) as dst:
+            dst.write(population.astype("float32"), 1)
+        files.append(memfile)
+        return memfile.name
+
+    yield write
+
+    # rasters are opened once per process by their path
+    for memfile in files:
+        raster_handler._cached_rasters.pop(memfile.name, None)
+        memfile.close()
+
+
+def make_blocks(x, y):
+    """
+    Blocks around a raster with its top left corner at (x, y): crossing its edges,
+    smaller than one cell, on cell corners and outside of it.
+    """
+
+    blocks = [
+        shapely.box(x - 150, y - 350, x + 220, y - 120),
+        shapely.box(x + 900, y + 50, x + 1130, y - 260),
+        shapely.box(x + 310, y - 290, x + 340, y - 260),
+        shapely.box(x + 490, y - 510, x + 520, y - 480),
+        shapely.Point(x + 1000, y - 600).buffer(3),
+        shapely.Point(x + 700, y - 700).buffer(330),
+        shapely.Polygon([(x + 120, y - 1150), (x + 1300, y - 1050), (x + 400, y - 800)]),
+        shapely.box(x - 500, y - 500, x - 200, y - 300),
+    ]
+    blocks = gpd.GeoDataFrame({"block_id": np.arange(len(blocks))}, geometry=blocks, crs=RASTER_CRS)
+
+    return blocks.to_crs(4326)
+
+
+def get_overlay_values(blocks, raster, territory):
+    grid = raster_handler.vectorize_raster_grid(raster, territory, value_column_name="population")
+    grid = grid.query("population>=0")
+    res = raster_handler.project_grid_values(blocks, grid, "block_id", "population")
+    return res["population"].fillna(0).values
+
+
+@pytest.mark.parametrize("cached", [True, False])
+def test_raster_values_match_overlay(population_raster, cached):
+    x, y = 1000000, 5000000
+    raster = raster_handler.open_raster(population_raster(x, y), cached=cached)
+    blocks = make_blocks(x, y)
+    territory = shapely.box(*blocks.total_bounds)
+
+    expected = get_overlay_values(blocks, raster, territory)
+    # every chunk size gives the same values, down to one polygon per chunk
+    for max_pairs in [1, 5, 1000000]:
+        res = raster_handler.project_raster_values(
+            blocks, raster, territory, "block_id", value_column_name="population", max_pairs=max_pairs)
+        np.testing.assert_allclose(res["population"].values, expected, rtol=1e-9, atol=1e-9)
+
+    # blocks on cells with values get a share of them, the block outside the raster gets nothing
+    assert (expected[:-1] > 0).all()
+    assert expected[-1] == 0
+
+
+def test_populate_blocks_engines_match(population_raster):
+    city = make_city()
+    model = make_model(city)
+    model.generate_blocks()
+
+    # the raster covers only the north west of the city
+    xmin, _, _, ymax = city["territory"].to_crs(RASTER_CRS).total_bounds
+    path = population_raster(np.floor(xmin) - 50, np.floor(ymax) - 500, height=15, width=12)
+
+    model.populate_blocks(path, engine="overlay")
+    expected = model.blocks["population"].copy()
+    model.populate_blocks(path, engine="raster")
+
+    np.testing.assert_array_equal(model.blocks["population"], expected)
+    assert 0 < (expected > 0).sum() < len(expected)
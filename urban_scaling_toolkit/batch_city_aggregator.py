@@ -1,109 +1,369 @@
 import geopandas as gpd
+import pandas as pd
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 from city_model import CityModel
 import utils
 import db_manager
 import data_fetcher
+import pbf_fetcher
+import checkpoints
+import instrumentation
 
 
 
-def push_citymodel_to_db(model,city_id,engine,tags_df):
-    # push blocks
-    max_block_id = db_manager.get_query(f'SELECT MAX(block_id) FROM block')['max'][0]
-    if max_block_id is None:
-        max_block_id = 0
-        
-    max_cluster_id = db_manager.get_query(f'SELECT MAX(cluster_id) FROM block')['max'][0]
-    if max_cluster_id is None:
-        max_cluster_id = 0
+@instrumentation.instrument(rows_in=lambda model, *args, **kwargs: len(model.blocks))
+def push_citymodel_to_db(model,city_id,engine,tags_df,method="copy"):
+    """
+    Pushes blocks, services, servicetags and roads of a CityModel to the database.
 
-    max_service_id = db_manager.get_query(f'SELECT MAX(service_id) FROM service')['max'][0]
-    if max_service_id is None:
-        max_service_id = 0
+    Attributes
+    ----------
+    model: CityModel
+        Processed city model.
 
-    model.blocks['city_id'] = city_id
-    model.blocks['cluster_id'] = model.blocks['cluster_id'].astype('Int64')+(max_cluster_id+1)
+    city_id: int
+        ID of a city in the `city` table.
 
-    old_block_ids = list(model.blocks['block_id'])
-    model.blocks['block_id'] += (max_block_id+1)
-    new_block_ids = list(model.blocks['block_id'])
+    engine: sqlalchemy.engine.Engine
+        Engine connected to the database, used by the "insert" method.
 
-    model.blocks[['block_id','city_id','cluster_id','population','area','geometry']].to_postgis(
-        'block',con=engine,if_exists='append')
+    tags_df: pd.DataFrame
+        Tags with `tag_id` and `name` columns.
 
+    method: str
+        "copy" streams all tables with COPY in one transaction per city,
+        "insert" appends them with `to_postgis`/`to_sql`.
+    """
 
-    # push services
-    model.services['city_id'] = city_id
+    # reserve new IDs for blocks, clusters and services in one query
+    cluster_ids = model.blocks['cluster_id'].dropna().unique()
+    ids = db_manager.reserve_ids(
+        block_id=len(model.blocks), cluster_id=len(cluster_ids), service_id=len(model.services))
 
-    block_id_replace_dict = {x:y for x,y in zip(old_block_ids,new_block_ids)}
+    # prepare blocks
+    model.blocks['city_id'] = city_id
+    model.blocks['cluster_id'] = model.blocks['cluster_id'].map(dict(zip(cluster_ids,ids['cluster_id']))).astype('Int64')
 
-    model.services = model.services.drop(['service_id'],axis=1).reset_index().rename(columns={'index':'service_id'})
-    model.services['service_id'] += (max_service_id+1)
-    model.services['block_id'] = model.services['block_id'].replace(block_id_replace_dict) 
+    block_id_replace_dict = dict(zip(model.blocks['block_id'],ids['block_id']))
+    model.blocks['block_id'] = ids['block_id']
+    blocks = model.blocks[['block_id','city_id','cluster_id','population','area','geometry']]
 
-    model.services[['service_id','city_id','block_id','name','geometry']].to_postgis(
-        'service',con=engine,if_exists='append')
+    # prepare services
+    model.services['city_id'] = city_id
 
+    model.services['service_id'] = ids['service_id']
+    model.services['block_id'] = model.services['block_id'].map(block_id_replace_dict)
+    services = model.services[['service_id','city_id','block_id','name','geometry']]
 
-    # push servicetags
+    # prepare servicetags
     servicetag = model.services[['service_id','tags']].set_index('service_id')['tags'].explode().reset_index()
     servicetag = servicetag.merge(tags_df,how='inner',left_on='tags',right_on='name')[['service_id','tag_id']]
-    servicetag.to_sql('servicetag',con=engine,if_exists='append',index=False)
-
 
-    # push roads
+    # prepare roads
     model.roads = model.roads.reset_index()[['geometry']]
     model.roads['city_id'] = city_id
-    model.roads.to_postgis('road',con=engine,if_exists='append')
-    
+    roads = model.roads[['city_id','geometry']]
+
+    if method == "copy":
+        db_manager.copy_tables(
+            [('block',blocks),('service',services),('servicetag',servicetag),('road',roads)])
+
+    elif method == "insert":
+        blocks.to_postgis('block',con=engine,if_exists='append')
+        services.to_postgis('service',con=engine,if_exists='append')
+        servicetag.to_sql('servicetag',con=engine,if_exists='append',index=False)
+        gpd.GeoDataFrame(roads,crs=4326).to_postgis('road',con=engine,if_exists='append')
+
+    else:
+        raise ValueError(f"Unknown push method: {method}")
+
+
+def _fetch_layers(territory, set_stage):
+
+    set_stage("fetching roads")
+    roads = data_fetcher.fetch_roads(territory)
+
+    set_stage("fetching railways")
+    railways = data_fetcher.fetch_railways(territory)
+
+    set_stage("fetching water")
+    water = data_fetcher.fetch_water(territory)
+
+    set_stage("fetching services")
+    services = data_fetcher.fetch_services(territory,verbose=False)
+
+    return {"roads": roads, "railways": railways, "water": water, "services": services}
+
+
+STAGE_NAMES = {
+    "generate_blocks": "generating blocks",
+    "set_services": "setting services",
+    "cluster_blocks": "clustering blocks",
+    "evaluate_centrality": "evaluating centrality",
+    "populate_blocks": "populating blocks",
+}
+
+
+@instrumentation.instrument(rows_in=lambda *args, **kwargs: None, rows_out=lambda model, *args, **kwargs: len(model.blocks))
+def process_city(territory, set_stage=None, layers=None, city_id=None, params=None):
+    """
+    Runs the full CityModel pipeline for one city.
+
+    If `city_id` is given and `checkpoints.CHECKPOINT_DIR` is set, fetched layers and the model
+    after every stage are saved as checkpoints, and the pipeline resumes from the last stage
+    whose checkpoint matches the territory and parameters of all stages up to it.
+
+    Attributes
+    ----------
+    territory: gpd.GeoDataFrame
+        Territory of a city.
+
+    set_stage: callable or None
+        Function called with the name of every stage before it starts.
+
+    layers: dict or None
+        Prefetched `roads`, `railways`, `water` and `services`, e.g. from
+        `pbf_fetcher.fetch_from_pbf`. If None, they are fetched from Overpass.
+
+    city_id: int or None
+        ID of a city used to store its checkpoints. None disables checkpoints.
+
+    params: dict or None
+        Stage name -> keyword arguments of the CityModel method, e.g.
+        `{'cluster_blocks': {'clustering_distance': 800}}`.
+
+    Returns
+    -------
+    model: CityModel
+        Processed city model.
+    """
+
+    if set_stage is None:
+        set_stage = lambda stage: None
+
+    params = params or {}
+    use_checkpoints = city_id is not None and checkpoints.CHECKPOINT_DIR is not None
+
+    model = None
+    stages = checkpoints.STAGES
+    if use_checkpoints:
+        keys = checkpoints.get_stage_keys(territory, params)
+        last_stage = checkpoints.get_last_stage(city_id, keys)
+        if last_stage is not None:
+            set_stage("loading checkpoint")
+            model = checkpoints.load_model(city_id, last_stage, keys[last_stage])
+            stages = stages[stages.index(last_stage) + 1:]
+
+    def get_layers():
+        nonlocal layers
+        fetched = use_checkpoints and checkpoints.exists(city_id, checkpoints.FETCH_STAGE, keys[checkpoints.FETCH_STAGE])
+        if layers is None and fetched:
+            set_stage("loading checkpoint")
+            layers = checkpoints.load_layers(city_id, keys[checkpoints.FETCH_STAGE])
+        elif layers is None:
+            layers = _fetch_layers(territory, set_stage)
+
+        # prefetched layers are saved too, so that resumed runs need neither Overpass nor the .pbf file
+        if use_checkpoints and not fetched:
+            checkpoints.save_layers(layers, city_id, keys[checkpoints.FETCH_STAGE])
+        return layers
+
+    for stage in stages:
+        if stage == "generate_blocks":
+            layers = get_layers()
+            set_stage("initializing citymodel")
+            model = CityModel(territory,layers["roads"],layers["railways"],layers["water"],verbose=False)
+
+        set_stage(STAGE_NAMES[stage])
+        if stage == "set_services":
+            model.set_services(get_layers()["services"])
+        else:
+            getattr(model, stage)(**params.get(stage, {}))
+
+        if use_checkpoints:
+            checkpoints.save_model(model, city_id, stage, keys[stage])
+
+    return model
+
+
+def _process_city_worker(city_id, territory, layers=None, params=None, checkpoint_dir=None,
+                         instrument=False, track_memory=False):
+    """
+    Runs `process_city` in a worker process and returns its outcome and instrumentation records
+    instead of raising, so that one failed city does not stop the batch.
+    """
+
+    checkpoints.configure(checkpoint_dir)
+    instrumentation.configure(enabled=instrument, track_memory=track_memory)
+    stage = {"name": None}
+
+    def set_stage(name):
+        stage["name"] = name
+
+    with instrumentation.context(city_id=city_id):
+        try:
+            model = process_city(territory, set_stage=set_stage, layers=layers, city_id=city_id, params=params)
+            return city_id, model, None, None, instrumentation.get_records()
+        except Exception:
+            return city_id, None, stage["name"], traceback.format_exc(), instrumentation.get_records()
+
+
+def batch_process_cities(city_ids,cities_df,n_workers=1,push_method="copy",defer_constraints=False,pbf_path=None,
+                         params=None,checkpoint_dir=None,log_path=None):
+    """
+    Processes cities and pushes resulting models to the database.
+
+    With `n_workers` > 1 every city's pipeline runs in a separate process,
+    and the models are pushed to the database one by one from the main process.
+
+    Attributes
+    ----------
+    city_ids: list
+        IDs of cities in the `city` table.
+
+    cities_df: pd.DataFrame
+        Cities with `city_id` and `name` columns.
+
+    n_workers: int
+        Number of worker processes.
+
+    push_method: str
+        Method passed to `push_citymodel_to_db`.
+
+    defer_constraints: bool
+        Drop foreign keys for the time of the batch and recreate them afterwards.
+        Speeds up initial loads into an empty database.
+
+    pbf_path: str or None
+        Path to a regional .osm.pbf extract. If set, OSM data of all cities is read
+        from it in one pass instead of querying Overpass for every city.
+
+    params: dict or None
+        Stage name -> keyword arguments of the CityModel method, passed to `process_city`.
+
+    checkpoint_dir: str or None
+        Directory of stage checkpoints. Cities failed or interrupted in a previous run resume
+        from their last completed stage, and changing `params` of a stage reruns only it
+        and later stages. None uses `checkpoints.CHECKPOINT_DIR`.
+
+    log_path: str or None
+        .jsonl or .parquet file the instrumentation records of every city (stage, wall and CPU time,
+        row counts and, with `instrumentation.TRACK_MEMORY`, peak RSS) are appended to.
+        Setting it turns instrumentation on, otherwise it is on only if enabled in `instrumentation`
+        and written to `instrumentation.LOG_PATH`.
+        Aggregate it with `instrumentation.summarize(instrumentation.read_records(log_path))`.
+
+    Returns
+    -------
+    status: pd.DataFrame
+        Processing status of every city with the failed stage and error traceback.
+    """
 
-def batch_process_cities(city_ids,cities_df):
     #city_ids = list(CITIES.query('country==["Brazil"]').sample(100)['city_id']) + list(CITIES.query('country==["Indonesia"]').sample(100)['city_id']) + list(CITIES.query('country==["Japan","Chile"]')['city_id'])
 
     cities_in_db = db_manager.get_query('SELECT DISTINCT(city_id) FROM block')
     city_ids_to_process = list(set(city_ids)-set(set(cities_in_db['city_id'])))
+    city_names = cities_df.set_index('city_id')['name']
 
+    engine = db_manager.get_engine()
+    tags_df = db_manager.get_query('SELECT tag_id, name FROM tag')
 
-    for city_id in (pbar := tqdm(city_ids_to_process)):
+    def get_territory(city_id):
+        territory = db_manager.get_query(f"SELECT geometry from city WHERE city_id='{city_id}'",geom=True)
+        return territory.make_valid()
+
+    status = []
+
+    if checkpoint_dir is not None:
+        checkpoints.configure(checkpoint_dir)
+
+    if log_path is not None:
+        instrumentation.configure(enabled=True)
+
+    pbf_layers = {}
+    if pbf_path is not None and city_ids_to_process:
+        ids = ','.join(f"'{city_id}'" for city_id in city_ids_to_process)
+        territories = db_manager.get_query(f"SELECT city_id, geometry FROM city WHERE city_id IN ({ids})",geom=True)
+        territories['geometry'] = territories.make_valid()
+
+        # cities with fetched layers or services already set in checkpoints do not need to be read again
+        if checkpoints.CHECKPOINT_DIR is not None:
+            fetched = [
+                checkpoints.has_layers(city_id, checkpoints.get_stage_keys(
+                    gpd.GeoSeries([geometry], crs=territories.crs), params))
+                for city_id, geometry in zip(territories['city_id'], territories.geometry)]
+            territories = territories[~pd.Series(fetched, index=territories.index)]
+
+        if len(territories) > 0:
+            pbf_layers = pbf_fetcher.fetch_from_pbf(pbf_path,territories)
+
+    def push_model(city_id, model):
         try:
-            city_name = cities_df[cities_df['city_id']==city_id]['name'].iloc[0]
-            pbar.set_description(f"{city_name}")
-            
-            territory = db_manager.get_query(f"SELECT geometry from city WHERE city_id='{city_id}'",geom=True)
-            territory = territory.make_valid()
-
-            pbar.set_description(f"{city_name} [fetching roads]")
-            roads = data_fetcher.fetch_roads(territory)
-            
-            pbar.set_description(f"{city_name} [fetching railways]")
-            railways = data_fetcher.fetch_railways(territory)
-            
-            pbar.set_description(f"{city_name} [fetching water]")
-            water = data_fetcher.fetch_water(territory)
-            
-            pbar.set_description(f"{city_name} [fetching services]")
-            services = data_fetcher.fetch_services(territory,verbose=False)
-
-            ###
-            pbar.set_description(f"{city_name} [initializing citymodel]")
-            model = CityModel(territory,roads,railways,water,verbose=False)
-
-            pbar.set_description(f"{city_name} [generating blocks]")
-            model.generate_blocks()
-            
-            pbar.set_description(f"{city_name} [setting services]")
-            model.set_services(services)
-            
-            pbar.set_description(f"{city_name} [clustering blocks]")
-            model.cluster_blocks()
-            
-            pbar.set_description(f"{city_name} [evaluating centrality]")
-            model.evaluate_centrality()
-            
-            pbar.set_description(f"{city_name} [populating blocks]")
-            model.populate_blocks()
-            
-            pbar.set_description(f"{city_name} [pushing to db]")
-            push_citymodel_to_db(model,city_id)
-        except:
-            continue
\ No newline at end of file
+            with instrumentation.context(city_id=city_id):
+                push_citymodel_to_db(model,city_id,engine,tags_df,method=push_method)
+            status.append([city_id, city_names[city_id], "done", None, None])
+        except Exception:
+            status.append([city_id, city_names[city_id], "failed", "pushing to db", traceback.format_exc()])
+
+    def write_records(records=()):
+        instrumentation.write_records(list(records) + instrumentation.get_records(), log_path)
+
+    # records of the batch-wide .pbf read
+    write_records()
+
+    if defer_constraints:
+        db_manager.drop_foreign_keys()
+
+    try:
+        if n_workers == 1:
+            for city_id in (pbar := tqdm(city_ids_to_process)):
+                city_name = city_names[city_id]
+                stage = {"name": "fetching territory"}
+
+                def set_stage(name):
+                    stage["name"] = name
+                    pbar.set_description(f"{city_name} [{name}]")
+
+                try:
+                    set_stage("fetching territory")
+                    territory = get_territory(city_id)
+                    with instrumentation.context(city_id=city_id):
+                        model = process_city(territory, set_stage=set_stage, layers=pbf_layers.pop(city_id, None),
+                                             city_id=city_id, params=params)
+                except Exception:
+                    status.append([city_id, city_name, "failed", stage["name"], traceback.format_exc()])
+                    write_records()
+                    continue
+
+                set_stage("pushing to db")
+                push_model(city_id, model)
+                write_records()
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                futures = []
+                for city_id in city_ids_to_process:
+                    try:
+                        futures.append(executor.submit(
+                            _process_city_worker, city_id, get_territory(city_id), pbf_layers.pop(city_id, None),
+                            params, checkpoints.CHECKPOINT_DIR, instrumentation.ENABLED, instrumentation.TRACK_MEMORY))
+                    except Exception:
+                        status.append([city_id, city_names[city_id], "failed", "fetching territory", traceback.format_exc()])
+
+                # a single writer pushes models to the database as soon as they are ready
+                for future in tqdm(as_completed(futures), total=len(futures)):
+                    city_id, model, failed_stage, error, records = future.result()
+                    if model is None:
+                        status.append([city_id, city_names[city_id], "failed", failed_stage, error])
+                        write_records(records)
+                        continue
+                    push_model(city_id, model)
+                    write_records(records)
+    finally:
+        if defer_constraints:
+            db_manager.create_foreign_keys()
+
+    status = pd.DataFrame(status, columns=['city_id', 'name', 'status', 'failed_stage', 'error'])
+
+    return status
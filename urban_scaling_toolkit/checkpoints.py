@@ -0,0 +1,188 @@
+import hashlib
+import inspect
+import json
+import os
+import shutil
+
+import geopandas as gpd
+import shapely
+from dotenv import load_dotenv
+
+import utils
+import instrumentation
+from city_model import CityModel, read_layer, MANIFEST_FILE, FORMAT_VERSION
+
+load_dotenv()
+
+# checkpoints are disabled unless a directory is set here, in the environment or with `configure`
+CHECKPOINT_DIR = os.environ.get('checkpoint_dir')
+
+# CityModel methods run by `batch_city_aggregator.process_city`, in order
+STAGES = ['generate_blocks', 'set_services', 'cluster_blocks', 'evaluate_centrality', 'populate_blocks']
+
+FETCH_STAGE = 'fetch'
+FETCH_LAYERS = ['roads', 'railways', 'water', 'services']
+
+
+def configure(checkpoint_dir=None):
+    """
+    Sets the directory of stage checkpoints. None disables them.
+    """
+
+    global CHECKPOINT_DIR
+    CHECKPOINT_DIR = checkpoint_dir
+
+
+def _hash(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_stage_params(stage, params=None):
+    """
+    Returns all parameters of a stage method, with defaults for the ones not given.
+    """
+
+    signature = inspect.signature(getattr(CityModel, stage))
+    bound = signature.bind_partial(None, **(params or {}))
+    bound.apply_defaults()
+
+    return {name: value for name, value in list(bound.arguments.items())[1:]}
+
+
+def get_stage_keys(territory, params=None):
+    """
+    Returns keys of the fetch stage and every stage in `STAGES`.
+
+    The fetch key is a hash of the territory, and every next key is a hash of the previous one
+    and the stage parameters, so changing parameters of a stage invalidates it and all later stages.
+
+    Attributes
+    ----------
+    territory: gpd.GeoDataFrame or gpd.GeoSeries or shapely.Geometry
+        Territory of a city.
+
+    params: dict or None
+        Stage name -> keyword arguments of the CityModel method, e.g.
+        `{'cluster_blocks': {'clustering_distance': 800}}`.
+
+    Returns
+    -------
+    keys: dict
+        Stage name -> hex digest.
+    """
+
+    params = params or {}
+    unknown = set(params) - set(STAGES)
+    if unknown:
+        raise ValueError(f"Unknown stages: {sorted(unknown)}")
+
+    if type(territory) in [gpd.GeoDataFrame, gpd.GeoSeries]:
+        territory = territory.unary_union
+
+    key = _hash([FETCH_STAGE, shapely.to_wkb(shapely.normalize(territory), hex=True)])
+    keys = {FETCH_STAGE: key}
+    for stage in STAGES:
+        key = _hash([key, stage, get_stage_params(stage, params.get(stage))])
+        keys[stage] = key
+
+    return keys
+
+
+def _get_path(city_id, stage, key):
+    return os.path.join(CHECKPOINT_DIR, str(city_id), stage, key)
+
+
+def exists(city_id, stage, key):
+    """
+    Checks whether a stage checkpoint is complete. The manifest is written last, so partial ones are ignored.
+    """
+
+    return CHECKPOINT_DIR is not None and os.path.isfile(os.path.join(_get_path(city_id, stage, key), MANIFEST_FILE))
+
+
+def get_last_stage(city_id, keys):
+    """
+    Returns the last stage in `STAGES` with a complete checkpoint, or None.
+    """
+
+    for stage in reversed(STAGES):
+        if exists(city_id, stage, keys[stage]):
+            return stage
+
+    return None
+
+
+def has_layers(city_id, keys):
+    """
+    Checks whether a city can resume without fetching layers: either they are checkpointed,
+    or a stage with services already set is.
+    """
+
+    last_stage = get_last_stage(city_id, keys)
+    return (exists(city_id, FETCH_STAGE, keys[FETCH_STAGE])
+            or (last_stage is not None and STAGES.index(last_stage) >= STAGES.index('set_services')))
+
+
+@instrumentation.instrument(rows_in=lambda *args, **kwargs: None)
+def save_model(model, city_id, stage, key):
+    model.save(_get_path(city_id, stage, key))
+
+
+@instrumentation.instrument(rows_in=lambda *args, **kwargs: None)
+def load_model(city_id, stage, key):
+    return CityModel.load(_get_path(city_id, stage, key))
+
+
+@instrumentation.instrument(rows_in=lambda *args, **kwargs: None)
+def save_layers(layers, city_id, key):
+    """
+    Saves fetched `roads`, `railways`, `water` and `services` in the layout of `CityModel.save`.
+    """
+
+    path = _get_path(city_id, FETCH_STAGE, key)
+    os.makedirs(path, exist_ok=True)
+
+    # the same as in `CityModel.save`, a manifest exists only for a complete set of layers
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    manifest = {'format_version': FORMAT_VERSION, 'layers': {}}
+    for layer in FETCH_LAYERS:
+        value = layers[layer]
+        if value is None:
+            manifest['layers'][layer] = None
+            continue
+
+        if isinstance(value, gpd.GeoSeries):
+            value = gpd.GeoDataFrame(geometry=value)
+
+        file = f'{layer}.parquet'
+        value.to_parquet(os.path.join(path, file))
+        manifest['layers'][layer] = {
+            'file': file,
+            'rows': len(value),
+            'columns': list(value.columns),
+            'geometry': value.geometry.name}
+
+    utils.save_json(manifest, manifest_path + '.tmp')
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+@instrumentation.instrument(rows_in=lambda *args, **kwargs: None)
+def load_layers(city_id, key):
+    path = _get_path(city_id, FETCH_STAGE, key)
+
+    return {layer: read_layer(path, layer) for layer in FETCH_LAYERS}
+
+
+def clear(city_id=None):
+    """
+    Removes checkpoints of a city, or all of them if `city_id` is None.
+    """
+
+    if CHECKPOINT_DIR is None:
+        return
+
+    path = CHECKPOINT_DIR if city_id is None else os.path.join(CHECKPOINT_DIR, str(city_id))
+    shutil.rmtree(path, ignore_errors=True)
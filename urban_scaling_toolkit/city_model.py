@@ -1,16 +1,121 @@
+import os
+import json
 import pandas as pd
 import geopandas as gpd
 import numpy as np
+from pyproj import CRS
 from shapely.ops import polygonize
 from shapely import Polygon,MultiPolygon
+import shapely
+from concurrent.futures import ProcessPoolExecutor
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 import utils
 from utils import verbose_print,get_attribute_from_largest_intersection
 from clusterizer import compress_services,get_cluster_hulls
 import metrics
 import raster_handler
+import instrumentation
+
+
+def _polygonize_tile(bounds, barriers, limit):
+    """
+    Polygonizes barriers clipped to a rectangular tile and returns the pieces within the limit.
+    """
+
+    tile = shapely.box(*bounds)
+    lines = shapely.clip_by_rect(np.append(barriers, limit.boundary), *bounds)
+    lines = np.append(lines[~shapely.is_empty(lines)], tile.boundary)
+
+    pieces = shapely.get_parts(shapely.polygonize(shapely.get_parts(shapely.union_all(lines))))
+    pieces = pieces[shapely.contains(limit, shapely.point_on_surface(pieces))]
+
+    # drop slivers left by rounding where barriers cross tile edges
+    pieces = pieces[shapely.area(pieces) > 1e-16]
+
+    return pieces
+
+
+def _drop_seam_vertices(polygons, xs, ys, kept):
+    """
+    Drops vertices lying exactly on seam lines `xs` and `ys` from polygons, except the `kept` ones.
+    """
+
+    rings, polygon_idx = shapely.get_rings(polygons, return_index=True)
+    coords, ring_idx = shapely.get_coordinates(rings, return_index=True)
+
+    on_seam = np.isin(coords[:, 0], xs) | np.isin(coords[:, 1], ys)
+    keep = ~on_seam | np.isin(coords[:, 0] + 1j * coords[:, 1], kept)
+
+    rings = shapely.linearrings(coords[keep], indices=ring_idx[keep])
+    return shapely.polygons(rings, indices=polygon_idx)
+
+
+# layers written by `CityModel.save`, GeoSeries layers are stored as one-column GeoDataFrames
+MODEL_LAYERS = ['territory', 'roads', 'railways', 'water', 'blocks', 'services', 'cluster_polygons', 'cluster_info']
+SERIES_LAYERS = ['roads', 'railways', 'water']
+MANIFEST_FILE = 'manifest.json'
+FORMAT_VERSION = 1
+
+
+def _read_manifest(path):
+    with open(os.path.join(path, MANIFEST_FILE), 'r') as fp:
+        return json.load(fp)
+
+
+def read_layer(path, layer, columns=None):
+    """
+    Reads one layer of a CityModel saved with `CityModel.save`.
+
+    Only requested columns are read from the file, and geometry is decoded
+    only if it is among them, e.g. `read_layer(path, 'blocks', ['cluster_id', 'population'])`
+    returns a plain DataFrame without touching block geometries.
+
+    Attributes
+    ----------
+    path: str
+        Directory of a saved model.
+
+    layer: str
+        One of `MODEL_LAYERS`.
+
+    columns: list or None
+        Columns to read. None reads all of them.
+
+    Returns
+    -------
+    res: gpd.GeoDataFrame or pd.DataFrame or None
+        GeoDataFrame if geometry is read, DataFrame otherwise. None if the layer was not set.
+    """
+
+    manifest = _read_manifest(path)
+    if layer not in manifest['layers']:
+        raise ValueError(f"Unknown layer: {layer}")
+
+    info = manifest['layers'][layer]
+    if info is None:
+        return None
+
+    file = os.path.join(path, info['file'])
+    if columns is None or info['geometry'] in columns:
+        res = gpd.read_parquet(file, columns=columns)
+    else:
+        res = pd.read_parquet(file, columns=columns)
+
+    # lists, e.g. service tags, are read back as arrays and missing lists as None, other values are kept
+    for column in res.columns:
+        if res[column].dtype == object:
+            values = res[column].to_numpy()
+            if any(isinstance(x, np.ndarray) for x in values):
+                res[column] = [list(x) if isinstance(x, np.ndarray) else np.nan if x is None else x for x in values]
+
+    return res
 
     
 class CityModel:
+
+    # incremented on every reassignment of `blocks`
+    _blocks_generation = 0
         
     def __init__(self, territory, roads=None, railways=None, water=None, verbose=True):
         
@@ -27,6 +132,13 @@ class CityModel:
         
         self.local_crs = territory.estimate_utm_crs()
 
+        # projected copies of blocks and services geometries reused between stages
+        self._projection_cache = utils.ProjectionCache(self.local_crs)
+
+        # spatial index of projected blocks and the generation of blocks services were linked with
+        self._blocks_tree = None
+        self._linked_blocks_generation = None
+
         self.roads = roads.geometry if type(roads) == gpd.GeoDataFrame else roads
         self.railways = railways.geometry if type(railways) == gpd.GeoDataFrame else railways
 
@@ -36,12 +148,23 @@ class CityModel:
         self.cluster_info = None
                 
             
-    def generate_blocks(self, min_block_width=None):
+    @instrumentation.instrument(rows_in=instrumentation.attribute_rows('roads'), rows_out=instrumentation.attribute_rows('blocks', output=True))
+    def generate_blocks(self, min_block_width=None, engine="union", tile_size=5000, n_workers=1):
         """
         # TODO
 
         Attributes
         ----------
+        engine: str
+            "union" polygonizes all barriers at once, "tiled" polygonizes them
+            in square tiles of `tile_size` meters in `n_workers` processes and
+            stitches the pieces on tile seams. Tiles node barriers separately, so vertices
+            of tiled blocks can differ by floating point rounding: on test cities blocks differ
+            by less than 1e-8 of their area, though `min_block_width` buffers amplify it.
+            In one process the tiled engine is slower, it only pays off with several workers.
+
+        n_workers: int
+            Number of worker processes of the tiled engine and of bottleneck filtering.
         # TODO
         
         Returns
@@ -57,7 +180,12 @@ class CityModel:
         
         # transform enclosed barriers to polygons 
         utils.verbose_print("Setting up enclosures...", self.verbose)
-        blocks = self._get_enclosures(barriers,self.territory)
+        if engine == "union":
+            blocks = self._get_enclosures(barriers,self.territory)
+        elif engine == "tiled":
+            blocks = self._get_enclosures_tiled(barriers,self.territory,self.local_crs,tile_size,n_workers)
+        else:
+            raise ValueError(f"Unknown block generation engine: {engine}")
 
         # fill everything within blocks' boundaries
         utils.verbose_print("Filling holes...", self.verbose)
@@ -74,12 +202,15 @@ class CityModel:
         # and divide the blocks on bottlenecks
         if min_block_width is not None:
             utils.verbose_print("Filtering bottlenecks and small blocks...", self.verbose)
-            blocks = utils.filter_bottlenecks(blocks, self.local_crs, min_block_width)
+            blocks, failed = utils.filter_bottlenecks(
+                blocks, self.local_crs, min_block_width, n_workers=n_workers, return_failed=True)
+            if len(failed) > 0:
+                utils.verbose_print(f"Failed to filter bottlenecks of {len(failed)} blocks, kept unchanged: {list(failed.index)}", self.verbose)
             blocks = self._reindex_blocks(blocks)
 
         # calculate blocks' area using local projected CRS
         utils.verbose_print("Calculating blocks area...", self.verbose)
-        blocks["area"] = blocks.to_crs(self.local_crs).area
+        blocks["area"] = self._project("blocks", blocks).area
         blocks = blocks[blocks["area"] > 1]
 
         # fix blocks' indices
@@ -88,11 +219,13 @@ class CityModel:
         self.blocks = blocks
         utils.verbose_print("Blocks generated.\n", self.verbose)
    
+    @instrumentation.instrument(rows_in=lambda self, services: len(services), rows_out=instrumentation.attribute_rows('services', output=True))
     def set_services(self,services):
         self.services = services
         self._link_services_to_blocks()
     
-    def cluster_blocks(self, clustering_distance=1200, method="average", max_number_of_services=10000):
+    @instrumentation.instrument(rows_in=instrumentation.attribute_rows('services'), rows_out=instrumentation.attribute_rows('cluster_polygons', output=True))
+    def cluster_blocks(self, clustering_distance=1200, method="average", max_number_of_services=10000, engine="dense"):
         """
         # TODO
         
@@ -110,49 +243,58 @@ class CityModel:
         _services = self.services.copy()
 
         # if there are more than X services, perform service clustering 
-        if len(_services) > max_number_of_services:
+        # (the sparse engine does not build a full distance matrix and needs no compression)
+        if engine == "dense" and len(_services) > max_number_of_services:
             verbose_print("Too many services. Compressing...", self.verbose)
             _services = compress_services(_services, n_clusters=max_number_of_services)
             verbose_print("Services compressed. Proceeding with clustering...", self.verbose)
 
         # cluster services, create convex hulls from cluster points and assign clusters to blocks
         self.cluster_polygons = get_cluster_hulls(
-            _services.to_crs(self.local_crs),
+            _services.set_geometry(self._project("services", _services)),
             distance_limit=clustering_distance,
-            link=method)
+            link=method,
+            engine=engine)
         
-        self.blocks = self.blocks.drop('cluster_id',axis=1,errors='ignore')
-        self.blocks = get_attribute_from_largest_intersection(
-            self.blocks, self.cluster_polygons, 
+        blocks = get_attribute_from_largest_intersection(
+            self.blocks.drop('cluster_id',axis=1,errors='ignore'), self.cluster_polygons, 
             attribute_column='cluster_id',
             df_id_column="block_id",
-            projected_crs=self.local_crs)
+            projected_crs=self.local_crs,
+            projected_geometry=self._project("blocks", self.blocks))
         
         # if cluster polygon occupies less than X% of block's area, unassign cluster from this block
-        self.blocks.loc[self.blocks["intersection_area"] < 0.4, 'cluster_id'] = np.nan
-        self.blocks = self.blocks.drop('intersection_area',axis=1)
+        blocks.loc[blocks["intersection_area"] < 0.4, 'cluster_id'] = np.nan
         
-        self._link_services_to_blocks()
+        # blocks' geometries do not change, so their columns are set in place and services stay linked to them
+        self.blocks.drop('cluster_id',axis=1,errors='ignore',inplace=True)
+        self.blocks['area'] = blocks['area'].values
+        self.blocks['cluster_id'] = blocks['cluster_id'].values
+        
+        self._link_services_to_blocks(reuse_links=True)
         verbose_print("Blocks clustered.\n", self.verbose)
              
                 
-    def evaluate_centrality(self):
+    @instrumentation.instrument(rows_in=instrumentation.attribute_rows('blocks'), rows_out=instrumentation.attribute_rows('blocks', output=True))
+    def evaluate_centrality(self, diversity_index="simpson"):
         """
         # TODO
         
         Attributes
         ----------
-        # TODO
+        diversity_index: str
+            "simpson" or "shannon" diversity of service tags.
         
         Returns
         -------
         # TODO
         """
         
-        self.blocks = metrics.evaluate_centrality(self.blocks,self.services)
+        self.blocks = metrics.evaluate_centrality(self.blocks,self.services,diversity_index=diversity_index)
     
     
-    def populate_blocks(self,population_raster_path="GHS_POP_E2020.tif"):
+    @instrumentation.instrument(rows_in=instrumentation.attribute_rows('blocks'), rows_out=instrumentation.attribute_rows('blocks', output=True))
+    def populate_blocks(self,population_raster_path="GHS_POP_E2020.tif",engine="overlay"):
         """
         # TODO
         
@@ -160,34 +302,54 @@ class CityModel:
         ----------
         # TODO
         
+        engine: str
+            "overlay" intersects blocks with vectorized raster cells,
+            "raster" computes blocks' coverage of raster cells directly on the grid.
+        
         Returns
         -------
         # TODO
         """
         
-        population_raster = raster_handler.open_raster(population_raster_path)
+        # the raster is opened once per process and its decoded tiles are reused between cities
+        population_raster = raster_handler.open_raster(population_raster_path, cached=True)
         
-        population_grid = raster_handler.vectorize_raster_grid(population_raster,self.territory,value_column_name='population')
-        population_grid = population_grid.query('population>=0')
+        self.blocks = self.blocks.drop('population',axis=1,errors='ignore')
+        
+        if engine == "overlay":
+            population_grid = raster_handler.vectorize_raster_grid(population_raster,self.territory,value_column_name='population')
+            population_grid = population_grid.query('population>=0')
+            
+            self.blocks = raster_handler.project_grid_values(self.blocks,population_grid,'block_id','population')
+        elif engine == "raster":
+            self.blocks = raster_handler.project_raster_values(
+                self.blocks,population_raster,self.territory,'block_id',value_column_name='population')
+        else:
+            raise ValueError(f"Unknown population engine: {engine}")
         
-        self.blocks = raster_handler.project_grid_values(self.blocks,population_grid,'block_id','population')
         self.blocks['population'] = self.blocks['population'].fillna(0).round().astype(int)
         
         
-    def aggregate_cluster_info(self):
+    @instrumentation.instrument(rows_in=instrumentation.attribute_rows('blocks'), rows_out=instrumentation.attribute_rows('cluster_info', output=True))
+    def aggregate_cluster_info(self, top_k=3, dissolve_method="unary"):
         """
         # TODO
         
         Attributes
         ----------
-        # TODO
+        top_k: int
+            Number of the most frequent tags and categories kept per cluster.
+
+        dissolve_method: str
+            Method of `gpd.GeoDataFrame.dissolve` for cluster geometries. "coverage"
+            is faster, but requires blocks to share edges exactly and not overlap.
         
         Returns
         -------
         # TODO
         """
         
-        self.blocks['area'] = self.blocks.to_crs(self.local_crs).area
+        self.blocks['area'] = self._project("blocks", self.blocks).area
         
         cluster_info = (
             self.blocks.groupby('cluster_id').agg(
@@ -198,21 +360,17 @@ class CityModel:
                     "services_total": "first",
                     "area": "sum",
                     "population": "sum",
-                    "geometry": list,
                 }
             ).reset_index())
         
-        cluster_info["geometry"] = cluster_info["geometry"].map(
-            lambda x: gpd.GeoDataFrame(geometry=x).unary_union)
-        cluster_info = gpd.GeoDataFrame(cluster_info,crs=4326)
+        cluster_geometry = self.blocks[['cluster_id','geometry']].dissolve(by='cluster_id',method=dissolve_method).reset_index()
+        cluster_info = gpd.GeoDataFrame(cluster_info.merge(cluster_geometry,how='left'),crs=4326)
         
-        service_stats_tags = self.services.groupby('cluster_id')["tags"].apply("sum")
-        service_stats_tags = service_stats_tags.map(
-            lambda x: [*pd.Series(x).value_counts().nlargest(3).keys()]).reset_index()
-        
-        service_stats_categories = self.services.groupby('cluster_id')["category"].apply(list)
-        service_stats_categories = service_stats_categories.map(
-            lambda x: [*pd.Series(x).value_counts().nlargest(3).keys()]).reset_index()
+        service_stats_tags = self._get_top_values(self.services[['cluster_id','tags']].explode('tags'),'tags',top_k)
+        service_stats_categories = self._get_top_values(self.services[['cluster_id','category']],'category',top_k)
+
+        cluster_info = cluster_info.merge(service_stats_tags.rename('top_tags').reset_index(), how="left")
+        cluster_info = cluster_info.merge(service_stats_categories.rename('top_categories').reset_index(), how="left")
 
         service_category_counts = self.services.groupby(
             ['cluster_id', "category"])["geometry"].count().unstack().reset_index()
@@ -229,43 +387,119 @@ class CityModel:
         self.cluster_info = cluster_info
         
         
-    def _link_services_to_blocks(self):
+    @staticmethod
+    def _get_top_values(df, column, top_k=3):
         """
-        # TODO
+        Returns lists of the `top_k` most frequent values of a column per cluster.
+        Ties are resolved by the first occurrence, as in `value_counts().nlargest()`.
+        """
+
+        df = df.dropna(subset=[column])
+        df = df.assign(_position=np.arange(len(df)))
+        counts = df.groupby(['cluster_id',column]).agg(count=('_position','size'),first=('_position','min')).reset_index()
+        counts = counts.sort_values(['cluster_id','count','first'],ascending=[True,False,True])
+        counts = counts.groupby('cluster_id').head(top_k)
+
+        return counts.groupby('cluster_id')[column].agg(list)
+
+
+    @instrumentation.instrument(rows_in=instrumentation.attribute_rows('services'), rows_out=instrumentation.attribute_rows('services', output=True))
+    def _link_services_to_blocks(self, reuse_links=False):
+        """
+        Assigns services to blocks containing them or, if there are none,
+        to the nearest blocks within 200 meters.
         
         Attributes
         ----------
-        # TODO
-        
-        Returns
-        -------
-        # TODO
+        reuse_links: bool
+            If services are already linked to the current blocks, only update
+            their `cluster_id` from blocks instead of searching blocks again.
         """
-           
-        blocks_columns = ["block_id", "geometry"]
-        if 'cluster_id' in self.blocks.columns:
-            blocks_columns.append('cluster_id')
+        
+        blocks_tree = self._get_blocks_tree()
 
-        # drop block_id and cluster columns in services
-        self.services = self.services.drop(['block_id','cluster_id'], axis=1, errors='ignore')
+        if reuse_links and 'block_id' in self.services.columns and self._linked_blocks_generation == self._blocks_generation:
+            self.services = self.services.drop('cluster_id', axis=1, errors='ignore')
+            if 'cluster_id' in self.blocks.columns:
+                self.services['cluster_id'] = self.services['block_id'].map(self.blocks.set_index('block_id')['cluster_id'])
 
-        # add block_id and cluster from the nearest block to the services
-        self.services = self.services.to_crs(self.local_crs)
-        self.services = self.services.sjoin_nearest(self.blocks.to_crs(self.local_crs)[blocks_columns], 
-                                                    how="left", max_distance=200).to_crs(4326)
-        
-        # drop services that are not assigned to any block
-        self.services = self.services.dropna(subset="block_id")
+        else:
+            # drop block_id and cluster columns in services
+            self.services = self.services.drop(['block_id','cluster_id'], axis=1, errors='ignore')
+
+            # blocks containing services, then the nearest blocks for the rest
+            geometry = np.asarray(self._project("services", self.services).values)
+            service_idx, block_idx = blocks_tree.query(geometry, predicate="intersects")
+            
+            outside = np.setdiff1d(np.arange(len(geometry)), service_idx)
+            nearest_idx, nearest_block_idx = blocks_tree.query_nearest(geometry[outside], max_distance=200, all_matches=True)
+            
+            # services not assigned to any block are dropped
+            service_idx = np.concatenate([service_idx, outside[nearest_idx]])
+            block_idx = np.concatenate([block_idx, nearest_block_idx])
+            order = np.lexsort((block_idx, service_idx))
+            service_idx, block_idx = service_idx[order], block_idx[order]
+
+            self.services = self.services.iloc[service_idx].copy()
+            self.services["block_id"] = self.blocks["block_id"].values[block_idx].astype(int)
+            if 'cluster_id' in self.blocks.columns:
+                self.services["cluster_id"] = self.blocks["cluster_id"].values[block_idx]
+
+            self._linked_blocks_generation = self._blocks_generation
         
         # clean up indices in services GeoDataFrame
-        self.services = self.services.drop("index_right", axis=1)
-        self.services["block_id"] = self.services["block_id"].astype(int)
-        
         self.services = self.services.drop('service_id',axis=1, errors='ignore')
         self.services = self.services.reset_index().rename(columns={'index':'service_id'})
         
         
+    def _get_blocks_tree(self):
+        """
+        Returns an STRtree of projected blocks, rebuilt only when `blocks` were reassigned.
+        """
+
+        if self._blocks_tree is not None:
+            tree_generation, tree = self._blocks_tree
+            if tree_generation == self._blocks_generation:
+                return tree
+
+        tree = shapely.STRtree(np.asarray(self._project("blocks", self.blocks).values))
+        self._blocks_tree = (self._blocks_generation, tree)
+
+        return tree
+
+
+    @property
+    def blocks(self):
+        return self._blocks
+
+
+    @blocks.setter
+    def blocks(self, blocks):
+        # every reassignment may change geometries and invalidates the spatial index and links of services,
+        # stages changing only columns assign them in place
+        self._blocks = blocks
+        self._blocks_generation += 1
+
+
+    def _project(self, name, gdf):
+        """
+        Returns geometries of blocks or services in the local CRS, reusing cached projections.
+        """
+
+        return self._projection_cache.project(name, gdf)
+
+
+    @property
+    def projection_stats(self):
+        """
+        Counters of reprojections and projection cache hits.
+        """
+
+        return dict(self._projection_cache.stats)
+
+
     @staticmethod
+    @instrumentation.instrument()
     def _get_enclosures(barriers,limit):
         """
         # TODO
@@ -294,6 +528,120 @@ class CityModel:
         return enclosures
           
             
+    @staticmethod
+    @instrumentation.instrument()
+    def _get_enclosures_tiled(barriers,limit,local_crs,tile_size=5000,n_workers=1):
+        """
+        Returns the enclosures of `_get_enclosures`, polygonizing barriers tile by tile.
+        They are the same up to rounding of vertices noded within a tile or clipped on a seam.
+
+        Attributes
+        ----------
+        barriers: gpd.GeoSeries
+            Exploded barrier lines (EPSG:4326).
+
+        limit: Polygon or MultiPolygon
+            Territory.
+
+        local_crs: pyproj.CRS
+            Projected CRS used to size the tiles.
+
+        tile_size: float
+            Approximate tile size in meters.
+
+        n_workers: int
+            Number of worker processes.
+
+        Returns
+        -------
+        enclosures: gpd.GeoDataFrame
+            Enclosures with `index` and `geometry` columns.
+        """
+
+        # split the territory extent into equal tiles of about tile_size meters
+        xmin, ymin, xmax, ymax = limit.bounds
+        pxmin, pymin, pxmax, pymax = gpd.GeoSeries([limit],crs=4326).to_crs(local_crs).total_bounds
+        nx = max(int(np.ceil((pxmax-pxmin)/tile_size)),1)
+        ny = max(int(np.ceil((pymax-pymin)/tile_size)),1)
+        xs, ys = np.linspace(xmin,xmax,nx+1), np.linspace(ymin,ymax,ny+1)
+
+        tiles = np.array([(xs[i],ys[j],xs[i+1],ys[j+1]) for i in range(nx) for j in range(ny)])
+        tile_boxes = shapely.box(*tiles.T)
+
+        # pass every worker only the barriers and the part of the territory of its tile
+        barriers = np.asarray(barriers.values)
+        tile_idx, barrier_idx = shapely.STRtree(barriers).query(tile_boxes)
+        tile_barriers = np.split(barrier_idx, np.searchsorted(tile_idx, np.arange(1,len(tiles))))
+        args = [(bounds, barriers[idx], shapely.clip_by_rect(limit, *bounds)) for bounds, idx in zip(tiles, tile_barriers)]
+
+        if n_workers > 1:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                tile_pieces = list(executor.map(_polygonize_tile, *zip(*args)))
+        else:
+            tile_pieces = [_polygonize_tile(*arg) for arg in args]
+
+        pieces = np.concatenate(tile_pieces)
+        piece_tiles = np.repeat(np.arange(len(tiles)), [len(p) for p in tile_pieces])
+
+        # pieces of different tiles sharing an edge on a seam belong to one enclosure,
+        # unless the edge is a barrier lying exactly on the seam
+        on_seam = ~shapely.contains_properly(tile_boxes[piece_tiles], pieces)
+        seam_idx = np.flatnonzero(on_seam)
+        left, right = shapely.STRtree(pieces[seam_idx]).query(pieces[seam_idx], predicate='touches')
+        left, right = seam_idx[left], seam_idx[right]
+        keep = (left < right) & (piece_tiles[left] != piece_tiles[right])
+        left, right = left[keep], right[keep]
+
+        shared = shapely.intersection(shapely.boundary(pieces[left]), shapely.boundary(pieces[right]))
+        keep = shapely.length(shared) > 0
+        left, right, shared = left[keep], right[keep], shared[keep]
+
+        # pieces touching along an edge and at a separate point share a collection, keep its lines
+        parts, part_idx = shapely.get_parts(shared, return_index=True)
+        is_line = shapely.get_type_id(parts) == 1
+        shared = shapely.multilinestrings(parts[is_line], indices=part_idx[is_line])
+
+        edge_idx, barrier_idx = shapely.STRtree(barriers).query(shared)
+        covered = np.bincount(
+            edge_idx, weights=shapely.length(shapely.intersection(shared[edge_idx], barriers[barrier_idx])), minlength=len(shared))
+        keep = shapely.length(shared) - covered > 1e-9
+        left, right = left[keep], right[keep]
+
+        graph = coo_matrix((np.ones(len(left)),(left,right)),shape=(len(pieces),len(pieces)))
+        _, labels = connected_components(graph, directed=False)
+
+        # order enclosures by their first piece, so that the result is deterministic
+        _, first_piece, labels = np.unique(labels, return_index=True, return_inverse=True)
+        order = np.argsort(first_piece)
+        labels = np.argsort(order)[labels]
+
+        enclosures = np.empty(len(first_piece), dtype=object)
+        counts = np.bincount(labels)
+        single = counts[labels] == 1
+        enclosures[labels[single]] = pieces[single]
+
+        # union pieces of every enclosure on a seam, grouping the pieces by label once
+        multi = np.flatnonzero(~single)
+        multi = multi[np.argsort(labels[multi], kind="stable")]
+        groups = np.split(pieces[multi], np.cumsum(counts[counts > 1])[:-1])
+        for label, group in zip(np.flatnonzero(counts > 1), groups):
+            enclosures[label] = shapely.union_all(group)
+
+        # clipping adds vertices where barriers cross seams, which are straight in EPSG:4326
+        # but change areas in a projected CRS, so they are dropped unless they are vertices of the input
+        seam_xs, seam_ys = xs[1:-1], ys[1:-1]
+        input_coords = shapely.get_coordinates(np.append(barriers, shapely.boundary(limit)))
+        input_coords = input_coords[np.isin(input_coords[:, 0], seam_xs) | np.isin(input_coords[:, 1], seam_ys)]
+        stitched = np.flatnonzero((counts > 1) & (shapely.get_type_id(enclosures) == 3))
+        enclosures[stitched] = _drop_seam_vertices(
+            enclosures[stitched], seam_xs, seam_ys, input_coords[:, 0] + 1j * input_coords[:, 1])
+
+        enclosures = gpd.GeoSeries(enclosures, crs=4326)
+        enclosures = enclosures.rename('geometry').reset_index()
+
+        return enclosures
+
+
     @staticmethod
     def _reindex_blocks(blocks):
         """
@@ -313,6 +661,122 @@ class CityModel:
         return blocks
     
     
+    def save(self, path):
+        """
+        Saves the model to a directory: a GeoParquet file with WKB geometry per layer
+        and a manifest with the local CRS and the list of layers.
+
+        Attributes
+        ----------
+        path: str
+            Directory to write to, created if missing. Files of a previous save are overwritten.
+        """
+
+        os.makedirs(path, exist_ok=True)
+
+        # layers are overwritten in place, so an interrupted save must not leave the previous manifest
+        # listing a mix of old and new layers
+        manifest_path = os.path.join(path, MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+
+        layers = {}
+        for layer in MODEL_LAYERS:
+            value = getattr(self, layer)
+            if value is None:
+                layers[layer] = None
+                continue
+
+            if layer == 'territory':
+                value = gpd.GeoDataFrame(geometry=[value], crs=4326)
+            elif layer in SERIES_LAYERS:
+                value = gpd.GeoDataFrame(geometry=value)
+
+            file = f'{layer}.parquet'
+            value.to_parquet(os.path.join(path, file))
+            layers[layer] = {
+                'file': file,
+                'rows': len(value),
+                'columns': list(value.columns),
+                'geometry': value.geometry.name}
+
+        manifest = {
+            'format_version': FORMAT_VERSION,
+            'local_crs': self.local_crs.to_string(),
+            'verbose': self.verbose,
+            'layers': layers}
+
+        # the manifest is written last and renamed into place, so an interrupted save is never loaded
+        utils.save_json(manifest, manifest_path + '.tmp')
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+
+    @classmethod
+    def load(cls, path, lazy=False):
+        """
+        Loads a model saved with `CityModel.save`.
+
+        Attributes
+        ----------
+        path: str
+            Directory of a saved model.
+
+        lazy: bool
+            Read layers from disk on first access instead of all at once.
+
+        Returns
+        -------
+        model: CityModel
+            Loaded model.
+        """
+
+        manifest = _read_manifest(path)
+        if manifest['format_version'] > FORMAT_VERSION:
+            raise ValueError(f"Unsupported format version: {manifest['format_version']}")
+
+        model = cls.__new__(cls)
+        model.verbose = manifest['verbose']
+        model.local_crs = CRS.from_user_input(manifest['local_crs'])
+
+        model._projection_cache = utils.ProjectionCache(model.local_crs)
+        model._blocks_tree = None
+        model._linked_blocks_generation = None
+
+        model._lazy_path = path
+        model._lazy_layers = set(MODEL_LAYERS)
+        if not lazy:
+            for layer in MODEL_LAYERS:
+                getattr(model, layer)
+
+        return model
+
+
+    def __getstate__(self):
+        # spatial indexes are rebuilt on demand instead of being pickled
+        state = self.__dict__.copy()
+        state['_blocks_tree'] = None
+        return state
+
+
+    def __getattr__(self, name):
+        # called only for missing attributes, i.e. layers of a lazily loaded model
+        lazy_layers = self.__dict__.get('_lazy_layers')
+        if not lazy_layers or name not in lazy_layers:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+        value = read_layer(self._lazy_path, name)
+        if value is not None:
+            if name == 'territory':
+                value = value.geometry.iloc[0]
+            elif name in SERIES_LAYERS:
+                value = value.geometry
+
+        lazy_layers.discard(name)
+        setattr(self, name, value)
+
+        return value
+
+
     def explore(self,column=None,cmap='Blues',attribute='blocks',tiles='CartoDB Positron'):
         """
         # TODO
@@ -1,11 +1,22 @@
+import heapq
+import math
+
 import dask_geopandas
 import geopandas as gpd
 import pandas as pd
 import numpy as np
+import shapely
 from shapely import MultiPoint
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree, Delaunay, QhullError
+from scipy.spatial.distance import cdist
 from sklearn.cluster import AgglomerativeClustering, MiniBatchKMeans
+from sklearn.neighbors import radius_neighbors_graph
+import instrumentation
 
 
+@instrumentation.instrument()
 def get_distance_matrix(geom): 
     """
     # TODO
@@ -26,7 +37,275 @@ def get_distance_matrix(geom):
     return distance_matrix
 
 
-def get_cluster_hulls(services, distance_limit=1000, link="average"):
+def get_sparse_distance_matrix(geom, distance_limit=1000):
+    """
+    Builds a sparse matrix of distances between points that are closer than a given limit.
+    
+    Attributes
+    ----------
+    geom: gpd.GeoSeries or gpd.GeoDataFrame
+        points in a projected metric CRS
+        
+    distance_limit: int or float
+        Maximum distance between points stored in the matrix.
+    
+    Returns
+    -------
+    distance_matrix: scipy.sparse.csr_matrix
+        Symmetric N×N matrix with distances between all pairs of points within `distance_limit`.
+    """
+    
+    coords = shapely.get_coordinates(geom.geometry.values)
+    
+    # coincident points are kept as explicit zeros so that they stay connected
+    distance_matrix = radius_neighbors_graph(
+        coords, radius=distance_limit, mode="distance", include_self=False)
+    
+    return distance_matrix.tocsr()
+
+
+# pairs of clusters whose statistics are computed in one vectorized batch are limited
+# to this many pairs of points, to bound memory
+MAX_BATCH_PAIRS = 2 ** 21
+
+# pairs of clusters with more pairs of points are computed one by one with `cdist`, which is faster on them
+MAX_FLAT_PAIRS = 256
+
+# number of times the distance limit is halved to get the radius of the first merging pass
+N_SCALES = 6
+
+
+def _get_cross_stat(coords, weights, a, b, link):
+    # sum of weighted distances between two sets of points for average linkage, maximum for complete linkage
+    res = 0.0
+    step = max(MAX_BATCH_PAIRS // len(b), 1)
+    for i in range(0, len(a), step):
+        distances = cdist(coords[a[i:i+step]], coords[b])
+        if link == "average":
+            res += weights[a[i:i+step]] @ distances @ weights[b]
+        else:
+            res = max(res, distances.max())
+
+    return res
+
+
+def _get_cross_stats(coords, weights, members, a, b, link):
+    # `_get_cross_stat` of many pairs of clusters, with all pairs of their points in flat arrays
+    n_a = np.array([len(members[i]) for i in a])
+    n_b = np.array([len(members[i]) for i in b])
+    n_pairs = n_a * n_b
+
+    res = np.zeros(len(a))
+    large = np.flatnonzero(n_pairs > MAX_FLAT_PAIRS)
+    for i in large:
+        res[i] = _get_cross_stat(coords, weights, members[a[i]], members[b[i]], link)
+
+    small = np.flatnonzero(n_pairs <= MAX_FLAT_PAIRS)
+    batch_ids = np.cumsum(n_pairs[small]) // MAX_BATCH_PAIRS
+    for batch in np.split(small, np.flatnonzero(np.diff(batch_ids)) + 1):
+        if len(batch) == 0:
+            continue
+        counts = n_pairs[batch]
+        pair = np.repeat(np.arange(len(batch)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        points_a = np.concatenate([members[i] for i in a[batch]])
+        points_b = np.concatenate([members[i] for i in b[batch]])
+        start_a = np.repeat(np.cumsum(n_a[batch]) - n_a[batch], counts)
+        start_b = np.repeat(np.cumsum(n_b[batch]) - n_b[batch], counts)
+        width = np.repeat(n_b[batch], counts)
+        i = points_a[start_a + local // width]
+        j = points_b[start_b + local % width]
+
+        distances = np.hypot(*(coords[i] - coords[j]).T)
+        if link == "average":
+            res[batch] = np.bincount(pair, weights=distances * weights[i] * weights[j], minlength=len(batch))
+        else:
+            res[batch] = np.maximum.reduceat(distances, np.cumsum(counts) - counts)
+
+    return res
+
+
+def _get_single_clusters(coords, distance_limit):
+    # single linkage clusters are components of the minimum spanning tree cut at the limit,
+    # and the Euclidean minimum spanning tree is a subgraph of the Delaunay triangulation
+    try:
+        triangulation = Delaunay(coords)
+        indptr, indices = triangulation.vertex_neighbor_vertices
+        # points too close to a vertex to be triangulated are linked to it
+        i = np.r_[np.repeat(np.arange(len(coords)), np.diff(indptr)), triangulation.coplanar[:, 0]]
+        j = np.r_[indices, triangulation.coplanar[:, 2]]
+    except (QhullError, ValueError):
+        # fewer than three points or all of them on a line
+        i, j = cKDTree(coords).query_pairs(distance_limit, output_type="ndarray").T
+
+    close = np.hypot(*(coords[i] - coords[j]).T) < distance_limit
+    graph = csr_matrix((np.ones(close.sum()), (i[close], j[close])), shape=(len(coords), len(coords)))
+
+    return connected_components(graph, directed=False)[1]
+
+
+def _get_reducible_clusters(coords, weights, distance_limit, link):
+    """
+    Average or complete linkage clusters of weighted points merged below a distance limit,
+    the same as a full linkage cut at the limit, without a full distance matrix.
+
+    Clusters are merged closest first in passes with the radius doubling up to the limit.
+    A pass only considers pairs of clusters whose centroids are closer than its radius,
+    as both linkages are never shorter than the distance between centroids.
+    Both linkages are reducible: a merged cluster is never closer to another one than both of its parts,
+    so candidates of a merged cluster are among candidates of its parts. Exact linkage distances of new pairs
+    are computed only when their lower bound is the shortest remaining one.
+    """
+
+    n = len(coords)
+    members = [np.array([i]) for i in range(n)]
+    size = list(weights.astype(float))
+    centroid_x = list(coords[:, 0])
+    centroid_y = list(coords[:, 1])
+    alive = [True] * n
+    average = link == "average"
+
+    def get_bound(i, j):
+        # the mean distance between two clusters is not shorter than the distance between their centroids
+        distance = math.hypot(centroid_x[i] - centroid_x[j], centroid_y[i] - centroid_y[j])
+        return distance * size[i] * size[j] if average else distance
+
+    for radius in distance_limit / 2.0 ** np.arange(N_SCALES, -1, -1):
+        ids = np.flatnonzero(alive)
+        centroids = np.c_[np.take(centroid_x, ids), np.take(centroid_y, ids)]
+        pairs = cKDTree(centroids).query_pairs(radius, output_type="ndarray")
+        a, b = ids[pairs[:, 0]], ids[pairs[:, 1]]
+
+        stats = _get_cross_stats(coords, weights, members, a, b, link)
+        values = stats / (np.take(size, a) * np.take(size, b)) if average else stats
+        close = values < radius
+
+        neighbors = {i: {} for i in ids.tolist()}
+        for i, j, stat in zip(a[close].tolist(), b[close].tolist(), stats[close].tolist()):
+            neighbors[i][j] = stat
+            neighbors[j][i] = stat
+
+        # entries are (linkage distance or its lower bound, whether it is exact, cluster, cluster)
+        heap = list(zip(values[close].tolist(), [True] * close.sum(), a[close].tolist(), b[close].tolist()))
+        heapq.heapify(heap)
+
+        while heap:
+            value, exact, i, j = heapq.heappop(heap)
+            if value >= radius:
+                break
+            if not (alive[i] and alive[j]) or j not in neighbors[i]:
+                continue
+
+            stat = neighbors[i][j]
+            if stat is None:
+                stat = _get_cross_stat(coords, weights, members[i], members[j], link)
+                value = stat / (size[i] * size[j]) if average else stat
+                if value < radius:
+                    neighbors[i][j] = neighbors[j][i] = stat
+                    heapq.heappush(heap, (value, True, i, j))
+                else:
+                    del neighbors[i][j], neighbors[j][i]
+                continue
+            if not exact:
+                continue
+
+            # merge i and j into a new cluster k
+            k = len(members)
+            members.append(np.concatenate([members[i], members[j]]))
+            size.append(size[i] + size[j])
+            centroid_x.append((size[i] * centroid_x[i] + size[j] * centroid_x[j]) / size[k])
+            centroid_y.append((size[i] * centroid_y[i] + size[j] * centroid_y[j]) / size[k])
+            alive.append(True)
+            alive[i] = alive[j] = False
+            members[i] = members[j] = None
+
+            neighbors_i, neighbors_j = neighbors.pop(i), neighbors.pop(j)
+            del neighbors_i[j], neighbors_j[i]
+            neighbors_k = neighbors[k] = {}
+            for c in neighbors_i.keys() | neighbors_j.keys():
+                neighbors_c = neighbors[c]
+                neighbors_c.pop(i, None)
+                neighbors_c.pop(j, None)
+                stat_i, stat_j = neighbors_i.get(c), neighbors_j.get(c)
+
+                if stat_i is not None and stat_j is not None:
+                    stat = stat_i + stat_j if average else max(stat_i, stat_j)
+                    value = stat / (size[k] * size[c]) if average else stat
+                    exact = True
+                else:
+                    # unknown parts are bounded by the distance between centroids
+                    if stat_i is None:
+                        stat_i = get_bound(i, c)
+                    if stat_j is None:
+                        stat_j = get_bound(j, c)
+                    value = max(
+                        (stat_i + stat_j) / (size[k] * size[c]) if average else max(stat_i, stat_j),
+                        math.hypot(centroid_x[k] - centroid_x[c], centroid_y[k] - centroid_y[c]))
+                    stat = None
+                    exact = False
+
+                if value < radius:
+                    neighbors_k[c] = neighbors_c[k] = stat
+                    heapq.heappush(heap, (value, exact, k, c))
+
+    labels = np.empty(n, dtype=int)
+    for label, i in enumerate(np.flatnonzero(alive)):
+        labels[members[i]] = label
+
+    return labels
+
+
+@instrumentation.instrument()
+def get_sparse_clusters(services, distance_limit=1000, link="average"):
+    """
+    Clusters points with single, average or complete linkage without a full distance matrix.
+
+    Labels are the same as of a full linkage with clusters merged while their linkage distance is
+    shorter than `distance_limit`, up to ties. Coincident points are merged first and clustered as one weighted point.
+    Single linkage clusters are components of Delaunay edges shorter than the limit.
+    Average and complete linkage merge clusters closest first in passes of a growing radius,
+    computing distances only between clusters whose centroids are closer than the radius.
+    Ward linkage can merge points without any close pair, so it is only available in the dense engine.
+    
+    Attributes
+    ----------
+    services: gpd.GeoDataFrame
+        services in a projected metric CRS
+        
+    distance_limit: int or float
+        Linkage distance threshold at or above which clusters will not be merged.
+    
+    link: str
+        Linkage criterion ("average", "complete" or "single").
+    
+    Returns
+    -------
+    labels: np.ndarray
+        Cluster label of every service.
+    """
+    
+    if link not in ["single", "average", "complete"]:
+        raise ValueError(f"The sparse engine does not support {link} linkage")
+    
+    coords = shapely.get_coordinates(services.geometry.values)
+    if len(coords) == 0:
+        return np.zeros(0, dtype=int)
+    
+    coords, inverse, weights = np.unique(coords, axis=0, return_inverse=True, return_counts=True)
+    
+    if link == "single":
+        labels = _get_single_clusters(coords, distance_limit)
+    else:
+        labels = _get_reducible_clusters(coords, weights.astype(float), distance_limit, link)
+    
+    # make labels consecutive
+    labels = np.unique(labels[inverse.reshape(-1)], return_inverse=True)[1]
+    
+    return labels
+
+
+@instrumentation.instrument()
+def get_cluster_hulls(services, distance_limit=1000, link="average", engine="dense"):
     """
     # TODO
     
@@ -37,26 +316,34 @@ def get_cluster_hulls(services, distance_limit=1000, link="average"):
     services: gpd.GeoDataFrame
         services in a projected metric CRS
     
+    engine: str
+        "dense" computes a full distance matrix with dask, 
+        "sparse" clusters without a distance matrix, with the same labels for single,
+        average and complete linkage (see `get_sparse_clusters`).
+    
     Returns
     -------
     # TODO
     """
     
-    distance_matrix = get_distance_matrix(services)
+    if engine == "dense":
+        distance_matrix = get_distance_matrix(services)
+        labels = AgglomerativeClustering(
+            n_clusters=None,metric="precomputed",distance_threshold=distance_limit,linkage=link).fit_predict(distance_matrix)
+    elif engine == "sparse":
+        labels = get_sparse_clusters(services, distance_limit=distance_limit, link=link)
+    else:
+        raise ValueError(f"Unknown clustering engine: {engine}")
     
     services = services.to_crs(4326)
-    services['cluster_id'] = AgglomerativeClustering(
-        n_clusters=None,metric="precomputed",distance_threshold=distance_limit,linkage=link).fit_predict(distance_matrix)
+    services['cluster_id'] = labels
 
     services_per_cluster = services.groupby(['cluster_id'])["geometry"].count()
+    services = services[services['cluster_id'].isin(services_per_cluster[services_per_cluster > 4].index)]
     
-    hulls = []
-    for cluster in services_per_cluster[services_per_cluster > 4].index:
-        hulls.append([cluster,services[services['cluster_id'] == cluster]["geometry"].unary_union.convex_hull])
-
-    cluster_polygons = gpd.GeoDataFrame(hulls)
-    cluster_polygons.columns = ['cluster_id', 'geometry']
-    cluster_polygons = cluster_polygons.set_geometry('geometry').set_crs(4326)
+    cluster_polygons = services[['cluster_id','geometry']].dissolve(by='cluster_id').convex_hull
+    cluster_polygons = gpd.GeoDataFrame(
+        {'cluster_id': cluster_polygons.index, 'geometry': cluster_polygons.values}, crs=4326)
     cluster_polygons = cluster_polygons[cluster_polygons.type == "Polygon"]
 
     return cluster_polygons
@@ -6,6 +6,11 @@ from osmnx.features import InsufficientResponseError
 from tqdm import tqdm
 from shapely import Polygon,MultiPolygon
 import shapely
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import fetch_cache
+import instrumentation
 
 
 service_tags = {
@@ -21,6 +26,28 @@ service_tags = {
     "shop": {"amenity": ["vending_machine", "marketplace"], "beauty": ["nails"], "shop": ["organic", "outdoor", "cheese", "hearing_aids", "interior_decoration", "anime", "window_blind", "scuba_diving", "deli", "video", "greengrocer", "bakery", "sports", "shoe_repair", "wine", "perfumery", "seafood", "boutique", "cannabis", "computer", "laundry", "nutrition_supplements", "erotic", "bag", "fabric", "mobile_phone", "frozen_food", "electronics", "farm", "art", "houseware", "beverages", "newsagent", "variety_store", "fishing", "craft", "weapons", "department_store", "water", "baby_goods", "tobacco", "fireplace", "herbalist", "wholesale", "coffee", "kiosk", "candles", "beauty", "hairdresser", "shoes", "toys", "appliance", "vacuum_cleaner", "furnace", "butcher", "doors", "party", "pyrotechnics", "health_food", "bathroom_furnishing", "stationery", "carpet", "doityourself", "bookmaker", "kitchen", "massage", "garden_centre", "tiles", "fashion", "water_sports", "security", "alcohol", "tea", "convenience", "games", "books", "funeral_directors", "hardware", "clothes", "hairdresser_supply", "music", "dry_cleaning", "second_hand", "paint", "copyshop", "sewing", "florist", "gift", "hifi", "pet_grooming", "bed", "spices", "ticket", "hunting", "e-cigarette", "pastry", "chocolate", "medical_supply", "fashion_accessories", "photo", "mall", "general", "cosmetics", "tattoo", "chemist", "watches", "electrical", "trade", "travel_agency", "gas", "curtain", "dairy", "video_games", "pet", "frame", "lighting", "jewelry", "storage_rental", "radiotechnics", "antiques", "lottery", "musical_instrument", "supermarket"]}}
 service_tags = pd.DataFrame(service_tags)
 
+road_tags = {
+    "highway": ["construction","crossing","living_street","motorway","motorway_link","motorway_junction","pedestrian","primary","primary_link","raceway","residential","road","secondary","secondary_link","services","tertiary","tertiary_link","track","trunk","trunk_link","turning_circle","turning_loop","unclassified",],
+    "service": ["living_street", "emergency_access"]
+}
+
+water_tags = {
+    'riverbank':True,  
+    'reservoir':True,  
+    'basin':True,  
+    'dock':True,  
+    'canal':True, 
+    'pond':True,
+    'natural':['water','bay'],
+    'waterway':['river','canal','ditch'],
+    'landuse':'basin'
+}
+
+railway_tags = {"railway": "rail"}
+
+# maximum number of concurrent Overpass requests of one fetch
+OVERPASS_WORKERS = int(os.environ.get('overpass_workers', 2))
+
 
 def fetch_territory(territory_name):
     
@@ -32,6 +59,8 @@ def fetch_territory(territory_name):
     return territory
 
 
+@instrumentation.instrument()
+@fetch_cache.cached
 def fetch_buildings(territory, express_mode=True):
     
     if type(territory) in [gpd.GeoDataFrame,gpd.GeoSeries]:
@@ -55,34 +84,9 @@ def fetch_buildings(territory, express_mode=True):
     return buildings
 
 
-def fetch_long_query(territory, tags, subdivision=3,verbose=True):
-    
-    if type(territory) in [gpd.GeoDataFrame,gpd.GeoSeries]:
-        territory = territory.unary_union
-        
-    cells = create_grid(territory,n_cells=subdivision) 
-    res_list = []
-    
-    for poly in tqdm(cells['geometry'],leave=False,disable=not verbose):
-        try: 
-            services_in_cell = ox.features_from_polygon(poly, tags)
-        except InsufficientResponseError: 
-            continue
-        except:
-            services_in_cell = fetch_long_query(poly,tags,subdivision)
-        
-        if len(services_in_cell) > 0: res_list.append(services_in_cell)
-   
-    res = pd.concat(res_list) if res_list else gpd.GeoDataFrame()
-    
-    return res
-
-
-def fetch_roads(territory):
-    tags = {
-        "highway": ["construction","crossing","living_street","motorway","motorway_link","motorway_junction","pedestrian","primary","primary_link","raceway","residential","road","secondary","secondary_link","services","tertiary","tertiary_link","track","trunk","trunk_link","turning_circle","turning_loop","unclassified",],
-        "service": ["living_street", "emergency_access"]
-    }
+@instrumentation.instrument()
+@fetch_cache.cached
+def fetch_roads(territory, tags=road_tags):
     
     if type(territory) in [gpd.GeoDataFrame,gpd.GeoSeries]:
         territory = territory.unary_union
@@ -101,22 +105,15 @@ def fetch_roads(territory):
     return roads
 
 
-def fetch_water(territory):
+@instrumentation.instrument()
+@fetch_cache.cached
+def fetch_water(territory, tags=water_tags):
     
     if type(territory) in [gpd.GeoDataFrame,gpd.GeoSeries]:
         territory = territory.unary_union
         
     try:
-        water = ox.features_from_polygon(
-            territory, {'riverbank':True,  
-                        'reservoir':True,  
-                        'basin':True,  
-                        'dock':True,  
-                        'canal':True, 
-                        'pond':True,
-                        'natural':['water','bay'],
-                        'waterway':['river','canal','ditch'],
-                        'landuse':'basin'})
+        water = ox.features_from_polygon(territory, tags)
         water = water.loc[water.geom_type.isin(
             ['Polygon','MultiPolygon','LineString','MultiLineString'])]
         
@@ -128,14 +125,16 @@ def fetch_water(territory):
         return
     
     
-def fetch_railways(territory):
+@instrumentation.instrument()
+@fetch_cache.cached
+def fetch_railways(territory, tags=railway_tags):
     
     if type(territory) in [gpd.GeoDataFrame,gpd.GeoSeries]:
         territory = territory.unary_union
         
     try:
         railway = ox.features_from_polygon(
-            territory, {"railway": "rail"}).reset_index(drop=True)
+            territory, tags).reset_index(drop=True)
         
         try:
             railway = railway.query('service not in ["crossover","siding","yard"]')
@@ -150,88 +149,358 @@ def fetch_railways(territory):
         return
     
 
-def create_grid(gdf=None, n_cells=5, crs=4326):
-    
-    if type(gdf) in [gpd.GeoDataFrame,gpd.GeoSeries]:
-        xmin, ymin, xmax, ymax= gdf.total_bounds
-    elif type(gdf) in [Polygon,MultiPolygon]:
-        xmin, ymin, xmax, ymax= gdf.bounds
+def _get_polygonal(geometry):
+    """
+    Returns only polygonal parts of geometries, empty geometries for the rest.
+    """
 
-    cell_size = (xmax-xmin)/n_cells
-    grid_cells = []
-    
-    for x0 in np.arange(xmin, xmax+cell_size, cell_size ):
-        for y0 in np.arange(ymin, ymax+cell_size, cell_size):
-            x1 = x0-cell_size
-            y1 = y0+cell_size
-            poly = shapely.geometry.box(x0, y0, x1, y1)
-            grid_cells.append(poly)
-
-    cells = gpd.GeoDataFrame(grid_cells, columns=['geometry'],crs=crs)
-    
-    if type(gdf) in [gpd.GeoDataFrame,gpd.GeoSeries]:
-        cells = gdf.overlay(cells,keep_geom_type=True)
-    elif type(gdf) in [Polygon,MultiPolygon]:
-        cells = gdf.intersection(cells)
-    
-    cells = cells[~cells.is_empty].set_crs(crs)
-    cells = cells[np.logical_or(
-        cells.type=='Polygon',cells.type=='MultiPolygon')]
-        
-    return cells
+    geometry = np.asarray(geometry, dtype=object).copy()
+    type_ids = shapely.get_type_id(geometry)
 
+    collections = np.flatnonzero(type_ids == 7)
+    for i in collections:
+        parts = shapely.get_parts(geometry[i])
+        parts = parts[np.isin(shapely.get_type_id(parts), [3, 6])]
+        geometry[i] = shapely.union_all(parts)
+
+    type_ids[collections] = shapely.get_type_id(geometry[collections])
+    geometry[~np.isin(type_ids, [3, 6])] = shapely.Polygon()
+
+    return geometry
+
+
+def create_grid(gdf=None, n_cells=5, crs=4326, cell_size=None, projected_crs=None):
+    """
+    Splits geometries by a regular grid.
+
+    Attributes
+    ----------
+    gdf: gpd.GeoDataFrame or gpd.GeoSeries or Polygon or MultiPolygon
+        Geometries to split.
+
+    n_cells: int
+        Number of cells along the x axis. Cells are square in degrees.
+
+    crs: int or str
+        CRS of `gdf` if it is a shapely geometry.
+
+    cell_size: float or None
+        Size of square cells in meters. Overrides `n_cells`.
+
+    projected_crs: int or str or None
+        CRS in which square cells of `cell_size` are built. Defaults to the local UTM zone.
+
+    Returns
+    -------
+    cells: gpd.GeoDataFrame
+        Polygonal parts of geometries within every cell with attributes of the GeoDataFrame.
+    """
+
+    if type(gdf) in [Polygon,MultiPolygon]:
+        gdf = gpd.GeoDataFrame(geometry=[gdf],crs=crs)
+    elif type(gdf) == gpd.GeoSeries:
+        gdf = gpd.GeoDataFrame(geometry=gdf)
+
+    crs = gdf.crs if gdf.crs is not None else crs
+    gdf = gdf.set_crs(crs).reset_index(drop=True)
+
+    if cell_size is not None:
+        if projected_crs is None:
+            projected_crs = gdf.estimate_utm_crs()
+        gdf = gdf.to_crs(projected_crs)
+
+    xmin, ymin, xmax, ymax = gdf.total_bounds
+    if cell_size is None:
+        cell_size = (xmax-xmin)/n_cells
+
+    # numbers of cells are rounded first, so that float error in the bounds does not add a row of slivers
+    n_x = max(int(np.ceil(round((xmax-xmin)/cell_size, 9))), 1)
+    n_y = max(int(np.ceil(round((ymax-ymin)/cell_size, 9))), 1)
+    x0, y0 = np.meshgrid(xmin + cell_size*np.arange(n_x), ymin + cell_size*np.arange(n_y), indexing='ij')
+    grid_cells = shapely.box(x0.ravel(), y0.ravel(), x0.ravel()+cell_size, y0.ravel()+cell_size)
+
+    # clip only pairs with intersecting bounding boxes, and cells not fully within geometries
+    geometry = gdf.geometry.values
+    geom_idx, cell_idx = shapely.STRtree(grid_cells).query(geometry)
+    order = np.lexsort((cell_idx, geom_idx))
+    geom_idx, cell_idx = geom_idx[order], cell_idx[order]
+
+    shapely.prepare(geometry)
+    within = shapely.contains_properly(geometry[geom_idx], grid_cells[cell_idx])
+    clipped = grid_cells[cell_idx].copy()
+    clipped[~within] = _get_polygonal(shapely.intersection(geometry[geom_idx[~within]], grid_cells[cell_idx[~within]]))
+
+    cells = gdf.drop(columns=gdf.geometry.name).iloc[geom_idx].reset_index(drop=True)
+    cells = gpd.GeoDataFrame(cells, geometry=clipped, crs=gdf.crs)
+    cells = cells[~cells.is_empty].reset_index(drop=True)
+
+    return cells.to_crs(crs)
+
+
+def _fetch_cell(fetch, cell, tags, max_retries, backoff):
+    """
+    Fetches features of one cell, retrying failed requests with exponential backoff.
+    Returns the features (None if there are none) or the last exception.
+    """
+
+    for attempt in range(max_retries + 1):
+        try:
+            return fetch(cell, tags)
+        except InsufficientResponseError:
+            return None
+        except Exception as e:
+            error = e
+            if attempt < max_retries:
+                time.sleep(backoff * 2 ** attempt)
+
+    return error
+
+
+def fetch_long_query(
+        territory, tags, subdivision=3, verbose=True, max_workers=OVERPASS_WORKERS,
+        max_retries=2, backoff=1, max_features=None, max_depth=4, fetch=None):
+    """
+    Fetches features of a large territory cell by cell with a bounded number of concurrent requests.
+
+    Cells that keep failing after retries, or return more than `max_features` features,
+    are split into four and fetched again. Features intersecting several cells are returned once.
+
+    Attributes
+    ----------
+    territory: gpd.GeoDataFrame or Polygon or MultiPolygon
+        Territory to fetch features for.
+
+    tags: dict
+        OSM tags as in `ox.features_from_polygon`.
+
+    subdivision: int
+        Number of initial grid cells along each axis.
+
+    max_workers: int
+        Maximum number of concurrent requests.
+
+    max_retries: int
+        Number of retries of a failed request before its cell is split.
+
+    backoff: float
+        Delay before the first retry in seconds, doubled on every next one.
+
+    max_features: int or None
+        Feature budget of one cell. Larger cells are split, as their response
+        is likely to be truncated by the server.
+
+    max_depth: int
+        Maximum number of splits of an initial cell. A cell failing at this depth raises an error.
+
+    fetch: callable or None
+        Function with the signature of `ox.features_from_polygon`, e.g. a mock for offline tests.
+
+    Returns
+    -------
+    res: gpd.GeoDataFrame
+        Unique features of the territory.
+    """
 
-def fetch_long_query(territory, tags, subdivision=3,verbose=True):
-    
     if type(territory) in [gpd.GeoDataFrame,gpd.GeoSeries]:
         territory = territory.unary_union
-    
-    cells = create_grid(territory,n_cells=subdivision) 
+
+    if fetch is None:
+        fetch = ox.features_from_polygon
+
+    cells = [(cell, 0) for cell in create_grid(territory,n_cells=subdivision)['geometry']]
     res_list = []
-    
-    for poly in tqdm(cells['geometry'],leave=False,disable=not verbose):
-        try: 
-            objects_in_cell = ox.features_from_polygon(poly, tags)
-        except InsufficientResponseError: 
-            continue
-        except:
-            objects_in_cell = fetch_long_query(poly,tags,subdivision)
-        
-        if len(objects_in_cell) > 0: res_list.append(objects_in_cell)
-   
+
+    pbar = tqdm(total=len(cells),leave=False,disable=not verbose)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_fetch_cell, fetch, cell, tags, max_retries, backoff): (cell, depth) for cell, depth in cells}
+
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                cell, depth = futures.pop(future)
+                features = future.result()
+                pbar.update()
+
+                too_large = max_features is not None and features is not None \
+                    and not isinstance(features, Exception) and len(features) > max_features
+
+                if isinstance(features, Exception) or too_large:
+                    if depth >= max_depth:
+                        if too_large:
+                            res_list.append(features)
+                            continue
+                        for pending in futures:
+                            pending.cancel()
+                        raise RuntimeError(f"Failed to fetch a cell after {max_depth} splits") from features
+
+                    subcells = create_grid(cell,n_cells=2)['geometry']
+                    pbar.total += len(subcells)
+                    for subcell in subcells:
+                        futures[executor.submit(_fetch_cell, fetch, subcell, tags, max_retries, backoff)] = (subcell, depth + 1)
+
+                elif features is not None and len(features) > 0:
+                    res_list.append(features)
+    pbar.close()
+
     res = pd.concat(res_list) if res_list else gpd.GeoDataFrame()
-    
+
+    # features crossing cell borders are returned for every cell they intersect
+    res = res[~res.index.duplicated()]
+
     return res
 
 
-def fetch_services(territory, service_tags=service_tags,subdivision=3,verbose=True):
+def get_service_tags_union(service_tags=service_tags):
+    """
+    Returns tags of all service categories merged into one osmnx tags dict.
+    """
+
+    union = {}
+    for category in service_tags.columns:
+        for key, values in service_tags[category].dropna().items():
+            union.setdefault(key, [])
+            union[key] += [value for value in values if value not in union[key]]
+
+    return union
+
+
+def classify_services(features, service_tags=service_tags):
+    """
+    Splits OSM features into service categories.
+
+    A feature gets a category if any of its tags matches the category's tags,
+    and is repeated once per matched category.
+
+    Attributes
+    ----------
+    features: pd.DataFrame
+        Features with OSM tags in columns, e.g. returned by `ox.features_from_polygon`.
+
+    service_tags: pd.DataFrame
+        Lists of tag values by key (index) and category (columns).
+
+    Returns
+    -------
+    services: gpd.GeoDataFrame
+        Services with `name`, `geometry`, `tags` (values of the category's keys) and `category` columns.
+    """
+
+    features = features.reset_index(drop=True)
+
+    # (category, key, value) of every tag of every category
+    rules = service_tags.stack().dropna().explode().reset_index()
+    rules.columns = ['key', 'category', 'value']
+    rules['order'] = rules['category'].map({category: i for i, category in enumerate(service_tags.columns)})
+
+    keys = [key for key in service_tags.index if key in features.columns]
+    feature_tags = features[keys].stack().dropna().reset_index()
+    feature_tags.columns = ['feature', 'key', 'value']
+
+    # features with at least one tag of a category
+    matches = feature_tags.merge(rules, on=['key', 'value'])[['feature', 'category', 'order']].drop_duplicates()
+
+    # values of all keys of a matched category
+    category_keys = rules[['category', 'key']].drop_duplicates()
+    key_order = {key: i for i, key in enumerate(service_tags.index)}
+    category_keys = category_keys.assign(key_order=category_keys['key'].map(key_order))
+    tags = matches.merge(category_keys, on='category').merge(feature_tags, on=['feature', 'key'])
+    tags = tags.sort_values(['order', 'feature', 'key_order'])
+    group_starts = np.flatnonzero(
+        (np.diff(tags['order'].to_numpy()) != 0) | (np.diff(tags['feature'].to_numpy()) != 0)) + 1
+    tags = [list(values) for values in np.split(tags['value'].to_numpy(dtype=object), group_starts)] if len(tags) else []
+
+    # every match has at least its matched tag, so both are in the same order
+    matches = matches.sort_values(['order', 'feature'])
+    columns = ['name', 'geometry'] if 'name' in features else ['geometry']
+    services = features.loc[matches['feature'], columns].reset_index(drop=True)
+    services['tags'] = tags
+    services['category'] = matches['category'].values
+
+    return gpd.GeoDataFrame(services, geometry='geometry', crs=4326)
+
+
+def get_centroids(geometry):
+    """
+    Returns centroids of geometries calculated in EPSG:3857. Points are kept as they are
+    and only other geometries are reprojected.
+    """
+
+    is_point = (geometry.geom_type == 'Point').values
+    centroids = geometry.copy()
+    if not is_point.all():
+        centroids[~is_point] = geometry[~is_point].to_crs(3857).centroid.to_crs(4326)
+
+    return centroids
+
+
+@instrumentation.instrument()
+@fetch_cache.cached
+def fetch_services(territory, service_tags=service_tags,subdivision=3,verbose=True,combined=True):
+    """
+    Fetches services of a territory from OSM.
+
+    Attributes
+    ----------
+    territory: gpd.GeoDataFrame or Polygon or MultiPolygon
+        Territory to fetch services for.
+
+    service_tags: pd.DataFrame
+        Lists of tag values by key (index) and category (columns).
+
+    subdivision: int
+        Number of grid cells along each axis used by `fetch_long_query` for too large requests.
+
+    combined: bool
+        Fetch the tags of all categories with one query and split the features into
+        categories locally. Otherwise every category is fetched with a separate query.
+
+    Returns
+    -------
+    services: gpd.GeoDataFrame
+        Service centroids with `name`, `geometry`, `tags` and `category` columns.
+    """
 
     if type(territory) in [gpd.GeoDataFrame,gpd.GeoSeries]:
         territory = territory.unary_union
-        
+
     res_list = []
-    
-    for category in tqdm(service_tags.columns, disable=not verbose):
-        tags = dict(service_tags[category].dropna())
 
-        try: 
-            services_temp = ox.features_from_polygon(territory,tags)    
-        except InsufficientResponseError: 
-            continue
+    if combined:
+        tags = get_service_tags_union(service_tags)
+
+        try:
+            features = ox.features_from_polygon(territory,tags)
+        except InsufficientResponseError:
+            features = None
         except:
-            services_temp = fetch_long_query(territory,tags,subdivision)
-            
-        good_keys = list(set(tags.keys()).intersection(services_temp.columns))
-        services_temp_tags = services_temp[good_keys].reset_index(drop=True).apply(lambda x: list(x.dropna()), axis=1)
-        services_geometry = services_temp[['name','geometry'] if 'name' in services_temp else ['geometry']].reset_index(drop=True)
-        
-        services_temp = pd.concat([services_geometry,services_temp_tags],axis=1).reset_index(drop=True)
-        services_temp["category"] = category
-        services_temp = services_temp.rename(columns={0: "tags"})
-        res_list.append(services_temp)
+            features = fetch_long_query(territory,tags,subdivision,verbose=verbose)
+
+        if features is not None and len(features) > 0:
+            res_list.append(classify_services(features,service_tags))
+
+    else:
+        for category in tqdm(service_tags.columns, disable=not verbose):
+            tags = dict(service_tags[category].dropna())
+
+            try:
+                services_temp = ox.features_from_polygon(territory,tags)
+            except InsufficientResponseError:
+                continue
+            except:
+                services_temp = fetch_long_query(territory,tags,subdivision)
+
+            good_keys = list(set(tags.keys()).intersection(services_temp.columns))
+            services_temp_tags = services_temp[good_keys].reset_index(drop=True).apply(lambda x: list(x.dropna()), axis=1)
+            services_geometry = services_temp[['name','geometry'] if 'name' in services_temp else ['geometry']].reset_index(drop=True)
+
+            services_temp = pd.concat([services_geometry,services_temp_tags],axis=1).reset_index(drop=True)
+            services_temp["category"] = category
+            services_temp = services_temp.rename(columns={0: "tags"})
+            res_list.append(services_temp)
 
     res = pd.concat(res_list) if res_list else gpd.GeoDataFrame()
-    res["geometry"] = res.to_crs(3857)["geometry"].centroid.to_crs(4326)
+    res["geometry"] = get_centroids(res.geometry)
     res = res.reset_index(drop=True)
 
-    return res
\ No newline at end of file
+    return res
@@ -1,8 +1,14 @@
 import warnings
 import psycopg2
+import psycopg2.pool
 from dotenv import load_dotenv
 import os 
+import threading
+from contextlib import contextmanager
 import geopandas as gpd
+import numpy as np
+import shapely
+import io
 warnings.filterwarnings('ignore',category=UserWarning)
 
 import pandas as pd
@@ -17,11 +23,164 @@ load_dotenv()
 
 HOST='localhost'
 PORT=5432
-DBNAME='urban_scaling_db_02'
+DBNAME=os.environ.get('dbname','urban_scaling_db_02')
 
 USER=os.environ.get('user')
 PASSWORD=os.environ.get('password')
 
+# maximum number of open connections per database and process
+POOL_SIZE=int(os.environ.get('pool_size',10))
+
+# table and sequence expression for every ID column allocated by reserve_ids
+ID_SEQUENCES = {
+    'block_id': ('block', "pg_get_serial_sequence('block', 'block_id')"),
+    'service_id': ('service', "pg_get_serial_sequence('service', 'service_id')"),
+    'cluster_id': ('block', "'cluster_id_seq'"),
+}
+
+# foreign keys that can be dropped for the time of an initial bulk load
+FOREIGN_KEYS = {
+    ('road', 'fk_city'): 'FOREIGN KEY(city_id) REFERENCES city(city_id) ON DELETE CASCADE',
+    ('railway', 'fk_city'): 'FOREIGN KEY(city_id) REFERENCES city(city_id) ON DELETE CASCADE',
+    ('water', 'fk_city'): 'FOREIGN KEY(city_id) REFERENCES city(city_id) ON DELETE CASCADE',
+    ('block', 'fk_city'): 'FOREIGN KEY(city_id) REFERENCES city(city_id) ON DELETE CASCADE',
+    ('service', 'fk_city'): 'FOREIGN KEY(city_id) REFERENCES city(city_id) ON DELETE CASCADE',
+    ('service', 'fk_block'): 'FOREIGN KEY(block_id) REFERENCES block(block_id) ON DELETE CASCADE',
+    ('servicetag', 'fk_service'): 'FOREIGN KEY(service_id) REFERENCES service(service_id) ON DELETE CASCADE',
+    ('servicetag', 'fk_tag'): 'FOREIGN KEY(tag_id) REFERENCES tag(tag_id) ON DELETE CASCADE',
+}
+
+_pools = {}
+_engines = {}
+_pools_lock = threading.Lock()
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of psycopg2 connections to one database.
+    
+    Unlike `psycopg2.pool.ThreadedConnectionPool`, waits for a free connection 
+    instead of raising when all `maxconn` connections are checked out.
+    """
+    
+    def __init__(self, maxconn=POOL_SIZE, **connection_params):
+        self._pool = psycopg2.pool.ThreadedConnectionPool(0, maxconn, **connection_params)
+        self._semaphore = threading.BoundedSemaphore(maxconn)
+        
+    def getconn(self):
+        self._semaphore.acquire()
+        try:
+            return self._pool.getconn()
+        except:
+            self._semaphore.release()
+            raise
+            
+    def putconn(self, connection, close=False):
+        try:
+            self._pool.putconn(connection, close=close or bool(connection.closed))
+        finally:
+            self._semaphore.release()
+            
+    def closeall(self):
+        self._pool.closeall()
+        
+
+def _reset_pools_after_fork():
+    # connections and engines inherited from the parent process share its sockets,
+    # so the child forgets them without closing and opens its own ones
+    global _pools, _pools_lock
+    _pools = {}
+    _pools_lock = threading.Lock()
+    for engine in _engines.values():
+        engine.dispose(close=False)
+        
+
+os.register_at_fork(after_in_child=_reset_pools_after_fork)
+
+
+def get_pool(
+    host=HOST,
+    port=PORT,
+    user=USER,
+    dbname=DBNAME,
+    password=PASSWORD):
+    """
+    Returns a process-wide connection pool for given connection parameters.
+    """
+    
+    key = (host, port, user, dbname)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(
+                maxconn=POOL_SIZE, host=host, port=port, user=user, dbname=dbname, password=password)
+        return _pools[key]
+    
+    
+@contextmanager
+def connection(
+    host=HOST,
+    port=PORT,
+    user=USER,
+    dbname=DBNAME,
+    password=PASSWORD,
+    autocommit=True):
+    """
+    Checks out a pooled connection for the duration of a `with` block.
+    
+    Without autocommit, the transaction is committed when the block exits
+    and rolled back if it raises.
+    """
+    
+    pool = get_pool(host=host, port=port, user=user, dbname=dbname, password=password)
+    conn = pool.getconn()
+    broken = False
+    try:
+        conn.autocommit = autocommit
+        yield conn
+        if not autocommit:
+            conn.commit()
+    except psycopg2.OperationalError:
+        broken = True
+        raise
+    except:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn, close=broken)
+        
+
+def get_engine(
+    host=HOST,
+    port=PORT,
+    user=USER,
+    dbname=DBNAME,
+    password=PASSWORD):
+    """
+    Returns a process-wide SQLAlchemy engine for given connection parameters.
+    """
+    
+    key = (host, port, user, dbname)
+    with _pools_lock:
+        if key not in _engines:
+            _engines[key] = create_engine(
+                f'postgresql://{user}:{password}@{host}:{port}/{dbname}',
+                pool_size=POOL_SIZE, max_overflow=0, pool_pre_ping=True)
+        return _engines[key]
+    
+    
+def close_connections(dbname=None):
+    """
+    Closes pooled connections of the current process, to all databases or to a given one.
+    """
+    
+    with _pools_lock:
+        for key in [key for key in _pools if dbname is None or key[3] == dbname]:
+            _pools.pop(key).closeall()
+        for key in [key for key in _engines if dbname is None or key[3] == dbname]:
+            _engines.pop(key).dispose()
+        
+
 def init_db(dbname=DBNAME):
     create_urban_scaling_db(dbname=dbname)
     create_city_table()
@@ -32,6 +191,7 @@ def init_db(dbname=DBNAME):
     create_service_table()
     create_tag_table()
     create_servicetag_table()
+    create_id_sequences()
     
     populate_cities_table()
     populate_tags_table()
@@ -44,6 +204,7 @@ def drop_db(
     dbname=DBNAME,
     password=PASSWORD):
     
+    close_connections(dbname=dbname)
     post_query(f'DROP DATABASE {dbname}',dbname=None)
     
     
@@ -55,26 +216,13 @@ def post_query(
     dbname=DBNAME,
     password=PASSWORD):
     
-    connection = psycopg2.connect(
-        host=host,
-        port=port,
-        user=user,
-        dbname=dbname,
-        password=password)
-    connection.autocommit = True
-    
-    cursor = connection.cursor()
-
-    try:
-        if type(query) == list:
-            for q in query:
-                cursor.execute(q)
-        else:
-            cursor.execute(query)
-            
-    finally:
-        cursor.close()
-        connection.close()
+    with connection(host=host, port=port, user=user, dbname=dbname, password=password) as conn:
+        with conn.cursor() as cursor:
+            if type(query) == list:
+                for q in query:
+                    cursor.execute(q)
+            else:
+                cursor.execute(query)
         
 
 def get_query(
@@ -85,31 +233,78 @@ def get_query(
     dbname=DBNAME,
     password=PASSWORD,
     geom=None):
-    
-    connection = psycopg2.connect(
-        host=host,
-        port=port,
-        user=user,
-        dbname=dbname,
-        password=password)
         
     if geom is None and 'geom' in query:
         geom=True
     
-    if geom:
-        res = gpd.read_postgis(query,con=connection,geom_col='geometry',crs=4326)
-        return res
+    with connection(host=host, port=port, user=user, dbname=dbname, password=password) as conn:
+        if geom:
+            res = gpd.read_postgis(query,con=conn,geom_col='geometry',crs=4326)
+        else:
+            res = pd.read_sql(query,con=conn)
     
-    res = pd.read_sql(query,con=connection)
+    return res
+
+
+def copy_tables(
+    tables,
+    host=HOST,
+    port=PORT,
+    user=USER,
+    dbname=DBNAME,
+    password=PASSWORD):
+    """
+    Appends DataFrames to database tables with COPY in a single transaction.
+    
+    Rows are streamed as CSV, geometries as hex-encoded EWKB with SRID 4326.
+    If any table fails, nothing is written.
+    
+    Attributes
+    ----------
+    tables: list
+        List of (table name, pd.DataFrame or gpd.GeoDataFrame) pairs. 
+        DataFrame columns must match table columns.
+    """
+    
+    with connection(host=host, port=port, user=user, dbname=dbname, password=password, autocommit=False) as conn:
+        with conn.cursor() as cursor:
+            for table, df in tables:
+                buffer = _to_copy_buffer(df)
+                cursor.copy_expert(
+                    f"COPY {table} ({', '.join(df.columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+        
+        
+def _to_copy_buffer(df):
+    """
+    Serializes a DataFrame to an in-memory CSV readable by COPY.
+    """
+    
+    df = pd.DataFrame(df).copy()
+    for column in df.columns:
+        if isinstance(df[column].dtype, gpd.array.GeometryDtype):
+            df[column] = shapely.to_wkb(
+                shapely.set_srid(df[column].values, 4326), hex=True, include_srid=True)
+    
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    
+    return buffer
+
+
+def drop_foreign_keys():
+    post_query([f'ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {name}' 
+                for table, name in FOREIGN_KEYS])
     
-    connection.close()
     
-    return res
+def create_foreign_keys():
+    post_query([f'ALTER TABLE {table} ADD CONSTRAINT {name} {definition}' 
+                for (table, name), definition in FOREIGN_KEYS.items()])
 
 
 def create_urban_scaling_db(dbname=DBNAME):
     post_query(f"CREATE DATABASE {dbname};",dbname=None)
-    post_query('CREATE EXTENSION postgis')
+    post_query('CREATE EXTENSION postgis',dbname=dbname)
     
 
 def create_city_table():
@@ -167,7 +362,7 @@ def create_water_table():
 def create_block_table():
     post_query("""
         CREATE TABLE IF NOT EXISTS block (
-            block_id INT PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
+            block_id INT PRIMARY KEY GENERATED BY DEFAULT AS IDENTITY,
             city_id INT,
             cluster_id INT,
             population INT,
@@ -183,7 +378,7 @@ def create_block_table():
 def create_service_table():
     post_query("""
         CREATE TABLE IF NOT EXISTS service (
-            service_id INT PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
+            service_id INT PRIMARY KEY GENERATED BY DEFAULT AS IDENTITY,
             city_id INT,
             block_id INT,
             name VARCHAR(255),
@@ -224,6 +419,60 @@ def create_servicetag_table():
         """)
     
     
+def create_id_sequences():
+    """
+    Prepares sequences used by `reserve_ids`. 
+    
+    `cluster_id` is not a primary key, so it gets its own sequence. Identity columns 
+    of `block` and `service` are switched to BY DEFAULT, so that IDs reserved 
+    from their sequences can be inserted explicitly. Safe to run on an existing database.
+    """
+    
+    queries = [
+        "CREATE SEQUENCE IF NOT EXISTS cluster_id_seq",
+        "ALTER TABLE block ALTER COLUMN block_id SET GENERATED BY DEFAULT",
+        "ALTER TABLE service ALTER COLUMN service_id SET GENERATED BY DEFAULT",
+        ]
+    
+    # move sequences past IDs that were inserted explicitly (never backwards)
+    for column, (table, sequence) in ID_SEQUENCES.items():
+        queries.append(f"""
+            SELECT setval({sequence}, max_id) 
+            FROM (SELECT MAX({column}) AS max_id FROM {table}) t
+            WHERE max_id > COALESCE(pg_sequence_last_value({sequence}::regclass), 0)
+            """)
+    
+    post_query(queries)
+    
+    
+def reserve_ids(**counts):
+    """
+    Reserves IDs from database sequences in a single round-trip.
+    
+    Values taken with `nextval` are never returned twice, so several writers 
+    can reserve IDs concurrently without collisions. IDs of a failed push are not reused.
+    
+    Attributes
+    ----------
+    **counts: int
+        Number of IDs to reserve per ID column, e.g. `block_id=100, cluster_id=10`. 
+        Supported columns are the keys of `ID_SEQUENCES`.
+        
+    Returns
+    -------
+    ids: dict
+        Arrays of reserved IDs per ID column.
+    """
+    
+    columns = [f"ARRAY(SELECT nextval({ID_SEQUENCES[column][1]}) FROM generate_series(1, {int(n)})) AS {column}" 
+               for column, n in counts.items()]
+    res = get_query(f"SELECT {', '.join(columns)}", geom=False)
+    
+    ids = {column: np.array(res[column][0], dtype=int) for column in counts}
+    
+    return ids
+    
+    
 def populate_tags_table(
     service_tags_path='service_tags.json',
     host=HOST,
@@ -238,13 +487,10 @@ def populate_tags_table(
     tags = pd.Series({col:service_tags[col].dropna().sum() for col in service_tags.columns}).explode().reset_index()
     tags.columns = ['category','name']
     
-    engine = create_engine(
-        f'postgresql://{user}:{password}@{host}:{port}/{dbname}')
+    engine = get_engine(host=host, port=port, user=user, dbname=dbname, password=password)
     
     tags.to_sql('tag',con=engine,if_exists='append',index=False)
     
-    engine.dispose()
-    
     
 def populate_cities_table(
     cities_df_path='agglomerations.geojson',
@@ -254,13 +500,10 @@ def populate_cities_table(
     dbname=DBNAME,
     password=PASSWORD):
     
-    engine = create_engine(
-        f'postgresql://{user}:{password}@{host}:{port}/{dbname}')
+    engine = get_engine(host=host, port=port, user=user, dbname=dbname, password=password)
     
     agglomerations = gpd.read_file(cities_df_path)
     agglomerations.to_postgis('city',con=engine,if_exists='append')
-    
-    engine.dispose()
   
     
 def create_shannon_diversity_view():
@@ -0,0 +1,207 @@
+import contextlib
+import functools
+import hashlib
+import inspect
+import json
+import os
+import time
+import uuid
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# the cache is disabled unless a directory is set here, in the environment or with `configure`
+CACHE_DIR = os.environ.get('osm_cache_dir')
+TTL = float(os.environ.get('osm_cache_ttl', 30 * 24 * 3600))
+MAX_SIZE = int(os.environ.get('osm_cache_max_size', 10 * 1024 ** 3))
+
+# parameters that do not change the result of a fetch
+IGNORED_PARAMS = {'verbose'}
+
+
+def configure(cache_dir=None, ttl=None, max_size=None):
+    """
+    Sets up the cache of fetched OSM data.
+
+    Attributes
+    ----------
+    cache_dir: str or None
+        Directory with cached GeoParquet files. None disables the cache.
+
+    ttl: int or float or None
+        Time in seconds after which cached results are refetched. None keeps the current value.
+
+    max_size: int or None
+        Maximum total size of cached files in bytes. None keeps the current value.
+    """
+
+    global CACHE_DIR, TTL, MAX_SIZE
+    CACHE_DIR = cache_dir
+    if ttl is not None:
+        TTL = ttl
+    if max_size is not None:
+        MAX_SIZE = max_size
+
+
+def _hash_territory(territory):
+    if type(territory) in [gpd.GeoDataFrame, gpd.GeoSeries]:
+        territory = territory.unary_union
+    return hashlib.sha256(shapely.to_wkb(shapely.normalize(territory))).hexdigest()
+
+
+def _serialize_param(value):
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return value.to_json()
+    if isinstance(value, shapely.Geometry):
+        return shapely.to_wkb(value, hex=True)
+    return str(value)
+
+
+def get_cache_key(func, *args, **kwargs):
+    """
+    Returns a key of a fetch call: a hash of the function name, the territory geometry
+    and all other parameters (including default tags) except `IGNORED_PARAMS`.
+
+    Attributes
+    ----------
+    func: callable
+        Fetch function whose first parameter is a territory.
+
+    *args, **kwargs
+        Arguments of the call.
+
+    Returns
+    -------
+    key: str
+        Hex digest identifying the call.
+    """
+
+    bound = inspect.signature(func).bind(*args, **kwargs)
+    bound.apply_defaults()
+    arguments = dict(bound.arguments)
+    territory = arguments.pop(next(iter(arguments)))
+
+    params = {name: value for name, value in arguments.items() if name not in IGNORED_PARAMS}
+    payload = json.dumps(
+        [func.__name__, _hash_territory(territory), params], sort_keys=True, default=_serialize_param)
+
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _get_path(key):
+    return os.path.join(CACHE_DIR, f'{key}.parquet')
+
+
+def load(key):
+    """
+    Returns a cached result or None if it is missing or expired.
+    """
+
+    path = _get_path(key)
+    try:
+        if time.time() - os.path.getmtime(path) > TTL:
+            os.remove(path)
+            return None
+
+        # access time is used for eviction
+        os.utime(path, (time.time(), os.path.getmtime(path)))
+        res = gpd.read_parquet(path)
+    except FileNotFoundError:
+        # missing or evicted by another process
+        return None
+
+    # lists are read back as arrays
+    for column in res.columns:
+        if res[column].dtype == object and res[column].map(lambda x: isinstance(x, np.ndarray)).any():
+            res[column] = res[column].map(lambda x: list(x) if isinstance(x, np.ndarray) else x)
+
+    return res
+
+
+def save(key, gdf):
+    """
+    Writes a result to the cache and evicts old files if the cache is too large.
+    """
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+
+    # write to a temporary file first so that parallel workers never read a partial file
+    temp_path = os.path.join(CACHE_DIR, f'{key}.{uuid.uuid4().hex}.tmp')
+    gdf.to_parquet(temp_path)
+    os.replace(temp_path, _get_path(key))
+
+    evict()
+
+
+def store(func, result, *args, **kwargs):
+    """
+    Puts a result of a fetch call into the cache, e.g. to prepare offline runs and tests.
+    """
+
+    save(get_cache_key(func, *args, **kwargs), result)
+
+
+def evict():
+    """
+    Removes expired files, then least recently used files until the cache fits into `MAX_SIZE`.
+    """
+
+    if CACHE_DIR is None or not os.path.isdir(CACHE_DIR):
+        return
+
+    now = time.time()
+    files = []
+    for entry in os.scandir(CACHE_DIR):
+        if not entry.name.endswith('.parquet'):
+            continue
+        try:
+            stat = entry.stat()
+            if now - stat.st_mtime > TTL:
+                os.remove(entry.path)
+            else:
+                files.append((stat.st_atime, stat.st_size, entry.path))
+        except FileNotFoundError:
+            continue
+
+    total_size = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total_size <= MAX_SIZE:
+            break
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        total_size -= size
+
+
+def _is_cacheable(res):
+    return isinstance(res, gpd.GeoDataFrame) and res._geometry_column_name in res.columns
+
+
+def cached(func):
+    """
+    Decorator serving results of a fetch function from the on-disk cache.
+
+    Results that are None or have no geometry column are not cached.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if CACHE_DIR is None:
+            return func(*args, **kwargs)
+
+        key = get_cache_key(func, *args, **kwargs)
+        res = load(key)
+        if res is not None:
+            return res
+
+        res = func(*args, **kwargs)
+        if _is_cacheable(res):
+            save(key, res)
+
+        return res
+
+    return wrapper
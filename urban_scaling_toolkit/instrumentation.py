@@ -0,0 +1,309 @@
+import contextlib
+import functools
+import json
+import os
+import resource
+import sys
+import time
+
+import pandas as pd
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# recording is off unless enabled here, in the environment or with `configure`
+ENABLED = os.environ.get('instrumentation', '0') == '1'
+
+# peak RSS of every stage, measured by resetting the peak of the whole process through /proc
+TRACK_MEMORY = os.environ.get('instrumentation_memory', '0') == '1'
+
+# default log of `write_records`, .jsonl or .parquet
+LOG_PATH = os.environ.get('instrumentation_log')
+
+# records kept in memory until they are written or summarized, older ones are dropped
+MAX_RECORDS = int(os.environ.get('instrumentation_max_records', 100000))
+
+_records = []
+_context = {}
+_stack = []
+
+
+def configure(enabled=None, log_path=None, track_memory=None, max_records=None):
+    """
+    Turns recording and memory tracking on or off, sets the default log path
+    and the number of records kept in memory. None keeps the current value.
+    """
+
+    global ENABLED, LOG_PATH, TRACK_MEMORY, MAX_RECORDS
+    if enabled is not None:
+        ENABLED = enabled
+    if log_path is not None:
+        LOG_PATH = log_path
+    if track_memory is not None:
+        TRACK_MEMORY = track_memory
+    if max_records is not None:
+        MAX_RECORDS = max_records
+
+
+def _read_status(field):
+    # peak and current RSS in bytes from /proc on Linux
+    with open('/proc/self/status', 'r') as fp:
+        for line in fp:
+            if line.startswith(field):
+                return int(line.split()[1]) * 1024
+
+
+def _get_peak_rss():
+    try:
+        return _read_status('VmHWM')
+    except OSError:
+        # lifetime peak of the process elsewhere, in kilobytes on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _get_rss():
+    try:
+        return _read_status('VmRSS')
+    except OSError:
+        return None
+
+
+def _reset_peak_rss():
+    # makes VmHWM start from the current RSS, so that the peak of every stage is measured separately
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+    except OSError:
+        pass
+
+
+def _get_rows(value):
+    if value is None or isinstance(value, (str, bytes, dict)):
+        return None
+    try:
+        return len(value)
+    except TypeError:
+        return None
+
+
+@contextlib.contextmanager
+def context(**fields):
+    """
+    Adds fields, e.g. `city_id`, to all records made inside the block.
+    """
+
+    previous = dict(_context)
+    _context.update(fields)
+    try:
+        yield
+    finally:
+        _context.clear()
+        _context.update(previous)
+
+
+@contextlib.contextmanager
+def record(stage, rows_in=None):
+    """
+    Records wall time, CPU time and, with `TRACK_MEMORY`, peak RSS of a block of code.
+
+    Yields the record, so that the block can set `rows_out` and other fields.
+    Peak RSS of a nested stage also counts towards the stages around it.
+    Without `TRACK_MEMORY` it is None, as measuring it resets memory counters of the whole process.
+
+    Attributes
+    ----------
+    stage: str
+        Name of the stage.
+
+    rows_in: int or None
+        Number of input rows.
+    """
+
+    if not ENABLED:
+        yield {}
+        return
+
+    if TRACK_MEMORY:
+        # peaks reached so far belong to the outer stages
+        peak = _get_peak_rss()
+        for outer in _stack:
+            outer['peak_rss'] = max(outer['peak_rss'], peak)
+        _reset_peak_rss()
+
+    rec = {
+        **_context,
+        'stage': stage,
+        'parent': _stack[-1]['stage'] if _stack else None,
+        'start': time.time(),
+        'wall_time': None,
+        'cpu_time': None,
+        'peak_rss': _get_peak_rss() if TRACK_MEMORY else None,
+        'rss': None,
+        'rows_in': rows_in,
+        'rows_out': None,
+        'failed': False,
+        'pid': os.getpid()}
+
+    _stack.append(rec)
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+
+    try:
+        yield rec
+    except BaseException:
+        rec['failed'] = True
+        raise
+    finally:
+        rec['wall_time'] = time.perf_counter() - wall_start
+        rec['cpu_time'] = time.process_time() - cpu_start
+        rec['rss'] = _get_rss()
+
+        _stack.pop()
+        if TRACK_MEMORY:
+            rec['peak_rss'] = max(rec['peak_rss'], _get_peak_rss())
+            for outer in _stack:
+                outer['peak_rss'] = max(outer['peak_rss'], rec['peak_rss'])
+
+        _records.append(rec)
+        if len(_records) > MAX_RECORDS:
+            del _records[:len(_records) - MAX_RECORDS]
+
+
+def instrument(stage=None, rows_in=None, rows_out=None):
+    """
+    Decorator recording every call of a function with `record`.
+
+    Attributes
+    ----------
+    stage: str or None
+        Name of the stage. Defaults to the module and qualified name of the function,
+        e.g. `city_model.CityModel.generate_blocks`.
+
+    rows_in: callable or None
+        Called with the arguments of the call, returns the number of input rows.
+        Defaults to the length of the first argument.
+
+    rows_out: callable or None
+        Called with the result and the arguments of the call, returns the number of output rows.
+        Defaults to the length of the result.
+    """
+
+    def decorator(func):
+        name = stage or f'{func.__module__}.{func.__qualname__}'
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+
+            n_in = rows_in(*args, **kwargs) if rows_in is not None else (_get_rows(args[0]) if args else None)
+            with record(name, rows_in=n_in) as rec:
+                res = func(*args, **kwargs)
+                rec['rows_out'] = rows_out(res, *args, **kwargs) if rows_out is not None else _get_rows(res)
+
+            return res
+
+        return wrapper
+
+    return decorator
+
+
+def attribute_rows(attribute, output=False):
+    """
+    Returns a row counter of an attribute of `self`, e.g. `blocks` of a CityModel, for `instrument`
+    of methods that update the object instead of returning a result.
+    With `output` it has the signature of `rows_out`.
+    """
+
+    if output:
+        return lambda res, self, *args, **kwargs: _get_rows(getattr(self, attribute, None))
+
+    return lambda self, *args, **kwargs: _get_rows(getattr(self, attribute, None))
+
+
+def get_records(clear=True):
+    """
+    Returns records made in this process, e.g. to send them from a worker to the main process.
+    """
+
+    res = list(_records)
+    if clear:
+        _records.clear()
+
+    return res
+
+
+def write_records(records=None, path=None):
+    """
+    Appends records to a .jsonl log or to a .parquet file.
+    None writes records made in this process and clears them.
+    """
+
+    if records is None:
+        records = get_records()
+
+    path = path or LOG_PATH
+    if path is None or not records:
+        return
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    if path.endswith('.parquet'):
+        df = pd.DataFrame(records)
+        if os.path.exists(path):
+            df = pd.concat([pd.read_parquet(path), df], ignore_index=True)
+        df.to_parquet(path, index=False)
+    else:
+        with open(path, 'a') as fp:
+            for rec in records:
+                fp.write(json.dumps(rec, default=str) + '\n')
+
+
+def read_records(path=None):
+    """
+    Reads a log written by `write_records` into a DataFrame.
+    """
+
+    path = path or LOG_PATH
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+
+    return pd.read_json(path, lines=True)
+
+
+def summarize(records=None):
+    """
+    Aggregates records of a batch run by stage.
+
+    Attributes
+    ----------
+    records: list or pd.DataFrame or None
+        Records or a log read with `read_records`.
+        None summarizes records made in this process and clears them.
+
+    Returns
+    -------
+    summary: pd.DataFrame
+        Number of calls, total and maximum wall time, total CPU time,
+        maximum peak RSS and total rows per stage, sorted by total wall time.
+    """
+
+    if records is None:
+        records = get_records()
+
+    df = pd.DataFrame(records)
+
+    summary = df.groupby('stage').agg(
+        calls=('wall_time', 'size'),
+        wall_time=('wall_time', 'sum'),
+        max_wall_time=('wall_time', 'max'),
+        cpu_time=('cpu_time', 'sum'),
+        peak_rss=('peak_rss', 'max'),
+        rows_in=('rows_in', 'sum'),
+        rows_out=('rows_out', 'sum'),
+        failed=('failed', 'sum'))
+
+    return summary.sort_values('wall_time', ascending=False)
@@ -1,19 +1,58 @@
 import geopandas as gpd
 import pandas as pd
-import momepy as mm
 import numpy as np
 import requests
 import shapely
 import json
 from scipy.optimize import curve_fit
+from scipy.sparse import csr_matrix
 
     
-def evaluate_centrality(blocks,services):
+def get_cluster_diversity(services):
+    """
+    Calculates diversity of service tags in every cluster.
+
+    Attributes
+    ----------
+    services: gpd.GeoDataFrame
+        Services with `cluster_id` and `tags` (lists) columns.
+
+    Returns
+    -------
+    diversity: pd.DataFrame
+        `cluster_id` with Simpson (1 - sum of squared tag shares) and
+        Shannon (-sum of p*ln(p) over tag shares) diversity of its tags.
+    """
+
+    services = services[services['cluster_id'].notna()]
+    cluster_ids, cluster_idx = np.unique(services['cluster_id'].to_numpy(), return_inverse=True)
+
+    # tag counts per cluster as a sparse matrix
+    tags = services['tags'].reset_index(drop=True).explode().dropna()
+    tag_codes, _ = pd.factorize(tags)
+    counts = csr_matrix(
+        (np.ones(len(tags)), (cluster_idx[tags.index.to_numpy()], tag_codes)),
+        shape=(len(cluster_ids), max(tag_codes.max() + 1, 1) if len(tags) else 1))
+    counts.sum_duplicates()
+
+    totals = np.asarray(counts.sum(axis=1)).ravel()
+    shares = counts.multiply(1 / np.where(totals > 0, totals, 1)[:, None]).tocsr()
+
+    simpson = np.asarray(shares.multiply(shares).sum(axis=1)).ravel()
+    shares.data = shares.data * np.log(shares.data)
+    shannon = -np.asarray(shares.sum(axis=1)).ravel()
+
+    return pd.DataFrame({'cluster_id': cluster_ids, 'simpson': 1 - simpson, 'shannon': shannon})
+
+
+def evaluate_centrality(blocks,services,diversity_index='simpson'):
     """
     # TODO
     
     Attributes
     ----------
+    diversity_index: str
+        "simpson" or "shannon" diversity of service tags.
     # TODO
     
     Returns
@@ -24,13 +63,11 @@ def evaluate_centrality(blocks,services):
     # drop columns related to centrality if there are any
     blocks = blocks.drop(['diversity','centrality','centrality_bin','services_total'],axis=1,errors='ignore')
     
-    # collect all service tags per cluster
-    services_groupped = services.groupby('cluster_id').agg({"tags": "sum"})["tags"].apply(list)
-    
     # calculate diversity per cluster
-    diversity = pd.DataFrame(columns=['cluster_id', "diversity"])
-    for i, x in services_groupped.items():
-        diversity.loc[len(diversity)] = [i,1 - mm.simpson_diversity(pd.Series(x), categorical=True)]
+    if diversity_index not in ['simpson','shannon']:
+        raise ValueError(f"Unknown diversity index: {diversity_index}")
+    diversity = get_cluster_diversity(services)
+    diversity = diversity[['cluster_id',diversity_index]].rename(columns={diversity_index:'diversity'})
 
     # count services per cluster
     services_total = services.groupby('cluster_id')["geometry"].count().rename("services_total").reset_index()
@@ -54,9 +91,7 @@ def evaluate_centrality(blocks,services):
     
     # map centrality to intervals from 0 to 10
     intervals = np.arange(-10, 111, 10) / 100
-    intervals_levels = {y: x for x, y in zip(np.arange(len(intervals)),pd.cut(np.asarray(blocks["centrality"]), intervals).categories)}
-    blocks["centrality_bin"] = pd.cut(np.asarray(blocks["centrality"]), intervals)
-    blocks["centrality_bin"] = blocks["centrality_bin"].replace(intervals_levels)
+    blocks["centrality_bin"] = pd.cut(np.asarray(blocks["centrality"]), intervals, labels=False)
     blocks["centrality_bin"] = blocks["centrality_bin"].fillna(0).astype(int)
     
     return blocks
@@ -0,0 +1,257 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import osmium
+import shapely
+from tqdm import tqdm
+import instrumentation
+from data_fetcher import service_tags, road_tags, water_tags, railway_tags, get_service_tags_union, classify_services, get_centroids
+
+
+# tags kept besides the filter keys
+EXTRA_KEYS = ['name', 'service']
+
+# layers whose closed ways are read as polygons
+AREA_LAYERS = ['water', 'services']
+
+
+def _normalize_tags(tags):
+    """
+    Turns an osmnx-style tags dict into a dict of key -> set of values (None for any value).
+    """
+
+    filters = {}
+    for key, values in tags.items():
+        if values is True:
+            filters[key] = None
+        elif isinstance(values, str):
+            filters[key] = {values}
+        else:
+            filters[key] = set(values)
+
+    return filters
+
+
+def _matches(tags, filters):
+    for key, values in filters.items():
+        value = tags.get(key)
+        if value is not None and (values is None or value in values):
+            return True
+    return False
+
+
+class _FeatureCollector:
+    """
+    Collects features matching layer filters and keeps the ones
+    intersecting any of the territories.
+    """
+
+    def __init__(self, filters, territories, batch_size):
+
+        self.filters = filters
+        self.keys = list(set().union(*filters.values()).union(EXTRA_KEYS))
+        self.tree = shapely.STRtree(territories)
+        self.batch_size = batch_size
+        self.factory = osmium.geom.WKBFactory()
+
+        self.batch = {layer: [] for layer in filters}
+        self.res = {layer: [] for layer in filters}
+
+    def add(self, obj):
+
+        if obj.is_node():
+            kind, create = 'node', self.factory.create_point
+        elif obj.is_way():
+            kind, create = 'way', self.factory.create_linestring
+        elif obj.is_area():
+            kind, create = 'area', self.factory.create_multipolygon
+        else:
+            return
+
+        tags = {key: obj.tags[key] for key in self.keys if key in obj.tags}
+        layers = []
+        for layer, filters in self.filters.items():
+            if kind == 'way' and layer in AREA_LAYERS and obj.is_closed():
+                continue  # closed ways come once again as areas
+            if kind == 'area' and layer not in AREA_LAYERS:
+                continue
+            if _matches(tags, filters):
+                layers.append(layer)
+
+        if not layers:
+            return
+
+        try:
+            wkb = create(obj)
+        except (RuntimeError, osmium.InvalidLocationError):
+            return  # incomplete geometry, e.g. a way cut at the extract border
+
+        for layer in layers:
+            self.batch[layer].append((wkb, tags))
+            if len(self.batch[layer]) >= self.batch_size:
+                self.flush(layer)
+
+    def flush(self, layer):
+
+        if not self.batch[layer]:
+            return
+
+        wkbs, tags = zip(*self.batch[layer])
+        self.batch[layer] = []
+
+        geometry = shapely.from_wkb(np.array(wkbs, dtype=object))
+
+        # osmium builds every area as a multipolygon, osmnx returns a polygon if there is one part
+        single = (shapely.get_type_id(geometry) == 6) & (shapely.get_num_geometries(geometry) == 1)
+        geometry[single] = shapely.get_geometry(geometry[single], 0)
+        feature_idx, territory_idx = self.tree.query(geometry, predicate='intersects')
+        if len(feature_idx) == 0:
+            return
+
+        features = gpd.GeoDataFrame(
+            pd.DataFrame(list(tags)).iloc[feature_idx].reset_index(drop=True),
+            geometry=geometry[feature_idx], crs=4326)
+        features['territory'] = territory_idx
+        self.res[layer].append(features)
+
+    def get_layers(self):
+
+        for layer in self.filters:
+            self.flush(layer)
+
+        return {
+            layer: pd.concat(frames, ignore_index=True) if frames else gpd.GeoDataFrame(
+                columns=['territory', 'geometry'], geometry='geometry', crs=4326)
+            for layer, frames in self.res.items()}
+
+
+@instrumentation.instrument(rows_in=lambda pbf_path, territories, *args, **kwargs: len(territories),
+                             rows_out=lambda res, *args, **kwargs: sum(len(features) for features in res.values()))
+def read_pbf(pbf_path, territories, service_tags=service_tags, road_tags=road_tags,
+             water_tags=water_tags, railway_tags=railway_tags, batch_size=100000, verbose=True):
+    """
+    Reads features of all layers from an .osm.pbf extract in one pass over the file.
+
+    Attributes
+    ----------
+    pbf_path: str
+        Path to a regional .osm.pbf extract.
+
+    territories: gpd.GeoSeries
+        Territories (EPSG:4326) to keep features for.
+
+    service_tags, road_tags, water_tags, railway_tags:
+        Tag filters, the same as in `data_fetcher`.
+
+    batch_size: int
+        Number of features per layer matched against territories at once.
+
+    Returns
+    -------
+    layers: dict
+        Raw features of every layer with their tags and the positional index of
+        an intersecting territory in the `territory` column. A feature intersecting
+        several territories is repeated.
+    """
+
+    filters = {
+        'roads': _normalize_tags(road_tags),
+        'railways': _normalize_tags(railway_tags),
+        'water': _normalize_tags(water_tags),
+        'services': _normalize_tags(get_service_tags_union(service_tags))}
+
+    territories = np.asarray(territories.to_crs(4326).geometry.values)
+    collector = _FeatureCollector(filters, territories, batch_size)
+
+    # drop objects without any relevant key before they reach python
+    keys = list(set().union(*filters.values()))
+    processor = osmium.FileProcessor(pbf_path).with_locations().with_areas().with_filter(osmium.filter.KeyFilter(*keys))
+
+    for obj in tqdm(processor, disable=not verbose, unit=' objects'):
+        collector.add(obj)
+
+    return collector.get_layers()
+
+
+def _format_roads(roads):
+
+    roads = roads.loc[roads.geom_type.isin(['LineString', 'MultiLineString'])]
+    roads = roads.reset_index(drop=True)["geometry"]
+
+    return gpd.GeoDataFrame(roads)
+
+
+def _format_water(water):
+
+    water = water.loc[water.geom_type.isin(
+        ['Polygon', 'MultiPolygon', 'LineString', 'MultiLineString'])]
+    if len(water) == 0:
+        return
+
+    water = water.reset_index(drop=True)["geometry"].drop_duplicates()
+
+    return gpd.GeoDataFrame(water)
+
+
+def _format_railways(railway):
+
+    if len(railway) == 0:
+        return
+
+    if 'service' in railway:
+        railway = railway[~railway['service'].isin(["crossover", "siding", "yard"])]
+
+    return gpd.GeoDataFrame(railway.reset_index(drop=True)["geometry"])
+
+
+def _format_services(services, service_tags=service_tags):
+
+    res = classify_services(services, service_tags)
+    res["geometry"] = get_centroids(res.geometry)
+
+    return res
+
+
+@instrumentation.instrument()
+def fetch_from_pbf(pbf_path, territories, id_column='city_id', service_tags=service_tags, batch_size=100000, verbose=True):
+    """
+    Reads roads, railways, water and services of many territories from a local .osm.pbf extract
+    instead of querying Overpass for every one of them.
+
+    Attributes
+    ----------
+    pbf_path: str
+        Path to a regional .osm.pbf extract covering the territories.
+
+    territories: gpd.GeoDataFrame
+        Territories, e.g. rows of the `city` table.
+
+    id_column: str
+        Column with territory IDs.
+
+    service_tags: pd.DataFrame
+        Service tags by category, the same as in `data_fetcher.fetch_services`.
+
+    Returns
+    -------
+    res: dict
+        Territory ID -> dict with `roads`, `railways`, `water` and `services`
+        in the formats of the corresponding `data_fetcher` functions.
+    """
+
+    territories = territories.reset_index(drop=True)
+    layers = read_pbf(pbf_path, territories.geometry, service_tags=service_tags,
+                      batch_size=batch_size, verbose=verbose)
+
+    grouped = {layer: dict(list(features.groupby('territory'))) for layer, features in layers.items()}
+
+    res = {}
+    for i, territory_id in enumerate(territories[id_column]):
+        features = {layer: grouped[layer].get(i, layers[layer].iloc[:0]) for layer in layers}
+        res[territory_id] = {
+            'roads': _format_roads(features['roads']),
+            'railways': _format_railways(features['railways']),
+            'water': _format_water(features['water']),
+            'services': _format_services(features['services'], service_tags)}
+
+    return res
@@ -1,40 +1,197 @@
 import geojson
-from shapely import Point
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import rasterio
+import rasterio.features
+import rasterio.windows
 import rioxarray as rxr
+from scipy.sparse import csr_matrix
 import shapely
+import instrumentation
 import geopandas as gpd
 from utils import reproject_shapely
+
+
+_cached_rasters = {}
+
+
+class CachedRaster:
+    """
+    Raster kept open for the lifetime of a process with an LRU cache of decoded tiles.
+    
+    Windows are read as whole tiles aligned to the file's internal blocks, so cities 
+    close to each other reuse tiles that were already decoded. Use `open_raster` 
+    with `cached=True` to get a shared instance instead of creating one directly.
+    
+    Attributes
+    ----------
+    filename: str
+        Path to a single-band raster.
+        
+    cache_size: int
+        Maximum number of decoded tiles kept in memory.
+        
+    tile_size: tuple or None
+        (height, width) of a tile in cells. Defaults to the file's internal block shape,
+        or 512×512 if the file is stored in strips.
+    """
+    
+    def __init__(self, filename, cache_size=64, tile_size=None):
+        self.filename = filename
+        self.dataset = rasterio.open(filename)
+        self.nodata = self.dataset.nodata
+        
+        if tile_size is None:
+            tile_size = self.dataset.block_shapes[0]
+            if min(tile_size) < 64:
+                tile_size = (512, 512)
+        self.tile_height, self.tile_width = tile_size
+        
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+        
+    def read_tile(self, tile_row, tile_col):
+        """
+        Returns values of the first band in a tile, decoding it only on a cache miss.
+        """
+        
+        key = (tile_row, tile_col)
+        with self._lock:
+            if key in self._tiles:
+                self.hits += 1
+                self._tiles.move_to_end(key)
+                return self._tiles[key]
+            self.misses += 1
+            
+            window = rasterio.windows.Window(
+                tile_col * self.tile_width, tile_row * self.tile_height, self.tile_width, self.tile_height)
+            window = window.intersection(rasterio.windows.Window(0, 0, self.dataset.width, self.dataset.height))
+            tile = self.dataset.read(1, window=window)
+            
+            self._tiles[key] = tile
+            if len(self._tiles) > self.cache_size:
+                self._tiles.popitem(last=False)
+        
+        return tile
+        
+    def read_window(self, row_off, col_off, height, width):
+        """
+        Assembles values of the first band in a window from cached tiles.
+        """
+        
+        values = np.empty((height, width), dtype=self.dataset.dtypes[0])
+        
+        for tile_row in range(row_off // self.tile_height, (row_off + height - 1) // self.tile_height + 1):
+            for tile_col in range(col_off // self.tile_width, (col_off + width - 1) // self.tile_width + 1):
+                tile = self.read_tile(tile_row, tile_col)
+                
+                # overlap of the tile and the window in raster coordinates
+                row_start = max(row_off, tile_row * self.tile_height)
+                row_end = min(row_off + height, tile_row * self.tile_height + tile.shape[0])
+                col_start = max(col_off, tile_col * self.tile_width)
+                col_end = min(col_off + width, tile_col * self.tile_width + tile.shape[1])
+                
+                values[row_start - row_off:row_end - row_off, col_start - col_off:col_end - col_off] = tile[
+                    row_start - tile_row * self.tile_height:row_end - tile_row * self.tile_height,
+                    col_start - tile_col * self.tile_width:col_end - tile_col * self.tile_width]
+                
+        return values
+    
+    def crop(self, cropping_polygon):
+        """
+        Same as `crop_raster` for a cached raster.
+        """
+        
+        window = rasterio.windows.from_bounds(*cropping_polygon.bounds, transform=self.dataset.transform)
+        window = window.round_offsets(op='floor').round_lengths(op='ceil')
+        window = window.intersection(rasterio.windows.Window(0, 0, self.dataset.width, self.dataset.height))
+        row_off, col_off, height, width = int(window.row_off), int(window.col_off), int(window.height), int(window.width)
+        
+        values = self.read_window(row_off, col_off, height, width)
+        
+        transform = rasterio.windows.transform(window, self.dataset.transform)
+        outside = rasterio.features.geometry_mask(
+            [shapely.geometry.mapping(cropping_polygon)], out_shape=values.shape, transform=transform)
+        values = np.where(outside, self.nodata if self.nodata is not None else np.nan, values)
+        
+        # cell centers, as in rioxarray
+        x = transform.c + (np.arange(width) + 0.5) * transform.a
+        y = transform.f + (np.arange(height) + 0.5) * transform.e
+        cropped = pd.DataFrame(values, index=pd.Index(y, name='y'), columns=pd.Index(x, name='x'))
+        
+        return cropped
+    
+    def cache_info(self):
+        return {"hits": self.hits, "misses": self.misses, "tiles": len(self._tiles), "cache_size": self.cache_size}
+
+
+def _reset_cached_rasters_after_fork():
+    # file handles inherited from the parent process must not be shared
+    global _cached_rasters
+    _cached_rasters = {}
+    
+    
+os.register_at_fork(after_in_child=_reset_cached_rasters_after_fork)
   
 
-def open_raster(filename):
+def open_raster(filename, cached=False, cache_size=64):
     """
-    # TODO
+    Opens a raster.
     
     Attributes
     ----------
-    # TODO
+    filename: str
+        Path to a raster.
+        
+    cached: bool
+        Return a `CachedRaster` shared by all calls with the same filename in the current process
+        instead of opening a new xr.DataArray.
+        
+    cache_size: int
+        Maximum number of decoded tiles kept by a new `CachedRaster`.
     
     Returns
     -------
-    # TODO
+    raster: xr.DataArray or CachedRaster
+        Opened raster.
     """
     
+    if cached:
+        if filename not in _cached_rasters:
+            _cached_rasters[filename] = CachedRaster(filename, cache_size=cache_size)
+        return _cached_rasters[filename]
+    
     dataarray = rxr.open_rasterio(filename)
     return dataarray
 
 
 def crop_raster(raster,cropping_polygon):
     """
-    # TODO
+    Reads raster values within a polygon. Only the window covering 
+    the polygon's bounds is read from disk, cells outside the polygon are set to nodata.
     
     Attributes
     ----------
-    # TODO
+    raster: xr.DataArray or CachedRaster
+        Raster opened with `open_raster`.
+        
+    cropping_polygon: shapely.Polygon or shapely.MultiPolygon
+        Polygon in raster CRS.
     
     Returns
     -------
-    # TODO
+    cropped: pd.DataFrame
+        Values of the first band with y coordinates as index and x coordinates as columns.
     """
+    
+    if isinstance(raster, CachedRaster):
+        return raster.crop(cropping_polygon)
 
     cropping_geometry = [geojson.loads(shapely.to_geojson(cropping_polygon))]
     cropped = raster.rio.clip(geometries=cropping_geometry, from_disk=True)
@@ -43,33 +200,59 @@ def crop_raster(raster,cropping_polygon):
     return cropped
 
 
-def vectorize_raster_grid(raster, cropping_polygon, poly_crs=4326, raster_crs="ESRI:54009", grid_resolution=100,value_column_name='value'):
+@instrumentation.instrument(rows_in=lambda *args, **kwargs: None)
+def vectorize_raster_grid(raster, cropping_polygon, poly_crs=4326, raster_crs="ESRI:54009", grid_resolution=100,value_column_name='value',skip_empty=True):
     """
-    # TODO
+    Converts raster cells within a polygon to square polygons.
     
     Attributes
     ----------
-    # TODO
+    raster: xr.DataArray or CachedRaster
+        Raster opened with `open_raster`.
+        
+    cropping_polygon: shapely.Polygon or shapely.MultiPolygon
+        Polygon limiting the cells.
+        
+    poly_crs: int or pyproj.CRS
+        CRS of the polygon.
+        
+    raster_crs: str or pyproj.CRS
+        CRS of the raster.
+        
+    grid_resolution: int or float
+        Size of a raster cell in raster CRS units.
+        
+    value_column_name: str
+        Name of the column with cell values.
+        
+    skip_empty: bool
+        Skip cells with zero, negative (nodata) or missing values before creating geometries.
     
     Returns
     -------
-    # TODO
+    gdf: gpd.GeoDataFrame
+        Cells with their values in raster CRS.
     """
     
     cropping_polygon = reproject_shapely(cropping_polygon,poly_crs,raster_crs)
     raster_cropped = crop_raster(raster,cropping_polygon)
 
-    res = []
-    for x in raster_cropped.columns:
-        for y in raster_cropped.index:
-            res.append([Point(x + (grid_resolution / 2), y - (grid_resolution / 2)), raster_cropped.loc[y, x]])
-
-    gdf = gpd.GeoDataFrame(res,columns=['geometry',value_column_name],crs=raster_crs)
-    gdf['geometry'] = gdf.buffer(grid_resolution / 2, cap_style=3)
+    values = raster_cropped.to_numpy()
+    y, x = np.meshgrid(raster_cropped.index.to_numpy(), raster_cropped.columns.to_numpy(), indexing='ij')
+    
+    if skip_empty:
+        mask = values > 0
+        values, x, y = values[mask], x[mask], y[mask]
+    
+    gdf = gpd.GeoDataFrame(
+        {value_column_name: values.ravel()},
+        geometry=shapely.box(x.ravel(), y.ravel() - grid_resolution, x.ravel() + grid_resolution, y.ravel()),
+        crs=raster_crs)
 
     return gdf
 
 
+@instrumentation.instrument()
 def project_grid_values(gdf, grid, gdf_id_column,grid_value_column='value'):
     """
     # TODO
@@ -95,4 +278,112 @@ def project_grid_values(gdf, grid, gdf_id_column,grid_value_column='value'):
     res = gdf_grid_overlay.groupby(gdf_id_column)[grid_value_column].sum().reset_index()
     gdf = gdf.merge(res, how="left")
 
-    return gdf
\ No newline at end of file
+    return gdf
+
+
+@instrumentation.instrument()
+def project_raster_values(gdf, raster, cropping_polygon, gdf_id_column, value_column_name='value', poly_crs=4326, raster_crs="ESRI:54009", grid_resolution=100, max_pairs=1000000):
+    """
+    Distributes raster values to polygons proportionally to the covered share of every cell.
+    
+    Gives the same result as `vectorize_raster_grid` followed by `project_grid_values`
+    without a polygon overlay: candidate cells of every polygon are found from its bounds 
+    on the regular grid, only intersection areas are computed, and the values are summed 
+    as a sparse (polygons × cells) coverage matrix multiplied by the vector of cell values.
+    Polygons are processed in chunks of at most `max_pairs` polygon-cell pairs to bound memory.
+    
+    Attributes
+    ----------
+    gdf: gpd.GeoDataFrame
+        Polygons to project values to.
+        
+    raster: xr.DataArray or CachedRaster
+        Raster opened with `open_raster`.
+        
+    cropping_polygon: shapely.Polygon or shapely.MultiPolygon
+        Polygon limiting the cells.
+        
+    gdf_id_column: str
+        Name of the polygons' ID column.
+        
+    value_column_name: str
+        Name of the resulting column.
+        
+    poly_crs: int or pyproj.CRS
+        CRS of the cropping polygon.
+        
+    raster_crs: str or pyproj.CRS
+        CRS of the raster.
+        
+    grid_resolution: int or float
+        Size of a raster cell in raster CRS units.
+        
+    max_pairs: int
+        Maximum number of polygon-cell pairs evaluated at once.
+    
+    Returns
+    -------
+    gdf: gpd.GeoDataFrame
+        Polygons with a column of projected values.
+    """
+    
+    cropping_polygon = reproject_shapely(cropping_polygon,poly_crs,raster_crs)
+    raster_cropped = crop_raster(raster,cropping_polygon)
+    
+    values = raster_cropped.to_numpy()
+    values = np.where(values > 0, values, 0).ravel()
+    xs = raster_cropped.columns.to_numpy()
+    ys = raster_cropped.index.to_numpy()
+    n_rows, n_cols = len(ys), len(xs)
+    cell_area = grid_resolution ** 2
+    
+    geoms = np.asarray(gdf.to_crs(raster_crs).geometry.values)
+    shapely.prepare(geoms)
+    
+    # ranges of grid rows and columns covered by polygons' bounds
+    bounds = shapely.bounds(geoms)
+    col_min = np.clip(np.floor((bounds[:, 0] - xs[0]) / grid_resolution), 0, n_cols - 1).astype(int)
+    col_max = np.clip(np.floor((bounds[:, 2] - xs[0]) / grid_resolution), -1, n_cols - 1).astype(int)
+    row_min = np.clip(np.floor((ys[0] - bounds[:, 3]) / grid_resolution), 0, n_rows - 1).astype(int)
+    row_max = np.clip(np.floor((ys[0] - bounds[:, 1]) / grid_resolution), -1, n_rows - 1).astype(int)
+    width = np.maximum(col_max - col_min + 1, 0)
+    n_pairs = width * np.maximum(row_max - row_min + 1, 0)
+    n_pairs[np.isnan(bounds).any(axis=1)] = 0
+    
+    result = np.zeros(len(geoms))
+    
+    chunk_start = 0
+    cumulative_pairs = np.cumsum(n_pairs)
+    while chunk_start < len(geoms):
+        chunk_end = max(np.searchsorted(cumulative_pairs, cumulative_pairs[chunk_start] - n_pairs[chunk_start] + max_pairs, side='right'),
+                        chunk_start + 1)
+        chunk = np.arange(chunk_start, chunk_end)
+        
+        # enumerate candidate cells of every polygon in the chunk
+        pair_polygons = np.repeat(chunk, n_pairs[chunk])
+        pair_offsets = np.arange(len(pair_polygons)) - np.repeat(np.cumsum(n_pairs[chunk]) - n_pairs[chunk], n_pairs[chunk])
+        pair_rows = row_min[pair_polygons] + pair_offsets // width[pair_polygons]
+        pair_cols = col_min[pair_polygons] + pair_offsets % width[pair_polygons]
+        pair_cells = pair_rows * n_cols + pair_cols
+        
+        # cells without values do not contribute
+        mask = values[pair_cells] > 0
+        pair_polygons, pair_rows, pair_cols, pair_cells = pair_polygons[mask], pair_rows[mask], pair_cols[mask], pair_cells[mask]
+        
+        cells = shapely.box(xs[pair_cols], ys[pair_rows] - grid_resolution, xs[pair_cols] + grid_resolution, ys[pair_rows])
+        
+        # only cells crossed by a polygon's boundary need an intersection
+        coverage = shapely.intersects(geoms[pair_polygons], cells).astype(float)
+        partial = (coverage > 0) & ~shapely.contains_properly(geoms[pair_polygons], cells)
+        coverage[partial] = shapely.area(shapely.intersection(geoms[pair_polygons[partial]], cells[partial])) / cell_area
+        
+        coverage_matrix = csr_matrix(
+            (coverage, (pair_polygons - chunk_start, pair_cells)), shape=(len(chunk), len(values)))
+        result[chunk] = coverage_matrix @ values
+        
+        chunk_start = chunk_end
+    
+    gdf = gdf.copy()
+    gdf[value_column_name] = result
+
+    return gdf
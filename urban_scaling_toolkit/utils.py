@@ -1,7 +1,10 @@
 import geopandas as gpd
+import pandas as pd
 from shapely.geometry import MultiPolygon, Polygon
 import numpy as np
+import shapely
 import dill
+from concurrent.futures import ProcessPoolExecutor
 import json
 
 import pyproj
@@ -11,6 +14,8 @@ from pyproj import CRS
 
 import momepy as mm
 
+import instrumentation
+
 def verbose_print(text, verbose=True):
     if verbose: print(text)
 
@@ -61,10 +66,78 @@ def get_projected_crs(poly):
     
     return projected_crs
 
+class ProjectionCache:
+    """
+    Keeps projected copies of geometries, so that frames whose geometries did not change
+    (e.g. filtered, reordered or merged with other columns) are not reprojected.
+
+    Geometries are matched by identity of shapely objects. The cache holds references
+    to the cached geometries, so their ids are not reused while they are cached.
+    Cached projections are not pickled.
+
+    Attributes
+    ----------
+    crs: int or pyproj.CRS
+        CRS to project geometries to.
+    """
+
+    def __init__(self, crs):
+
+        self.crs = crs
+        self.cache = {}
+        self.stats = {"reprojections": 0, "projected_geometries": 0, "cache_hits": 0}
+
+    def project(self, name, gdf):
+        """
+        Returns geometries of a GeoDataFrame or GeoSeries in the cache CRS,
+        reprojecting only geometries missing in the cache under a given name.
+        """
+
+        geometry = np.asarray(gdf.geometry.values)
+        ids = pd.Index(np.fromiter(map(id, geometry), dtype=np.int64, count=len(geometry)))
+
+        if name in self.cache:
+            cached_ids, _, cached_projected = self.cache[name]
+            positions = cached_ids.get_indexer(ids)
+        else:
+            positions = np.full(len(geometry), -1)
+
+        missing = positions < 0
+        projected = np.empty(len(geometry), dtype=object)
+        if not missing.all():
+            projected[~missing] = cached_projected[positions[~missing]]
+
+        if missing.any():
+            projected[missing] = np.asarray(
+                gpd.GeoSeries(geometry[missing], crs=gdf.crs).to_crs(self.crs).values)
+            self.stats["reprojections"] += 1
+            self.stats["projected_geometries"] += int(missing.sum())
+        self.stats["cache_hits"] += int((~missing).sum())
+
+        # keep geometries of the last call, every geometry once
+        unique = ~ids.duplicated()
+        self.cache[name] = (ids[unique], geometry[unique], projected[unique])
+
+        return gpd.GeoSeries(projected, index=gdf.index, crs=self.crs)
+
+    def clear(self):
+
+        self.cache = {}
+
+    def __getstate__(self):
+        # ids of cached geometries are meaningless in another process or after they are freed
+        state = self.__dict__.copy()
+        state["cache"] = {}
+        return state
+
+
 def fill_holes(gdf):
     """
     Fills holes in geometries of a given GeoDataFrame
     
+    Every ring of a polygon (the exterior and the holes) becomes a separate polygon,
+    so that the holes are covered both by the filled polygon and by their own polygons.
+
     Attributes
     ----------
     gdf: gpd.GeoDataFrame
@@ -76,17 +149,22 @@ def fill_holes(gdf):
         GeoDataFrame with filled geometries.
     """
     
-    gdf["geometry"] = gdf["geometry"].boundary
-    gdf = gdf.explode(index_parts=False)
-    gdf["geometry"] = gdf["geometry"].map(
-        lambda x: Polygon(x) if x.geom_type != 'Point' else np.nan)
-    gdf = gdf.dropna(subset='geometry').reset_index(drop=True).to_crs(4326)
+    parts, part_idx = shapely.get_parts(gdf["geometry"].values, return_index=True)
+    is_polygon = shapely.get_type_id(parts) == 3
+    parts, part_idx = parts[is_polygon], part_idx[is_polygon]
+
+    rings, ring_idx = shapely.get_rings(parts, return_index=True)
+
+    gdf = gdf.iloc[part_idx[ring_idx]].copy()
+    gdf["geometry"] = shapely.polygons(rings)
+    gdf = gdf.reset_index(drop=True).to_crs(4326)
     
     return gdf
 
 def drop_contained_geometries(gdf):
     """
     Drops geometries that are contained inside other geometries.
+    Equal geometries contain each other, so all of them are dropped.
     
     Attributes
     ----------
@@ -101,19 +179,43 @@ def drop_contained_geometries(gdf):
     
     gdf = gdf.reset_index(drop=True)
     
-    overlaps = gdf["geometry"].sindex.query(gdf["geometry"], predicate="contains")
-    contains_dict = {x:[] for x in overlaps[0]}
-    for x, y in zip(overlaps[0], overlaps[1]):
-        if x != y:
-            contains_dict[x].append(y)
-            
-    contained_geoms_idxs = list({x for v in contains_dict.values() for x in v})
+    containers, contained = gdf["geometry"].sindex.query(gdf["geometry"], predicate="contains")
+    contained_geoms_idxs = np.unique(contained[containers != contained])
     gdf = gdf.drop(contained_geoms_idxs)
     gdf = gdf.reset_index(drop=True)
     
     return gdf
 
-def filter_bottlenecks(gdf,projected_crs,min_width=40):
+def _filter_bottlenecks_chunk(geometry,min_width):
+    """
+    Applies negative and positive buffers to an array of projected geometries and
+    intersects the result with the original geometries.
+
+    Returns processed geometries and a mask of geometries that failed to process,
+    which are returned unchanged.
+    """
+
+    try:
+        opened = shapely.buffer(
+            shapely.buffer(geometry,-min_width/2,quad_segs=16),min_width/2,quad_segs=16,join_style='mitre')
+        return shapely.intersection(geometry,opened), np.zeros(len(geometry),dtype=bool)
+    except shapely.errors.GEOSException:
+        pass
+
+    # find failing geometries one by one
+    res = geometry.copy()
+    failed = np.zeros(len(geometry),dtype=bool)
+    for i, poly in enumerate(geometry):
+        try:
+            res[i] = poly.intersection(poly.buffer(-min_width/2).buffer(min_width/2,join_style='mitre'))
+        except shapely.errors.GEOSException:
+            failed[i] = True
+
+    return res, failed
+
+
+@instrumentation.instrument(rows_out=lambda res, *args, **kwargs: len(res[0]) if isinstance(res, tuple) else len(res))
+def filter_bottlenecks(gdf,projected_crs,min_width=40,n_workers=1,chunk_size=10000,return_failed=False):
     """
     Divides geometries in narrow places and removes small geometries.
     
@@ -127,54 +229,114 @@ def filter_bottlenecks(gdf,projected_crs,min_width=40):
         
     min_width: int or float
         Minimum allowed width of geometries in resulting GeoDataFrame.
+
+    n_workers: int
+        Number of worker processes for chunks of geometries.
+
+    chunk_size: int
+        Number of geometries processed in one chunk.
+
+    return_failed: bool
+        Also return the rows that failed to process. They are kept unchanged in the result.
     
     Returns
     -------
     gdf: gpd.GeoDataFrame
         GeoDataFrame with processed geometries.
+
+    failed: gpd.GeoDataFrame
+        Rows of the given GeoDataFrame that failed to process, if `return_failed` is True.
     """
     
-    def _filter_bottlenecks_helper(poly,min_width=40):
-        try: return poly.intersection(poly.buffer(-min_width/2).buffer(min_width/2,join_style=2))
-        except: return poly
-    
-    gdf['geometry'] = gdf.to_crs(projected_crs)['geometry'].map(
-        lambda x: _filter_bottlenecks_helper(x,min_width)).set_crs(projected_crs).to_crs(4326)
-    gdf = gdf[gdf['geometry'] != Polygon()]
-    gdf = gdf.explode(index_parts=False)
-    gdf = gdf[gdf.type == 'Polygon']
+    geometry = np.asarray(gdf.to_crs(projected_crs).geometry.values)
+    chunks = [geometry[i:i+chunk_size] for i in range(0,len(geometry),chunk_size)]
+
+    if n_workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_filter_bottlenecks_chunk,chunks,[min_width]*len(chunks)))
+    else:
+        results = [_filter_bottlenecks_chunk(chunk,min_width) for chunk in chunks]
+
+    processed = np.concatenate([res for res, _ in results]) if results else geometry
+    failed = np.concatenate([mask for _, mask in results]) if results else np.zeros(0,dtype=bool)
+    failed_rows = gdf[failed]
+
+    # keep polygonal parts
+    parts, part_idx = shapely.get_parts(processed,return_index=True)
+    keep = (shapely.get_type_id(parts) == 3) & ~shapely.is_empty(parts)
+    parts, part_idx = parts[keep], part_idx[keep]
+
+    gdf = gdf.iloc[part_idx].copy()
+    gdf['geometry'] = gpd.GeoSeries(parts,index=gdf.index,crs=projected_crs).to_crs(4326)
     
     if 'area' in gdf.columns:
-        gdf['area'] = gdf.to_crs(projected_crs).area
+        gdf['area'] = shapely.area(parts)
+
+    if return_failed:
+        return gdf, failed_rows
         
     return gdf
 
 
-def get_attribute_from_largest_intersection(df, df_with_attribute, attribute_column,df_id_column='block_id',projected_crs=3857):
+@instrumentation.instrument()
+def get_attribute_from_largest_intersection(df, df_with_attribute, attribute_column,df_id_column='block_id',projected_crs=3857,projected_geometry=None):
     """
-    # TODO
+    Assigns every geometry an attribute of the geometries covering the largest share of its area.
     
     Attributes
     ----------
-    # TODO
+    df: gpd.GeoDataFrame
+        Geometries to assign the attribute to, with unique ids in `df_id_column`.
+
+    df_with_attribute: gpd.GeoDataFrame
+        Geometries with the attribute.
+
+    attribute_column: str
+        Column with the attribute.
+
+    df_id_column: str
+        Column with ids of `df`.
+
+    projected_crs: int or pyproj.CRS
+        Metric CRS in which areas are calculated.
+
+    projected_geometry: gpd.GeoSeries or None
+        Geometries of `df` already projected to `projected_crs`.
     
     Returns
     -------
-    # TODO
+    df: gpd.GeoDataFrame
+        `df` with `area`, the attribute and the share of area covered by it (`intersection_area`).
     """
     
-    df_temp = gpd.overlay(
-        df[[df_id_column, "geometry"]],
-        df_with_attribute[[attribute_column, "geometry"]],how="intersection",keep_geom_type=False)
-    
-    df_temp["intersection_area"] = df_temp.to_crs(projected_crs)["geometry"].area
-    df_temp = df_temp.groupby([df_id_column, attribute_column])["intersection_area"].sum().reset_index()
+    if projected_geometry is None:
+        projected_geometry = df.to_crs(projected_crs).geometry
+    geometry = np.asarray(projected_geometry.values)
+    geometry_with_attribute = np.asarray(df_with_attribute.to_crs(projected_crs).geometry.values)
+
+    df["area"] = shapely.area(geometry)
+
+    # intersection areas of candidate pairs only, geometries lying inside need no intersection
+    attribute_idx, idx = shapely.STRtree(geometry).query(geometry_with_attribute, predicate="intersects")
+    shapely.prepare(geometry_with_attribute)
+    inside = shapely.contains_properly(geometry_with_attribute[attribute_idx], geometry[idx])
+
+    intersection_area = df["area"].values[idx]
+    intersection_area[~inside] = shapely.area(
+        shapely.intersection(geometry[idx[~inside]], geometry_with_attribute[attribute_idx[~inside]]))
+
+    # sum areas of polygons with the same attribute value
+    df_temp = pd.DataFrame({
+        df_id_column: df[df_id_column].values[idx],
+        attribute_column: df_with_attribute[attribute_column].values[attribute_idx],
+        "intersection_area": intersection_area / df["area"].values[idx]})
+    df_temp = df_temp.groupby([df_id_column, attribute_column], sort=False)["intersection_area"].sum().reset_index()
 
-    df["area"] = df.to_crs(projected_crs)["geometry"].area
-    df_temp = df_temp.merge(df[[df_id_column, "area"]], how="left")
-    df_temp["intersection_area"] = df_temp["intersection_area"] / df_temp["area"]
-    df_temp = df_temp.sort_values(by=[df_id_column, "intersection_area"])
-    df_temp = df_temp.drop_duplicates(subset=df_id_column, keep="last")
+    # the largest share per id, the largest attribute value on ties
+    order = np.lexsort((df_temp[attribute_column].values, df_temp["intersection_area"].values, df_temp[df_id_column].values))
+    ids = df_temp[df_id_column].values[order]
+    last = np.append(ids[1:] != ids[:-1], True)
+    df_temp = df_temp.iloc[order[last]]
 
     if "cluster" in df.columns:
         df = df.drop("cluster", axis=1)